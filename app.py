@@ -1,5 +1,9 @@
 import openai
 import requests
+try:
+    import httpx2 as httpx  # The HTTP client newer openai releases are built on
+except ImportError:
+    import httpx
 from bs4 import BeautifulSoup
 import json
 import time
@@ -7,55 +11,728 @@ import os
 import tempfile
 import logging
 import pandas as pd
+import numpy as np
 from serpapi import GoogleSearch
 from urllib.parse import urljoin
 from urllib.parse import urlparse
+from urllib.parse import urlunparse, parse_qsl, urlencode
+from datetime import datetime
 from newspaper import Article
 import re
 import streamlit as st
 import zipfile
 import concurrent.futures
 import io
+import pickle
+import argparse
+import shutil
+import queue
+import sqlite3
+import hashlib
+import threading
+import heapq
+import itertools
+import random
+import zlib
+import math
+import types
+import tracemalloc
+import http.server
+from enum import Enum
+from typing import NamedTuple
+
+def get_secret(name):
+    """ Read an API key from the Streamlit secrets, falling back to the environment for headless runs """
+    try:
+        return st.secrets[name]
+    except (FileNotFoundError, KeyError):
+        return os.environ.get(name)
 
 # Securely load API keys
-OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
-SERP_API_KEY = st.secrets["SERP_API_KEY"]
+OPENAI_API_KEY = get_secret("OPENAI_API_KEY")
+SERP_API_KEY = get_secret("SERP_API_KEY")
 # Define your Typeform API token and endpoint
-api_token =  st.secrets["TYPEFORM_API_KEY"]
+api_token =  get_secret("TYPEFORM_API_KEY")
 
-# Initialize OpenAI client
-client = openai.Client(api_key=OPENAI_API_KEY)
+# Initialize OpenAI client (retries are handled by the rate-limit scheduler below)
+client = openai.Client(api_key=OPENAI_API_KEY, max_retries=0)
 
-def get_citations(article_response):
-    article_message_id = article_response.data[0].id
-    article_message_content = article_response.data[0].content[0].text
-    article_message_role= article_response.data[0].role
-    article_message_file_id = article_response.data[0].file_ids
-    #print(f"Article Message Id: {article_message_id}")
-    #print(f"Article Message Content: {article_message_content}")
-    #print(f"Article Message Role: {article_message_role}")
-    #print(f"Article Message File Id: {article_response.data[0].file_ids}")
-    annotations = article_message_content.annotations
-    #print(annotations)
-    citations = []
-    #print(f"File ID in Citation:{article_message_file_id}")
+# Local cache directory shared by the on-disk caches below
+CACHE_DIR = ".cache"
 
-    # Iterate over the annotations and add footnotes
-    for index, annotation in enumerate(annotations):
-        # Replace the text with a footnote
-        article_message_content.value = article_message_content.value.replace(annotation.text, f' [{index}]')
+def make_cache_key(*parts):
+    """ Build a stable hash key from any JSON-serializable parts """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class DiskCache:
+    """
+    Small SQLite-backed key/value store with a TTL and a size-bounded LRU eviction policy.
+    Values are stored as zlib-compressed JSON and can be shared across runs and sessions.
+    """
+
+    def __init__(self, path, ttl=None, max_bytes=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key, default=None, ttl=None):
+        """ The stored value, or default if there is none or it is older than ttl (the store's TTL by default) """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self.lock, self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            value, created = row
+            if ttl is not None and now - created > ttl:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return default
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(zlib.decompress(value).decode('utf-8'))
+
+    def set(self, key, value):
+        now = time.time()
+        blob = zlib.compress(json.dumps(value, default=str).encode('utf-8'))
+        with self.lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                         (key, blob, len(blob), now, now))
+            self._evict(conn)
+
+    def delete(self, key):
+        with self.lock, self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _evict(self, conn):
+        if self.max_bytes is None:
+            return
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until we are back under the cap
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed ASC").fetchall():
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+# SERP responses are cached for a day, capped at 50MB
+SERP_CACHE_TTL = 24 * 60 * 60
+SERP_CACHE_MAX_BYTES = 50_000_000
+serp_cache = DiskCache(os.path.join(CACHE_DIR, "serp.sqlite3"), ttl=SERP_CACHE_TTL, max_bytes=SERP_CACHE_MAX_BYTES)
+
+# Per-minute OpenAI limits for our account, keyed by model (or endpoint for non-model traffic)
+OPENAI_RATE_LIMITS = {
+    "gpt-4-1106-preview": {"rpm": 500, "tpm": 150_000},
+    "gpt-3.5-turbo-1106": {"rpm": 3_500, "tpm": 160_000},
+    "dall-e-3": {"rpm": 5, "tpm": None},
+    "files": {"rpm": 100, "tpm": None},
+    "assistants": {"rpm": 1_000, "tpm": None},  # Threads, messages, run polling and the assistant registry
+    "default": {"rpm": 500, "tpm": None},
+}
+# Lower numbers are served first when requests are waiting on the same budget
+STAGE_PRIORITIES = {
+    "runs": 0,  # Checks on runs already in flight, so finished work is collected first
+    "writing": 0,
+    "outline": 1,
+    "notes": 2,
+    "upload": 2,
+    "images": 3,
+    "survey": 4,
+}
+OPENAI_MAX_RETRIES = 6
+ASSISTANT_RUN_TOKEN_ESTIMATE = 16_000  # Retrieval runs read a whole file and write long notes
+
+def estimate_tokens(text):
+    """ Rough token count for budgeting (about 4 characters per token) """
+    return len(str(text)) // 4 + 1
+
+def estimate_chat_tokens(messages, max_tokens=0):
+    """ Tokens a chat request counts against TPM: the prompt plus the completion allowance """
+    return sum(estimate_tokens(message["content"]) + 4 for message in messages) + max_tokens
+
+class TokenBucket:
+    """ Continuously refilling budget of `per_minute` units """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        """ Charge (positive) or refund (negative) the difference once real usage is known """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class RateLimiter:
+    """ RPM and TPM budgets for one model, plus the queue of requests waiting on them """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self.queue = []
+
+    def wait_time(self, tokens):
+        waits = [self.paused_until - time.monotonic()]
+        if self.requests is not None:
+            waits.append(self.requests.wait_time(1))
+        if self.tokens is not None:
+            waits.append(self.tokens.wait_time(tokens))
+        return max(waits)
+
+    def take(self, tokens):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+def get_retry_after(error):
+    """ Seconds the API asked us to wait, from the Retry-After headers of a 429 """
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+class OpenAIScheduler:
+    """
+    Single gate for all OpenAI traffic. Requests wait for their model's RPM/TPM token buckets,
+    are granted in stage priority order, and back off for the whole model when a 429 comes back.
+    """
+
+    def __init__(self, limits=OPENAI_RATE_LIMITS, priorities=STAGE_PRIORITIES, max_retries=OPENAI_MAX_RETRIES):
+        self.limits = limits
+        self.priorities = priorities
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.limiters = {}
+        self.counter = itertools.count()
+
+    def _limiter(self, model):
+        if model not in self.limiters:
+            limits = self.limits.get(model, self.limits["default"])
+            self.limiters[model] = RateLimiter(limits.get("rpm"), limits.get("tpm"))
+        return self.limiters[model]
+
+    def acquire(self, stage, model, tokens):
+        """ Block until this request fits in the budget and no higher priority request is waiting """
+        ticket = (self.priorities.get(stage, max(self.priorities.values()) + 1), next(self.counter))
+        with self.condition:
+            limiter = self._limiter(model)
+            heapq.heappush(limiter.queue, ticket)
+            try:
+                while True:
+                    if limiter.queue[0] == ticket:
+                        wait = limiter.wait_time(tokens)
+                        if wait <= 0:
+                            limiter.take(tokens)
+                            return
+                        self.condition.wait(timeout=wait)
+                    else:
+                        self.condition.wait(timeout=1.0)
+            finally:
+                limiter.queue.remove(ticket)
+                heapq.heapify(limiter.queue)
+                self.condition.notify_all()
+
+    def call(self, stage, model, tokens, fn, /, *args, **kwargs):
+        """
+        Run an OpenAI request through the scheduler.
+
+        Parameters:
+        stage (str): Pipeline stage, used for priority (see STAGE_PRIORITIES).
+        model (str): Model or endpoint key whose budget the request uses.
+        tokens (int): Estimated tokens the request will consume.
+        fn (callable): The client method to call with *args and **kwargs.
+
+        Returns:
+        The result of fn.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(stage, model, tokens)
+            try:
+                result = fn(*args, **kwargs)
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = get_retry_after(e)
+                if retry_after is None:
+                    retry_after = min(60.0, 2 ** attempt) + random.random()
+                print(f"OpenAI {stage} request for {model} failed ({type(e).__name__}), retrying in {retry_after:.1f}s")
+                if isinstance(e, openai.RateLimitError):
+                    # Hold every request on this model, not just the one that hit the limit
+                    with self.condition:
+                        limiter = self._limiter(model)
+                        limiter.paused_until = max(limiter.paused_until, time.monotonic() + retry_after)
+                        self.condition.notify_all()
+                else:
+                    time.sleep(retry_after)
+                continue
+
+            usage = getattr(result, 'usage', None)
+            total_tokens = getattr(usage, 'total_tokens', None)
+            if isinstance(total_tokens, int):
+                with self.condition:
+                    limiter = self._limiter(model)
+                    if limiter.tokens is not None:
+                        limiter.tokens.adjust(total_tokens - tokens)
+            return result
+
+openai_scheduler = OpenAIScheduler()
+
+# Optional cache of model responses, so development runs with unchanged inputs replay instantly.
+# read-through serves stored responses and stores new ones, record always calls the model but stores
+# what comes back, and bypass (the default) leaves the cache alone so production always generates fresh.
+LLM_CACHE_MODES = ('read-through', 'record', 'bypass')
+LLM_CACHE_MODE = get_secret("LLM_CACHE_MODE") or 'bypass'
+LLM_CACHE_TTL = 7 * 24 * 60 * 60
+LLM_CACHE_KIND_TTLS = {'image': 50 * 60}  # DALL-E URLs expire an hour after generation
+LLM_CACHE_MAX_BYTES = 500_000_000
+LLM_CACHE_IGNORED_PARAMS = {'stream', 'timeout', 'user'}  # Request parameters that don't change the response
+FILE_ID_PATTERN = re.compile(r'\bfile-[A-Za-z0-9]+')
+file_content_hashes = {}  # OpenAI file ID -> sha256 of its content, filled in by upload_bytes
+
+def file_content_hash(file_id):
+    """ The sha256 of an uploaded file's content, from this process or the file ID cache, or None if unknown """
+    if file_id not in file_content_hashes:
+        digest = file_id_cache.get(make_cache_key("file_hash", file_id))
+        if digest is None:
+            return None
+        file_content_hashes[file_id] = digest
+    return file_content_hashes[file_id]
+
+def normalize_llm_request(value):
+    """
+    Canonical form of a model request for fingerprinting. Indentation and other insignificant whitespace
+    is dropped, and file IDs are replaced by the hash of their content, so a re-uploaded file still matches.
+    """
+    if isinstance(value, dict):
+        return {key: normalize_llm_request(item) for key, item in value.items() if key not in LLM_CACHE_IGNORED_PARAMS}
+    if isinstance(value, (list, tuple)):
+        return [normalize_llm_request(item) for item in value]
+    if isinstance(value, str):
+        text = '\n'.join(line.strip() for line in value.strip().splitlines())
+        return FILE_ID_PATTERN.sub(lambda match: file_content_hash(match.group(0)) or match.group(0), text)
+    return value
+
+class LLMCache:
+    """ Response cache for chat, image and assistant run calls, keyed by a fingerprint of the normalized request """
+
+    def __init__(self, path, mode=LLM_CACHE_MODE, ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.store = None
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f"LLM cache mode must be one of {LLM_CACHE_MODES}, not {mode!r}")
+        self.mode = mode
+        # The database is only created once something is going to use it
+        if mode != 'bypass' and self.store is None:
+            self.store = DiskCache(self.path, ttl=self.ttl, max_bytes=self.max_bytes)
+
+    def fingerprint(self, kind, request):
+        return make_cache_key("llm", kind, normalize_llm_request(request))
+
+    def lookup(self, kind, request):
+        """ The stored response for this request, or None if there is none or the mode doesn't read """
+        if self.mode != 'read-through':
+            return None
+        return self.store.get(self.fingerprint(kind, request), ttl=LLM_CACHE_KIND_TTLS.get(kind))
+
+    def record(self, kind, request, response):
+        if self.mode != 'bypass' and response is not None:
+            self.store.set(self.fingerprint(kind, request), response)
+
+    def cached(self, kind, request, compute):
+        """
+        Return the response to a request, calling compute() only when the cache can't answer it.
+
+        Parameters:
+        kind (str): The kind of call, like 'chat', 'image' or 'assistant'.
+        request (dict): Everything that determines the response: model, messages, parameters, file IDs.
+        compute (callable): Makes the actual call and returns a JSON-serializable response, or None on failure.
+        """
+        response = self.lookup(kind, request)
+        if response is None:
+            response = compute()
+            self.record(kind, request, response)
+        return response
+
+llm_cache = LLMCache(os.path.join(CACHE_DIR, "llm.sqlite3"))
+
+def cached_chat_completion(stage, tokens, **request):
+    """ The text of a chat completion, made through the scheduler and the LLM response cache """
+    return llm_cache.cached('chat', request, lambda: openai_scheduler.call(
+        stage, request['model'], tokens, client.chat.completions.create, **request).choices[0].message.content)
+
+# Record/replay of outbound HTTP, so a slow production run can be profiled offline against exactly the SERP
+# results, pages and model outputs it saw. record passes traffic through and archives every exchange with its
+# timings; replay serves the archive back, sleeping the recorded latency times the latency scale
+# (1 for the original timings, less to compress them, 0 for none).
+HTTP_ARCHIVE_MODES = ('record', 'replay')
+HTTP_ARCHIVE_PATH = os.path.join(CACHE_DIR, "http_archive.sqlite3")
+HTTP_REPLAY_LATENCY = 1.0
+HTTP_ARCHIVE_REDACTED_PARAMS = {'api_key', 'key', 'token'}
+HTTP_ARCHIVE_ID_PATTERN = re.compile(r'/(?:file|asst|thread|run|msg|step)[-_][A-Za-z0-9]+')
+# requests has already decoded the body it hands back, so these would describe the wrong bytes on replay
+HTTP_ARCHIVE_DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+
+def archive_keys(method, url, body, content_type=''):
+    """
+    The redacted URL and the (exact, same URL, same route) keys a request is matched on at replay.
+    Credentials are dropped from the query and multipart boundaries are made constant.
+    """
+    parts = urlparse(url)
+    query = urlencode([(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name not in HTTP_ARCHIVE_REDACTED_PARAMS])
+    url = urlunparse(parts._replace(query=query))
+    boundary = re.search(r'boundary=([^;\s]+)', content_type)
+    if boundary:
+        body = body.replace(boundary.group(1).encode('utf-8'), b'boundary')
+    route = f"{method} {parts.netloc}{HTTP_ARCHIVE_ID_PATTERN.sub('/{id}', parts.path)}"
+    return url, (f"{method} {url} {hashlib.sha256(body).hexdigest()}", f"{method} {url}", route)
+
+class HTTPArchive:
+    """
+    SQLite archive of HTTP exchanges with the time each chunk of the response arrived.
+
+    Replay matches a request by method, URL and body, then by method and URL, then by route with the OpenAI IDs
+    masked, and serves the recorded responses for a match in the order they were recorded, repeating the last
+    once they run out. Concurrent runs that differ only in which thread they landed on can be served each
+    other's responses, which keeps the volume and timing of the run even though the content is shuffled.
+    """
+
+    def __init__(self, path, mode, latency_scale=HTTP_REPLAY_LATENCY):
+        if mode not in HTTP_ARCHIVE_MODES:
+            raise ValueError(f"HTTP archive mode must be one of {HTTP_ARCHIVE_MODES}, not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.recorded = 0
+        self.replayed = 0
+        self.missed = 0
+        self.cache_dir = None  # The temporary caches and checkpoints of the run going through the archive
+        if mode == 'record':
+            # A recording is one run; appending to an old one would mix two runs' timings
+            if os.path.exists(path):
+                os.remove(path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("""CREATE TABLE exchanges (
+                    seq INTEGER PRIMARY KEY, exact TEXT, url TEXT, route TEXT, started REAL, elapsed REAL, data BLOB)""")
+        else:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No HTTP archive at {path}")
+            # Key -> seqs in the order the requests were sent, for each of the three match levels
+            self.index = [{}, {}, {}]
+            self.cursors = {}
+            self.served = set()
+            with self._connect() as conn:
+                for row in conn.execute("SELECT seq, exact, url, route FROM exchanges ORDER BY started"):
+                    for level, key in enumerate(row[1:]):
+                        self.index[level].setdefault(key, []).append(row[0])
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, method, url, body, content_type, started, status, reason, headers, chunks):
+        """ Archive one exchange; chunks are (seconds since the request was sent, bytes) pairs """
+        url, keys = archive_keys(method, url, body, content_type)
+        entry = {'method': method, 'url': url, 'status': status, 'reason': reason, 'headers': headers, 'chunks': chunks}
+        elapsed = chunks[-1][0] if chunks else 0.0
+        blob = zlib.compress(pickle.dumps(entry))
+        with self.lock, self._connect() as conn:
+            conn.execute("INSERT INTO exchanges (exact, url, route, started, elapsed, data) VALUES (?, ?, ?, ?, ?, ?)",
+                         (*keys, started - self.started, elapsed, blob))
+            self.recorded += 1
+
+    def _next(self, level, key):
+        """ The first recorded response for this key that hasn't been served yet """
+        seqs = self.index[level].get(key, [])
+        position = self.cursors.get((level, key), 0)
+        while position < len(seqs) and seqs[position] in self.served:
+            position += 1
+        self.cursors[(level, key)] = position
+        return seqs[position] if position < len(seqs) else None
 
-        # Gather citations based on annotation attributes
+    def lookup(self, method, url, body, content_type=''):
+        """ The archived exchange to replay for a request, or None if nothing recorded resembles it """
+        _, keys = archive_keys(method, url, body, content_type)
+        with self.lock:
+            seq = next((seq for level, key in enumerate(keys) for seq in [self._next(level, key)] if seq is not None), None)
+            if seq is None:
+                # Everything that matches has been served; poll loops and retries get the last response again
+                seq = next((self.index[level][key][-1] for level, key in enumerate(keys) if key in self.index[level]), None)
+            if seq is None:
+                self.missed += 1
+                print(f"No recorded response for {method} {url}")
+                return None
+            self.served.add(seq)
+            self.replayed += 1
+        with self._connect() as conn:
+            blob = conn.execute("SELECT data FROM exchanges WHERE seq = ?", (seq,)).fetchone()[0]
+        return pickle.loads(zlib.decompress(blob))
+
+    def replay_chunks(self, entry):
+        """ Yield the recorded response body, paced like the original """
+        started = time.monotonic()
+        for offset, chunk in entry['chunks']:
+            delay = offset * self.latency_scale - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+            yield chunk
+
+    def summary(self):
+        if self.mode == 'record':
+            return f"Recorded {self.recorded} HTTP exchanges to {self.path}"
+        return f"Replayed {self.replayed} HTTP exchanges from {self.path}, {self.missed} requests had no recording"
+
+    def close(self):
+        """ Remove the temporary caches and checkpoints once the run is over """
+        if self.cache_dir is not None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.cache_dir = None
+
+class ArchiveAdapter(requests.adapters.HTTPAdapter):
+    """ requests transport that records through to the network or replays from an HTTPArchive """
+
+    def __init__(self, archive):
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        content_type = request.headers.get('Content-Type', '')
+        if self.archive.mode == 'replay':
+            entry = self.archive.lookup(request.method, request.url, body, content_type)
+            if entry is None:
+                raise requests.ConnectionError(f"No recorded response for {request.method} {request.url}", request=request)
+            response = requests.Response()
+            response.status_code = entry['status']
+            response.reason = entry['reason']
+            response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            response.raw = io.BytesIO(b''.join(self.archive.replay_chunks(entry)))
+            response.url = request.url
+            response.request = request
+            response.connection = self
+            return response
+
+        started = time.monotonic()
+        response = super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        # Reading the body here means the recorded latency covers the whole download
+        content = response.content
+        headers = [(name, value) for name, value in response.headers.items() if name.lower() not in HTTP_ARCHIVE_DROPPED_HEADERS]
+        self.archive.record(request.method, request.url, body, content_type, started, response.status_code, response.reason,
+                            headers, [(time.monotonic() - started, content)])
+        return response
+
+class RecordingStream(httpx.SyncByteStream):
+    """ Passes an OpenAI response body through, archiving it with chunk timings once it has been read or closed """
+
+    def __init__(self, archive, request, body, started, response):
+        self.archive = archive
+        self.request = request
+        self.body = body
+        self.started = started
+        self.response = response
+        self.chunks = []
+        self.saved = False
+
+    def __iter__(self):
+        for chunk in self.response.stream:
+            self.chunks.append((time.monotonic() - self.started, chunk))
+            yield chunk
+        self._save()
+
+    def _save(self):
+        if not self.saved:
+            self.saved = True
+            self.archive.record(self.request.method, str(self.request.url), self.body, self.request.headers.get('content-type', ''),
+                                self.started, self.response.status_code, None, list(self.response.headers.multi_items()), self.chunks)
+
+    def close(self):
+        self.response.close()
+        self._save()
+
+class ReplayStream(httpx.SyncByteStream):
+    def __init__(self, archive, entry):
+        self.archive = archive
+        self.entry = entry
+
+    def __iter__(self):
+        return self.archive.replay_chunks(self.entry)
+
+class ArchiveTransport(httpx.BaseTransport):
+    """ httpx transport for the OpenAI client that records through to the network or replays from an HTTPArchive """
+
+    def __init__(self, archive, transport=None):
+        self.archive = archive
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        body = request.read()
+        if self.archive.mode == 'replay':
+            entry = self.archive.lookup(request.method, str(request.url), body, request.headers.get('content-type', ''))
+            if entry is None:
+                raise httpx.ConnectError(f"No recorded response for {request.method} {request.url}", request=request)
+            return httpx.Response(entry['status'], headers=entry['headers'], stream=ReplayStream(self.archive, entry), request=request)
+
+        started = time.monotonic()
+        response = self.transport.handle_request(request)
+        return httpx.Response(response.status_code, headers=response.headers, request=request, extensions=response.extensions,
+                              stream=RecordingStream(self.archive, request, body, started, response))
+
+    def close(self):
+        self.transport.close()
+
+http_archive = None
+
+def use_http_archive(mode, path=HTTP_ARCHIVE_PATH, latency_scale=HTTP_REPLAY_LATENCY):
+    """
+    Send the OpenAI client and every requests call (SerpAPI, article pages, images, Typeform) through an HTTPArchive.
+
+    The caches and run checkpoints are moved to an empty temporary directory, so every request reaches the network
+    or the archive and a recording replays the same way it was made. Closing the archive removes that directory.
+
+    Parameters:
+    mode (str): 'record' or 'replay'.
+    path (str): The archive file; recording replaces it.
+    latency_scale (float): Replayed latencies are the recorded ones times this.
+
+    Returns:
+    HTTPArchive: The archive, whose summary() reports what was recorded or replayed.
+    """
+    global client, http_archive
+    http_archive = HTTPArchive(path, mode, latency_scale)
+    adapter = ArchiveAdapter(http_archive)
+    # requests.get builds a new Session per call, so the adapter is installed on all of them
+    requests.Session.get_adapter = lambda session, url: adapter
+    client = openai.Client(api_key=OPENAI_API_KEY or 'replay', max_retries=0,
+                           http_client=openai.DefaultHttpxClient(transport=ArchiveTransport(http_archive)))
+    http_archive.cache_dir = tempfile.mkdtemp(prefix="http_archive_")
+    use_cache_dir(http_archive.cache_dir)
+    return http_archive
+
+# File names rarely change, so citation lookups are memoized for an hour
+FILE_METADATA_TTL = 60 * 60
+_file_metadata_cache = {}
+_file_metadata_lock = threading.Lock()
+
+def get_file_metadata(file_ids):
+    """ Resolve file IDs to file objects, fetching the distinct uncached ones concurrently """
+    now = time.monotonic()
+    resolved = {}
+    with _file_metadata_lock:
+        for file_id in set(file_ids):
+            cached = _file_metadata_cache.get(file_id)
+            if cached is not None and cached[0] > now:
+                resolved[file_id] = cached[1]
+    missing = [file_id for file_id in set(file_ids) if file_id not in resolved]
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(missing))) as executor:
+            fetched = dict(zip(missing, executor.map(
+                lambda file_id: openai_scheduler.call("writing", "files", 0, client.files.retrieve, file_id), missing)))
+        with _file_metadata_lock:
+            for file_id, cited_file in fetched.items():
+                _file_metadata_cache[file_id] = (now + FILE_METADATA_TTL, cited_file)
+        resolved.update(fetched)
+    return resolved
+
+def resolve_citations(message_text):
+    """
+    Replace a message's annotations with footnote markers in a single pass.
+
+    Parameters:
+    message_text: The text part of an assistant message (value plus annotations).
+
+    Returns:
+    tuple: (text with footnotes appended, list of citation dicts with index, type, file_id, filename and quote)
+    """
+    text = message_text.value
+    annotations = list(message_text.annotations)
+    citations = []
+    for index, annotation in enumerate(annotations):
         if (file_citation := getattr(annotation, 'file_citation', None)):
-            cited_file = client.files.retrieve(file_citation.file_id)
-            citations.append(f'[{index}] from {cited_file.filename}')
+            citations.append({'index': index, 'type': 'file_citation', 'file_id': file_citation.file_id,
+                              'quote': getattr(file_citation, 'quote', None)})
         elif (file_path := getattr(annotation, 'file_path', None)):
-            cited_file = client.files.retrieve(file_path.file_id)
-            citations.append(f'[{index}] Click <here> to download {cited_file.filename}')
+            citations.append({'index': index, 'type': 'file_path', 'file_id': file_path.file_id, 'quote': None})
+
+    files = get_file_metadata([citation['file_id'] for citation in citations])
+    for citation in citations:
+        citation['filename'] = files[citation['file_id']].filename
+
+    # Locate every annotation by offset (falling back to a forward search) and rebuild the text once
+    spans = []
+    cursor = 0
+    for index, annotation in sorted(enumerate(annotations), key=lambda item: getattr(item[1], 'start_index', None) or 0):
+        start = getattr(annotation, 'start_index', None)
+        end = getattr(annotation, 'end_index', None)
+        if start is None or end is None or text[start:end] != annotation.text:
+            start = text.find(annotation.text, cursor)
+            if start == -1:
+                continue
+            end = start + len(annotation.text)
+        if start < cursor:
+            continue
+        spans.append((start, end, index))
+        cursor = end
+    pieces = []
+    cursor = 0
+    for start, end, index in spans:
+        pieces.append(text[cursor:start])
+        pieces.append(f' [{index}]')
+        cursor = end
+    pieces.append(text[cursor:])
+
+    footnotes = []
+    for citation in citations:
+        if citation['type'] == 'file_citation':
+            footnotes.append(f"[{citation['index']}] from {citation['filename']}")
+        else:
+            footnotes.append(f"[{citation['index']}] Click <here> to download {citation['filename']}")
             # Note: File download functionality not implemented above for brevity
 
     # Add footnotes to the end of the message before displaying to user
-    article_message_content.value += '\n' + '\n'.join(citations)
+    return ''.join(pieces) + '\n' + '\n'.join(footnotes), citations
+
+def get_citations(article_response):
+    article_message_content = article_response.data[0].content[0].text
+    article_message_content.value, _ = resolve_citations(article_message_content)
     return article_message_content.value
 
 def get_root_domain(url):
@@ -66,43 +743,242 @@ def get_root_domain(url):
     root_domain = '.'.join(domain_parts[-2:]) if len(domain_parts) > 1 else parsed_url.netloc
     return root_domain
 
-def scrape_articles(query,num_articles):
-    all_results = []
-    num_articles = int(num_articles)
-    for i in range(num_articles):  # Iterating over three pages
-
-        start_index = i * 10  # Google usually shows 10 results per page
-        params = {
-            "engine": "google",
-            "q": query,
-            "start": start_index,
-            "gl": "us",  # Country setting
-            "api_key": SERP_API_KEY  # Replace with your SERP API key
+# Query parameters that only track the visit and never change the page content
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'igshid', 'ref', 'ref_src', 'cmpid', 'ocid'}
+
+def canonicalize_url(url):
+    """ Normalize a URL so the same page always maps to the same key """
+    parsed = urlparse(url.strip())
+    # http and https copies of a page are the same article
+    scheme = 'https' if parsed.scheme.lower() in ('', 'http') else parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    path = re.sub(r'/{2,}', '/', parsed.path or '/')
+    if len(path) > 1:
+        path = path.rstrip('/')
+    query = [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+             if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS]
+    return urlunparse((scheme, netloc, path, '', urlencode(sorted(query)), ''))
+
+# Concurrency settings for the article fetch stage
+FETCH_WORKERS = 8  # Simultaneous page downloads
+PARSE_WORKERS = os.cpu_count() or 2  # Processes used for newspaper parsing
+FETCH_TIMEOUT = 10  # Seconds allowed per HTTP request
+FETCH_BATCH_TIMEOUT = 90  # Seconds before stragglers are abandoned
+FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+}
+
+# Scraped articles are kept in a local store and revalidated after a week, capped at 500MB
+ARTICLE_STORE_PATH = os.path.join(CACHE_DIR, "articles.sqlite3")
+ARTICLE_STORE_FRESH_FOR = 7 * 24 * 60 * 60
+ARTICLE_STORE_MAX_BYTES = 500_000_000
+
+class ArticleStore:
+    """
+    Persistent article store keyed by canonical URL.
+    Keeps the parsed text (zlib-compressed), authors, publish date, a hash of the raw page and the
+    ETag/Last-Modified validators so unchanged pages can be revalidated without being re-parsed.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS articles (
+                url TEXT PRIMARY KEY, text BLOB, authors TEXT, publish_date TEXT, content_hash TEXT,
+                etag TEXT, last_modified TEXT, size INTEGER, fetched REAL, accessed REAL)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, url):
+        url = canonicalize_url(url)
+        with self.lock, self._connect() as conn:
+            row = conn.execute("""SELECT text, authors, publish_date, content_hash, etag, last_modified, fetched
+                                  FROM articles WHERE url = ?""", (url,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE articles SET accessed = ? WHERE url = ?", (time.time(), url))
+        text, authors, publish_date, content_hash, etag, last_modified, fetched = row
+        return {
+            'text': zlib.decompress(text).decode('utf-8'),
+            'authors': json.loads(authors),
+            'publish_date': datetime.fromisoformat(publish_date) if publish_date else None,
+            'content_hash': content_hash,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched': fetched,
         }
-        search = GoogleSearch(params)  # Use the GoogleSearch class
-        results = search.get_dict()
-        serp_data = results["organic_results"]
 
-        for result in serp_data:
+    def put(self, url, text, authors, publish_date, content_hash, etag=None, last_modified=None):
+        now = time.time()
+        blob = zlib.compress(text.encode('utf-8'))
+        publish_date = publish_date.isoformat() if publish_date else None
+        with self.lock, self._connect() as conn:
+            conn.execute("""INSERT OR REPLACE INTO articles
+                            (url, text, authors, publish_date, content_hash, etag, last_modified, size, fetched, accessed)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         (canonicalize_url(url), blob, json.dumps(authors), publish_date, content_hash,
+                          etag, last_modified, len(blob), now, now))
+            self._evict(conn)
+
+    def touch(self, url, etag=None, last_modified=None):
+        """ Mark a stored article as freshly revalidated """
+        now = time.time()
+        with self.lock, self._connect() as conn:
+            conn.execute("""UPDATE articles SET fetched = ?, accessed = ?, etag = COALESCE(?, etag),
+                            last_modified = COALESCE(?, last_modified) WHERE url = ?""",
+                         (now, now, etag, last_modified, canonicalize_url(url)))
+
+    def _evict(self, conn):
+        if self.max_bytes is None:
+            return
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM articles").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used articles until we are back under the cap
+        for url, size in conn.execute("SELECT url, size FROM articles ORDER BY accessed ASC").fetchall():
+            conn.execute("DELETE FROM articles WHERE url = ?", (url,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+article_store = ArticleStore(ARTICLE_STORE_PATH, max_bytes=ARTICLE_STORE_MAX_BYTES)
+
+def parse_article_html(link, html):
+    """ Parse downloaded HTML with newspaper. Runs inside the parse process pool. """
+    article = Article(link)
+    article.download(input_html=html)
+    article.parse()
+    return article.text, article.authors, article.publish_date
+
+def fetch_article(link, parse_pool, timeout=FETCH_TIMEOUT, store=None):
+    """ Load a page from the article store, revalidating or downloading and parsing it when needed """
+    store = store or article_store
+    stored = store.get(link)
+    if stored is not None and time.time() - stored['fetched'] < ARTICLE_STORE_FRESH_FOR:
+        return stored['text'], stored['authors'], stored['publish_date']
+
+    headers = dict(FETCH_HEADERS)
+    if stored is not None:
+        # Conditional request so unchanged pages come back as 304 Not Modified
+        if stored['etag']:
+            headers['If-None-Match'] = stored['etag']
+        if stored['last_modified']:
+            headers['If-Modified-Since'] = stored['last_modified']
+
+    response = requests.get(link, headers=headers, timeout=timeout)
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if stored is not None and response.status_code == 304:
+        store.touch(link, etag, last_modified)
+        return stored['text'], stored['authors'], stored['publish_date']
+    response.raise_for_status()
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if stored is not None and stored['content_hash'] == content_hash:
+        store.touch(link, etag, last_modified)
+        return stored['text'], stored['authors'], stored['publish_date']
+
+    html = response.text
+    try:
+        parsed = parse_pool.submit(parse_article_html, link, html).result(timeout=timeout)
+    except concurrent.futures.BrokenExecutor:
+        # Fall back to parsing in this thread if the process pool is unavailable
+        parsed = parse_article_html(link, html)
+
+    text, authors, publish_date = parsed
+    store.put(link, text, authors, publish_date, content_hash, etag, last_modified)
+    return parsed
+
+def fetch_articles(serp_hits, max_workers=FETCH_WORKERS, timeout=FETCH_TIMEOUT, batch_timeout=FETCH_BATCH_TIMEOUT):
+    """
+    Download and parse SERP hits concurrently.
+
+    Parameters:
+    serp_hits (list): Organic results from SerpAPI, in SERP order.
+    max_workers (int): Number of simultaneous downloads.
+    timeout (int): Per-request timeout in seconds.
+    batch_timeout (int): Overall deadline; hosts still pending after it are skipped.
+
+    Returns:
+    list: (result, text, authors, publish_date) tuples in SERP order, for hits that succeeded.
+    """
+    parsed = [None] * len(serp_hits)
+    parse_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(fetch_article, hit['link'], parse_pool, timeout): index
+                   for index, hit in enumerate(serp_hits)}
+        done, not_done = concurrent.futures.wait(futures, timeout=batch_timeout)
+        for future in done:
+            index = futures[future]
             try:
-                link = result['link']
-                title = result['title']
-                snippet = result.get('snippet', '')
-
-                article_text = Article(link)
-                article_text.download()
-                article_text.parse()
-
-                text = article_text.text
-                authors = article_text.authors
-                publish_date = article_text.publish_date
-
-                # Check if the article text is 500 words or longer
-                if len(text.split()) >= 500:
-                    root_domain = get_root_domain(link)  # Ensure this function is defined
-                    all_results.append((root_domain, link, title, authors, publish_date, snippet, text))
+                parsed[index] = future.result()
             except Exception as e:
-                print(f"Couldn't download article from {link}: {e}")
+                print(f"Couldn't download article from {serp_hits[index]['link']}: {e}")
+        for future in not_done:
+            print(f"Timed out downloading article from {serp_hits[futures[future]]['link']}")
+    finally:
+        # Don't let slow or dead hosts hold up the batch
+        executor.shutdown(wait=False, cancel_futures=True)
+        parse_pool.shutdown(wait=False, cancel_futures=True)
+
+    return [(hit,) + result for hit, result in zip(serp_hits, parsed) if result is not None]
+
+def fetch_serp_page(query, start_index, gl="us"):
+    """ Retrieve one page of organic Google results, served from the SERP cache when possible """
+    cache_key = make_cache_key("serp", query, start_index, gl)
+    cached = serp_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    params = {
+        "engine": "google",
+        "q": query,
+        "start": start_index,
+        "gl": gl,  # Country setting
+        "api_key": SERP_API_KEY  # Replace with your SERP API key
+    }
+    search = GoogleSearch(params)  # Use the GoogleSearch class
+    results = search.get_dict()
+    if "error" in results:
+        print(f"SerpAPI error for {query!r} page starting at {start_index}: {results['error']}")
+        return []
+    serp_data = results.get("organic_results")
+    if serp_data is None:
+        return []
+    # Only real result pages are cached; errors and empty answers are retried on the next run
+    serp_cache.set(cache_key, serp_data)
+    return serp_data
+
+def scrape_articles(query,num_articles):
+    all_results = []
+    serp_hits = []
+    num_articles = int(num_articles)
+    start_indexes = [i * 10 for i in range(num_articles)]  # Google usually shows 10 results per page
+
+    # Request all pages at once; map keeps them in page order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, num_articles)) as executor:
+        pages = executor.map(lambda start_index: fetch_serp_page(query, start_index), start_indexes)
+        for serp_data in pages:
+            serp_hits.extend(result for result in serp_data if 'link' in result)
+
+    for result, text, authors, publish_date in fetch_articles(serp_hits):
+        link = result['link']
+        title = result.get('title', '')
+        snippet = result.get('snippet', '')
+
+        # Check if the article text is 500 words or longer
+        if len(text.split()) >= 500:
+            root_domain = get_root_domain(link)  # Ensure this function is defined
+            all_results.append((root_domain, link, title, authors, publish_date, snippet, text))
 
     # Define the column names for the DataFrame
     columns = ['Root Domain', 'Link', 'Title', 'Authors', 'Publish Date', 'Snippet', 'Text']
@@ -110,41 +986,481 @@ def scrape_articles(query,num_articles):
     # Create the DataFrame with column names
     article_df = pd.DataFrame(all_results, columns=columns)
 
-    # Save to CSV
-    article_df.to_csv("articles_dataframe.csv", index=False)
+    # Not saved to the working directory: concurrent batch queries would overwrite each other's file,
+    # and the results bundle already holds every article under Articles/
     print("Filtered Results from SerpAPI")
 
     return article_df  # Return the DataFrame of search results
 
 
 
+# Near-duplicate detection settings (MinHash over word shingles with LSH banding)
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 32  # 32 bands of 4 rows puts the LSH candidate threshold around 0.42
+DUPLICATE_THRESHOLD = 0.8  # Estimated Jaccard similarity needed to merge two articles
+_MINHASH_PRIME = np.uint64(4294967291)  # Largest 32 bit prime, keeps a * h + b inside uint64
+_minhash_rng = np.random.RandomState(1)
+_MINHASH_A = _minhash_rng.randint(1, 2**32 - 5, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_B = _minhash_rng.randint(0, 2**32 - 5, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    """ Hash the overlapping word n-grams of a text into 32 bit integers """
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        words = words + [''] * (size - len(words))
+    shingles = {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+def minhash_signature(text, shingle_size=SHINGLE_SIZE):
+    """ MinHash signature of a text, one minimum per permutation """
+    hashes = shingle_hashes(text, shingle_size)
+    return ((np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+
+def find_duplicate_clusters(texts, threshold=DUPLICATE_THRESHOLD, bands=MINHASH_BANDS, keys=None, shingle_size=SHINGLE_SIZE):
+    """
+    Group near-identical texts without comparing every pair of full texts.
+
+    Parameters:
+    texts (list): The texts to compare.
+    threshold (float): Estimated Jaccard similarity needed to treat two texts as duplicates.
+    bands (int): Number of LSH bands the signatures are split into.
+    keys (list): Optional exact keys (e.g. canonical URLs); texts sharing a key always cluster together.
+    shingle_size (int): Words per shingle; use smaller shingles for short texts.
+
+    Returns:
+    list: A cluster id per text; texts sharing an id are duplicates. Ids are the index of the first member.
+    """
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    if keys is not None:
+        first_for_key = {}
+        for index, key in enumerate(keys):
+            union(first_for_key.setdefault(key, index), index)
+
+    if not texts:
+        return []
+    signatures = np.array([minhash_signature(text, shingle_size) for text in texts])
+    rows = MINHASH_PERMUTATIONS // bands
+    for band in range(bands):
+        buckets = {}
+        for index, signature in enumerate(signatures):
+            buckets.setdefault(signature[band * rows:(band + 1) * rows].tobytes(), []).append(index)
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                if find(first) == find(other):
+                    continue
+                # Only candidates that share a bucket get the (cheap) signature comparison
+                if np.mean(signatures[first] == signatures[other]) >= threshold:
+                    union(first, other)
+
+    return [find(i) for i in range(len(texts))]
+
+def dedupe_articles(article_df, threshold=DUPLICATE_THRESHOLD):
+    """
+    Collapse repeated URLs and near-duplicate article texts, keeping the highest ranked copy.
+
+    Returns:
+    tuple: (deduplicated DataFrame, dict mapping each kept link to the list of links merged into it)
+    """
+    if article_df.empty:
+        return article_df, {}
+
+    canonical = article_df['Link'].map(canonicalize_url).tolist()
+    clusters = find_duplicate_clusters(article_df['Text'].tolist(), threshold, keys=canonical)
+
+    links = article_df['Link'].tolist()
+    merged = {}
+    for position, kept in enumerate(clusters):
+        if kept != position:
+            merged.setdefault(links[kept], []).append(links[position])
+            print(f"Merged duplicate {links[position]} into {links[kept]}")
+
+    keep = [kept == position for position, kept in enumerate(clusters)]
+    return article_df[keep].reset_index(drop=True), merged
+
+# Uploaded files are remembered by content hash so unchanged articles and notes are never re-uploaded
+FILE_ID_CACHE_TTL = 7 * 24 * 60 * 60
+file_id_cache = DiskCache(os.path.join(CACHE_DIR, "file_ids.sqlite3"), ttl=FILE_ID_CACHE_TTL)
+_verified_file_ids = set()
+UPLOAD_WORKERS = 8
+
+def safe_filename(name):
+    """ Make a title or URL usable as an uploaded file name """
+    return re.sub(r'[^\w\-_\. ]', '_', str(name))[:200]
+
+def upload_bytes(client, data, filename):
+    """
+    Upload an in-memory file for the assistants, reusing the file ID of identical earlier uploads.
+
+    Parameters:
+    client (openai.Client): The OpenAI client.
+    data (bytes): The file content.
+    filename (str): The name the file is uploaded under.
+
+    Returns:
+    str: The OpenAI file ID.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    cache_key = make_cache_key("file", digest)
+    file_id = file_id_cache.get(cache_key)
+    if file_id is not None and file_id not in _verified_file_ids:
+        # Make sure the cached file still exists on the account, once per process
+        try:
+            openai_scheduler.call("upload", "files", 0, client.files.retrieve, file_id)
+            _verified_file_ids.add(file_id)
+        except openai.NotFoundError:
+            file_id_cache.delete(cache_key)
+            file_id_cache.delete(make_cache_key("file_hash", file_id))
+            file_id = None
+    if file_id is None:
+        file_id = openai_scheduler.call("upload", "files", 0, client.files.create,
+                                        file=(filename, io.BytesIO(data)), purpose='assistants').id
+        file_id_cache.set(cache_key, file_id)
+        # Kept under the file ID too, so cached LLM requests that mention it still match after a restart
+        file_id_cache.set(make_cache_key("file_hash", file_id), digest)
+        _verified_file_ids.add(file_id)
+    file_content_hashes[file_id] = digest
+    return file_id
+
+# Information-gain source selection: hashed TF-IDF vectors, greedily picked for relevance and novelty
+HASHED_FEATURES = 2 ** 14
+SOURCE_TOKEN_BUDGET = 200_000  # Article tokens we are willing to send through worker runs
+MIN_SOURCE_NOVELTY = 0.1  # Sources closer than this to what is already selected add nothing new
+RELEVANCE_WEIGHT = 0.5  # Balance between relevance to the query and novelty against selected sources
+
+def hashed_tfidf(texts, idf=None):
+    """
+    Sublinear TF-IDF vectors over hashed word features, L2-normalized.
+
+    Returns:
+    tuple: (matrix with one row per text, idf vector so other texts can be embedded in the same space)
+    """
+    matrix = np.zeros((len(texts), HASHED_FEATURES), dtype=np.float32)
+    for row, text in enumerate(texts):
+        features = [zlib.crc32(term.encode('utf-8')) % HASHED_FEATURES for term in search_terms(text)]
+        if features:
+            matrix[row] = np.bincount(features, minlength=HASHED_FEATURES)
+    np.log1p(matrix, out=matrix)
+    if idf is None:
+        document_frequency = np.count_nonzero(matrix, axis=0)
+        idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+    matrix *= idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    return matrix, idf
+
+def select_sources(article_df, query, max_sources=None, max_tokens=SOURCE_TOKEN_BUDGET, min_novelty=MIN_SOURCE_NOVELTY):
+    """
+    Greedily pick the articles that add the most new, relevant information, within a budget.
+
+    Parameters:
+    article_df (DataFrame): The scraped articles.
+    query (str): The research query.
+    max_sources (int): Maximum number of articles to keep, or None for no limit.
+    max_tokens (int): Maximum estimated tokens of article text to keep, or None for no limit.
+    min_novelty (float): Articles less novel than this against the selection are skipped.
+
+    Returns:
+    tuple: (selected articles in their original order, DataFrame scoring every article)
+    """
+    if article_df.empty:
+        return article_df, pd.DataFrame(columns=['Link', 'Relevance', 'Novelty', 'Rank'])
+
+    texts = article_df['Text'].tolist()
+    vectors, idf = hashed_tfidf(texts)
+    query_vector, _ = hashed_tfidf([query], idf)
+    relevance = vectors @ query_vector[0]
+    if relevance.max() > 0:
+        relevance = relevance / relevance.max()
+    tokens = np.array([estimate_tokens(text) for text in texts])
+
+    selected = []
+    max_similarity = np.zeros(len(texts), dtype=np.float32)  # Similarity to the closest selected article
+    novelty_at_pick = np.zeros(len(texts), dtype=np.float32)
+    available = np.ones(len(texts), dtype=bool)
+    spent = 0
+    while available.any() and (max_sources is None or len(selected) < max_sources):
+        novelty = 1 - max_similarity
+        gain = np.where(available, RELEVANCE_WEIGHT * relevance + (1 - RELEVANCE_WEIGHT) * novelty, -np.inf)
+        best = int(np.argmax(gain))
+        available[best] = False
+        # A redundant article is skipped, not a reason to stop: less relevant ones may still add something new
+        if novelty[best] < min_novelty:
+            continue
+        if max_tokens is not None and spent + tokens[best] > max_tokens:
+            continue
+        selected.append(best)
+        spent += tokens[best]
+        novelty_at_pick[best] = novelty[best]
+        max_similarity = np.maximum(max_similarity, vectors @ vectors[best])
+
+    ranks = np.zeros(len(texts), dtype=int)
+    ranks[selected] = np.arange(1, len(selected) + 1)
+    scores = pd.DataFrame({
+        'Link': article_df['Link'].tolist(),
+        'Relevance': relevance.round(3),
+        'Novelty': np.where(ranks > 0, novelty_at_pick, 1 - max_similarity).round(3),
+        'Rank': ranks,
+    })
+    print(f"Selected {len(selected)} of {len(texts)} sources ({spent} estimated tokens)")
+    return article_df.iloc[sorted(selected)].reset_index(drop=True), scores
+
 def upload_article(content, article_index,title):
-    file_path = f"{title}.txt"
+    data = content.encode('utf-8')
 
     # Check if the content is too large
-    if len(content.encode('utf-8')) > 10_000_000:  # 1MB in bytes
-        print(f"Article {article_index} size exceeds 1MB, skipping upload.")
+    if len(data) > 10_000_000:  # 10MB in bytes
+        print(f"Article {article_index} size exceeds 10MB, skipping upload.")
         return None
 
     try:
-        # Write content to a text file
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(content)
-
-        # Upload the file
-        with open(file_path, 'rb') as f:
-            response = client.files.create(file=f, purpose='assistants')
-            file_id = response.id
-            print(f"Uploaded article {article_index} with file ID: {file_id}")
-            return file_id
+        file_id = upload_bytes(client, data, f"{safe_filename(title)}.txt")
+        print(f"Uploaded article {article_index} with file ID: {file_id}")
+        return file_id
     except Exception as e:
         print(f"Error uploading article {article_index}: {e}")
         return None
-    #finally:
-        # Delete the local file
-        #if os.path.exists(file_path):
-            #os.remove(file_path)
 
+def upload_articles(articles, on_uploaded=None):
+    """
+    Upload every scraped article concurrently, returning (file_id, title) pairs in article order.
+    on_uploaded is called with each pair as soon as that upload finishes.
+    """
+    def upload_row(item):
+        index, row = item
+        article_content = '\n'.join(f'{key}: {value}' for key, value in row.items())
+        return upload_article(article_content, index, row['Title']), row['Title']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(upload_row, item) for item in articles.iterrows()]
+        if on_uploaded is not None:
+            for future in concurrent.futures.as_completed(futures):
+                on_uploaded(future.result())
+        return [future.result() for future in futures]
+
+
+# Assistant IDs are persisted locally so identical configurations are created only once
+ASSISTANT_REGISTRY_PATH = os.path.join(CACHE_DIR, "assistants.sqlite3")
+assistant_registry = DiskCache(ASSISTANT_REGISTRY_PATH)
+assistant_registry_lock = threading.Lock()
+_verified_assistant_ids = set()
+
+def get_or_create_assistant(client, instructions, model, tools):
+    """
+    Return the ID of an assistant with this exact configuration, creating it only if needed.
+
+    Parameters:
+    client (openai.Client): The OpenAI client.
+    instructions (str): The assistant instructions. Keep per-query text out of these and send it in the thread message.
+    model (str): The model name.
+    tools (list): The assistant tools.
+
+    Returns:
+    str: The assistant ID.
+    """
+    key = make_cache_key("assistant", instructions, model, tools)
+    with assistant_registry_lock:
+        assistant_id = assistant_registry.get(key)
+        if assistant_id is not None and assistant_id not in _verified_assistant_ids:
+            # Make sure the stored assistant still exists on the account, once per process
+            try:
+                openai_scheduler.call("notes", "assistants", 0, client.beta.assistants.retrieve, assistant_id)
+                _verified_assistant_ids.add(assistant_id)
+            except openai.NotFoundError:
+                assistant_id = None
+        if assistant_id is None:
+            assistant_id = openai_scheduler.call("notes", "assistants", 0, client.beta.assistants.create,
+                                                 instructions=instructions, model=model, tools=tools).id
+            assistant_registry.set(key, assistant_id)
+            _verified_assistant_ids.add(assistant_id)
+            print(f"Created assistant {assistant_id}")
+        return assistant_id
+
+# The Assistants API accepts at most 10 files on a single message
+MAX_FILES_PER_MESSAGE = 10
+
+def attach_files_to_thread(client, thread_id, file_ids, stage="outline"):
+    """ Attach reference files to a thread, since shared assistants no longer carry per-run files """
+    for start in range(0, len(file_ids), MAX_FILES_PER_MESSAGE):
+        batch = file_ids[start:start + MAX_FILES_PER_MESSAGE]
+        openai_scheduler.call(stage, "assistants", 0, client.beta.threads.messages.create,
+            thread_id=thread_id,
+            role="user",
+            content=f"Reference notes files for this article: {batch}",
+            file_ids=batch
+        )
+
+# Assistant run waiting: stream run events when the SDK supports it, otherwise poll with backoff
+RUN_DEADLINE = 20 * 60  # Seconds a single run may take before it is cancelled
+RUN_POLL_MIN_DELAY = 0.5
+RUN_POLL_MAX_DELAY = 8.0
+RUN_POLL_BACKOFF = 1.5
+RUN_STREAM_IDLE_TIMEOUT = 60  # Seconds without a stream event before the run is handed to the poller
+
+class RunStatus(str, Enum):
+    """ Terminal states of an assistant run """
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+    REQUIRES_ACTION = 'requires_action'
+    INCOMPLETE = 'incomplete'
+    TIMED_OUT = 'timed_out'
+
+RUN_TERMINAL_STATES = {state.value for state in RunStatus}
+
+class RunOutcome(NamedTuple):
+    thread_id: str
+    run_id: str
+    status: RunStatus
+    last_error: object = None
+
+class RunWaiter:
+    """
+    Waits on many in-flight assistant runs from a single background thread.
+    Every tick checks only the runs that are due, each with its own exponential backoff and deadline.
+    """
+
+    def __init__(self, min_delay=RUN_POLL_MIN_DELAY, max_delay=RUN_POLL_MAX_DELAY, backoff=RUN_POLL_BACKOFF):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.thread = None
+
+    def submit(self, client, thread_id, run_id, deadline=RUN_DEADLINE):
+        """ Start tracking a run and return a Future that resolves to its RunOutcome """
+        future = concurrent.futures.Future()
+        now = time.monotonic()
+        with self.condition:
+            self.pending[(thread_id, run_id)] = {
+                'client': client,
+                'future': future,
+                'deadline': now + deadline,
+                'next_check': now + self.min_delay,
+                'delay': self.min_delay,
+            }
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name="run-waiter", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def wait(self, client, thread_id, run_id, deadline=RUN_DEADLINE):
+        return self.submit(client, thread_id, run_id, deadline).result()
+
+    def _loop(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            while True:
+                with self.condition:
+                    while not self.pending:
+                        self.condition.wait()
+                    now = time.monotonic()
+                    due = [key for key, entry in self.pending.items() if entry['next_check'] <= now]
+                    if not due:
+                        next_check = min(entry['next_check'] for entry in self.pending.values())
+                        self.condition.wait(timeout=next_check - now)
+                        continue
+                    entries = [(key, self.pending[key]) for key in due]
+                # Check every due run in one batch instead of one sleeping loop per run
+                list(executor.map(lambda item: self._check(*item), entries))
+
+    def _check(self, key, entry):
+        thread_id, run_id = key
+        client = entry['client']
+        try:
+            run = openai_scheduler.call("runs", "assistants", 0, client.beta.threads.runs.retrieve, thread_id=thread_id, run_id=run_id)
+        except Exception as e:
+            print(f"Error checking run {run_id}: {e}")
+            run = None
+
+        if run is not None and run.status in RUN_TERMINAL_STATES:
+            self._resolve(key, RunOutcome(thread_id, run_id, RunStatus(run.status), getattr(run, 'last_error', None)))
+        elif time.monotonic() >= entry['deadline']:
+            try:
+                openai_scheduler.call("runs", "assistants", 0, client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run_id)
+            except Exception as e:
+                print(f"Error cancelling run {run_id}: {e}")
+            self._resolve(key, RunOutcome(thread_id, run_id, RunStatus.TIMED_OUT))
+        else:
+            with self.condition:
+                entry['delay'] = min(entry['delay'] * self.backoff, self.max_delay)
+                entry['next_check'] = min(time.monotonic() + entry['delay'], entry['deadline'])
+
+    def _resolve(self, key, outcome):
+        with self.condition:
+            entry = self.pending.pop(key, None)
+        if entry is not None:
+            entry['future'].set_result(outcome)
+
+run_waiter = RunWaiter()
+
+def follow_run_stream(client, thread_id, stream, deadline=RUN_DEADLINE):
+    """ Follow a run's server-sent events until it reaches a terminal state """
+    started = time.monotonic()
+    run_id = None
+    try:
+        with stream:
+            for event in stream:
+                if not event.event.startswith('thread.run.') or event.event.startswith('thread.run.step'):
+                    continue
+                run_id = event.data.id
+                if event.data.status in RUN_TERMINAL_STATES:
+                    return RunOutcome(thread_id, run_id, RunStatus(event.data.status), getattr(event.data, 'last_error', None))
+                if time.monotonic() - started >= deadline:
+                    break
+    except (httpx.TimeoutException, openai.APITimeoutError):
+        # The stream stalled past its read timeout; the poller still enforces the deadline
+        print(f"Run stream for thread {thread_id} stalled, polling instead")
+    if run_id is None:
+        raise RuntimeError(f"Run stream for thread {thread_id} ended before the run was created")
+    # The stream ended early or ran past the deadline; hand the rest over to the poller
+    return run_waiter.wait(client, thread_id, run_id, max(0, deadline - (time.monotonic() - started)))
+
+def run_and_wait(client, thread_id, assistant_id, stage, model, tokens=ASSISTANT_RUN_TOKEN_ESTIMATE, deadline=RUN_DEADLINE):
+    """
+    Run an assistant on a thread and block until the run reaches a terminal state.
+
+    Parameters:
+    client (openai.Client): The OpenAI client.
+    thread_id (str): The thread to run.
+    assistant_id (str): The assistant to run it with.
+    stage (str): Pipeline stage the run is scheduled under.
+    model (str): The assistant's model, whose token budget the run uses.
+    tokens (int): Estimated tokens the run will consume.
+    deadline (int): Seconds to wait before the run is cancelled.
+
+    Returns:
+    RunOutcome: The thread ID, run ID and terminal RunStatus.
+    """
+    # Only the create request is retried; retrying the whole wait could start a second run
+    try:
+        # The read timeout bounds how long a stalled stream can block between events
+        stream = openai_scheduler.call(stage, model, tokens, client.beta.threads.runs.create, thread_id=thread_id, assistant_id=assistant_id, stream=True,
+                                       timeout=httpx.Timeout(RUN_STREAM_IDLE_TIMEOUT, read=min(RUN_STREAM_IDLE_TIMEOUT, deadline)))
+    except TypeError:
+        # This SDK version can't stream runs, fall back to the shared poller
+        stream = None
+    if stream is not None:
+        return follow_run_stream(client, thread_id, stream, deadline)
+
+    run_response = openai_scheduler.call(stage, model, tokens, client.beta.threads.runs.create, thread_id=thread_id, assistant_id=assistant_id)
+    print(f"Run created with ID: {run_response.id}")
+    return run_waiter.wait(client, thread_id, run_response.id, deadline)
 
 def sanitize_url(url):
     """Sanitize the URL to make it suitable for use in a filename."""
@@ -162,9 +1478,9 @@ def worker(file_id_link_tuple, query,status,client):
 
     sanitized_link = sanitize_url(link)
     
-    # Create an Assistant with retrieval for analyzing articles
-    assistant_id = client.beta.assistants.create(
-            instructions=f"""You are an all-knowing expert AI researcher information extractor. You are compiling as much useful information and as many facts as you can for an article you are writing about {query}
+    # Reuse the shared note-taking assistant with retrieval for analyzing articles
+    assistant_id = get_or_create_assistant(client,
+            instructions="""You are an all-knowing expert AI researcher information extractor. You are compiling as much useful information and as many facts as you can for an article you are writing about the topic given in the user's message.
             You always cite your sources by referencing the URL where the info was found as the source.
             Analyze articles and provide insights using the charting method.Write at least 6000 words.
             Be exceptionally detailed, thorough, are extremely well organized and hierarchical in your organization.
@@ -268,12 +1584,9 @@ def worker(file_id_link_tuple, query,status,client):
             Stop and print the entire set of notes when you are satisfied you have fully extracted all relevant info for the query.""",
             model="gpt-3.5-turbo-1106",
             tools=[{"type": "retrieval"}]
-        ).id
-    thread_id = client.beta.threads.create().id
-    client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=f"""Please analyze the file with ID {file_id} and extract ALL possible salient facts and information.
+        )
+    message = f"""The article you are researching is about: {query}
+                  Please analyze the file with ID {file_id} and extract ALL possible salient facts and information.
                   At the beginning always start with:
                   ###
                   Topic/Subject: [Main Topic or Subject Name]
@@ -284,60 +1597,330 @@ def worker(file_id_link_tuple, query,status,client):
                   ###
                   The total length of the information extracted should be at least 6000 words long. Always include at least one generated data table, even if it is simple.
                   Also, whenever possible extract authoritative quotes which can be used to later. Never say anything like -i will now begin taking notes-, just start taking notes. You should always start your response with:
-                  Full Notes:""",
-        file_ids=[file_id]
-    )
-    print(f"Created message for file ID {file_id} in thread {thread_id}")
+                  Full Notes:"""
 
-    run_response = client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=assistant_id
-    )
-    print(f"Run created with ID: {run_response.id}")
+    def take_notes():
+        thread_id = openai_scheduler.call("notes", "assistants", 0, client.beta.threads.create).id
+        openai_scheduler.call("notes", "assistants", 0, client.beta.threads.messages.create,
+            thread_id=thread_id,
+            role="user",
+            content=message,
+            file_ids=[file_id]
+        )
+        print(f"Created message for file ID {file_id} in thread {thread_id}")
 
-    while True:
-        run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_response.id).status
-        if run_status in ['queued', 'in_progress']:
-            time.sleep(1)
-            continue
-        if run_status in ['completed', 'failed', 'requires_action']:
-            break
+        outcome = run_and_wait(client, thread_id, assistant_id, "notes", "gpt-3.5-turbo-1106")
+        print(f"Run {outcome.run_id} finished with status: {outcome.status.value}")
+        if outcome.status != RunStatus.COMPLETED:
+            return None
+
+        response = openai_scheduler.call("notes", "assistants", 0, client.beta.threads.messages.list, thread_id=thread_id)
+        if len(response.data) > 0 and response.data[0].role == "assistant":
+            return response.data[0].content[0].text.value
+        return None
 
-    response = client.beta.threads.messages.list(thread_id=thread_id)
-    if len(response.data) > 0 and response.data[0].role == "assistant":
-        article_message_content = response.data[0].content[0].text.value
+    article_message_content = llm_cache.cached('assistant', {'assistant_id': assistant_id, 'model': "gpt-3.5-turbo-1106", 'content': message, 'file_ids': [file_id]}, take_notes)
+    if article_message_content is not None:
         word_count = len(article_message_content.split())
 
         if word_count >= 300:
-            note_file_path = f'final_outline_{sanitized_link}.txt'
-            with open(note_file_path, 'w', encoding='utf-8') as file: 
-                file.write(article_message_content)
-
-            with open(note_file_path, 'rb') as file:
-                response = client.files.create(file=file, purpose='assistants')
-                individual_file_id = response.id
+            note_file_name = safe_filename(f'final_outline_{sanitized_link}') + '.txt'
+            individual_file_id = upload_bytes(client, article_message_content.encode('utf-8'), note_file_name)
 
             return {"file_id": file_id, "note": article_message_content, "individual_file_id": individual_file_id}
             
     return None
     
-def analyze_articles(file_ids, query, status, client):
+# Local BM25 retrieval over the extracted notes, so prompts carry only the relevant chunks
+NOTES_CHUNK_WORDS = 200
+NOTES_TOP_K = 16
+BM25_K1 = 1.5
+BM25_B = 0.75
+OUTLINE_SOURCE_BOOST = 1.5  # Score multiplier for chunks from sources the outline assigns to a section
+NOTE_SOURCE_PATTERN = re.compile(r'(?:Article Source URL[^:\n]*|Article URL|Source):\s*\**\s*(https?://\S+)', re.IGNORECASE)
+SEARCH_STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it', 'its', 'of',
+    'on', 'or', 'that', 'the', 'this', 'to', 'was', 'were', 'will', 'with', 'fact', 'info', 'source', 'url',
+}
+
+def search_terms(text):
+    return [term for term in re.findall(r'\w+', text.lower()) if term not in SEARCH_STOPWORDS]
+
+def chunk_note(note, chunk_words=NOTES_CHUNK_WORDS):
+    """ Split a note into chunks of about `chunk_words` words along line boundaries """
+    chunks, current, count = [], [], 0
+    for line in note.splitlines():
+        words = len(line.split())
+        if current and count + words > chunk_words:
+            chunks.append('\n'.join(current))
+            current, count = [], 0
+        if words:
+            current.append(line)
+            count += words
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+class NotesIndex:
+    """
+    In-process BM25 index over note chunks. Notes can be added one at a time as worker results arrive;
+    postings are kept per term and turned into NumPy arrays lazily for scoring.
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.chunks = []
+        self.sources = []
+        self.lengths = []
+        self.postings = {}  # term -> ([chunk ids], [term frequencies])
+        self.arrays = {}  # term -> (chunk id array, tf array), rebuilt after new chunks land
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Run checkpoints pickle the index; the lock can't be, and the arrays are rebuilt on demand
+        state = self.__dict__.copy()
+        del state['lock']
+        state['arrays'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add_note(self, note, source=None):
+        """ Chunk a note and add it to the index """
+        # Pass source='' for text that carries its own citations
+        if source is None:
+            match = NOTE_SOURCE_PATTERN.search(note) or SOURCE_URL_PATTERN.search(note)
+            source = (match.group(1) if match.groups() else match.group(0)).rstrip('.,)*') if match else None
+        with self.lock:
+            for chunk in chunk_note(note):
+                terms = search_terms(chunk)
+                if not terms:
+                    continue
+                chunk_id = len(self.chunks)
+                self.chunks.append(chunk)
+                self.sources.append(source)
+                self.lengths.append(len(terms))
+                counts = {}
+                for term in terms:
+                    counts[term] = counts.get(term, 0) + 1
+                for term, count in counts.items():
+                    ids, tfs = self.postings.setdefault(term, ([], []))
+                    ids.append(chunk_id)
+                    tfs.append(count)
+                    self.arrays.pop(term, None)
+
+    def search(self, query, k=NOTES_TOP_K, sources=None):
+        """
+        Return the top `k` chunks for a query as (score, chunk, source) tuples, best first.
+        Chunks from `sources` get their score multiplied by OUTLINE_SOURCE_BOOST.
+        """
+        with self.lock:
+            if not self.chunks:
+                return []
+            lengths = np.asarray(self.lengths, dtype=np.float64)
+            norm = self.k1 * (1 - self.b + self.b * lengths / lengths.mean())
+            scores = np.zeros(len(self.chunks))
+            for term in set(search_terms(query)):
+                if term not in self.postings:
+                    continue
+                if term not in self.arrays:
+                    ids, tfs = self.postings[term]
+                    self.arrays[term] = (np.asarray(ids), np.asarray(tfs, dtype=np.float64))
+                ids, tfs = self.arrays[term]
+                idf = np.log(1 + (len(self.chunks) - len(ids) + 0.5) / (len(ids) + 0.5))
+                scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm[ids])
+            if sources:
+                boosted = np.array([source in sources for source in self.sources])
+                scores[boosted] *= OUTLINE_SOURCE_BOOST
+            k = min(k, int(np.count_nonzero(scores)))
+            if k == 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(float(scores[i]), self.chunks[i], self.sources[i]) for i in top]
+
+def format_note_chunks(results):
+    """ Render retrieved chunks with their source URLs for a prompt """
+    return '\n\n'.join(f"[Source: {source}]\n{chunk}" if source else chunk for _, chunk, source in results)
+
+ANALYZE_WORKERS = 16
+
+def analyze_articles(file_ids, query, status, client, notes_index=None, done=None, on_result=None):
     notes = []
     individual_file_ids = []
+    done = done or {}
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(worker,file_id_link_tuple, query, status, client) for file_id_link_tuple in file_ids]
+    def analyze(file_id_link_tuple):
+        # Articles a previous attempt already took notes on are not sent to the assistant again
+        if file_id_link_tuple[0] in done:
+            return done[file_id_link_tuple[0]]
+        result = worker(file_id_link_tuple, query, status, client)
+        if result is not None and on_result is not None:
+            on_result(file_id_link_tuple[0], result)
+        return result
+
+    # The scheduler paces the actual OpenAI traffic; this only bounds the number of threads.
+    # file_ids may be a Channel, in which case each run starts as soon as its upload lands.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ANALYZE_WORKERS) as executor:
+        futures = [executor.submit(analyze, file_id_link_tuple) for file_id_link_tuple in file_ids]
 
         for future in concurrent.futures.as_completed(futures):
             result = future.result()
             if result is not None:
                 notes.append(result["note"])
                 individual_file_ids.append(result["individual_file_id"])
+                # Index each note as soon as it lands instead of after the whole batch
+                if notes_index is not None:
+                    notes_index.add_note(result["note"])
 
     df_notes = pd.DataFrame({'Note': notes})
 
     return df_notes, individual_file_ids, df_notes
     
+# Fact-level compaction of the notes: near-identical facts from different sources are merged
+FACT_SHINGLE_SIZE = 2
+FACT_DUPLICATE_THRESHOLD = 0.7
+FACT_CATEGORY_PATTERN = re.compile(r'^\s*(?:#+\s*)?\**\s*((?:Sub-?)*Category)\s*[\d.]*\s*\**\s*:\s*\**\s*(.+?)\**\s*$', re.IGNORECASE)
+DATA_TABLE_PATTERN = re.compile(r'^\s*(?:#+\s*)?\**\s*Data Table\s*\d*', re.IGNORECASE)
+FACT_LINE_PATTERN = re.compile(r'^\s*(?:[-*]\s*)?\**\s*(?:Fact/Info|Fact|Info|Insight)\s*\d*\s*\**\s*:\s*(.+)$', re.IGNORECASE)
+FACT_SOURCE_SUFFIX_PATTERN = re.compile(r'\s*[-(]*\s*(?:http or https URL of )?Source\s*\d*\s*:?.*$', re.IGNORECASE)
+NOTE_HEADER_PATTERN = re.compile(r'^\s*(?:#+\s*)?\**\s*(?:Topic|Subject|Article Title|Title|Article Source URL|Article URL|Source|Authors?|Date)\b[^:\n]{0,20}:', re.IGNORECASE)
+
+class FactRecord(NamedTuple):
+    category: str
+    fact: str
+    source: str
+
+def parse_note_facts(note):
+    """ Parse one source's notes into FactRecords of (category, fact, source URL) """
+    match = NOTE_SOURCE_PATTERN.search(note)
+    note_source = match.group(1).rstrip('.,)*') if match else ''
+    category = 'General'
+    records = []
+    for line in note.splitlines():
+        category_match = FACT_CATEGORY_PATTERN.match(line)
+        if category_match:
+            category = category_match.group(2).strip()
+            continue
+        fact_match = FACT_LINE_PATTERN.match(line)
+        if not fact_match:
+            continue
+        fact = fact_match.group(1)
+        urls = [url.rstrip('.,)*') for url in SOURCE_URL_PATTERN.findall(fact)]
+        fact = SOURCE_URL_PATTERN.sub('', fact)
+        fact = FACT_SOURCE_SUFFIX_PATTERN.sub('', fact).strip(' -*[]()')
+        if len(fact.split()) >= 3:
+            records.append(FactRecord(category, fact, urls[0] if urls else note_source))
+    return records
+
+def parse_note_tables(note):
+    """ The generated data tables in one source's notes, which are kept verbatim """
+    match = NOTE_SOURCE_PATTERN.search(note)
+    note_source = match.group(1).rstrip('.,)*') if match else ''
+    tables, current = [], None
+    for line in note.splitlines():
+        if DATA_TABLE_PATTERN.match(line):
+            if current:
+                tables.append('\n'.join(current))
+            current = [line.strip()]
+        elif current is not None:
+            if not line.strip():
+                if len(current) > 1:
+                    tables.append('\n'.join(current))
+                current = None
+            else:
+                current.append(line.rstrip())
+    if current and len(current) > 1:
+        tables.append('\n'.join(current))
+    return [f"{table}\n(Source: {note_source})" if note_source else table for table in tables]
+
+def parse_note_leftovers(note):
+    """
+    The lines of one source's notes that aren't facts, categories, tables or header fields, like free-form
+    bullets and quotes, each tagged with the source URL so its citation survives compaction
+    """
+    match = NOTE_SOURCE_PATTERN.search(note)
+    note_source = match.group(1).rstrip('.,)*') if match else ''
+    leftovers = []
+    in_table = False
+    for line in note.splitlines():
+        if DATA_TABLE_PATTERN.match(line):
+            in_table = True
+            continue
+        if not line.strip():
+            in_table = False
+            continue
+        if in_table or FACT_CATEGORY_PATTERN.match(line) or FACT_LINE_PATTERN.match(line) or NOTE_HEADER_PATTERN.match(line):
+            continue
+        text = line.strip()
+        if len(text.split()) < 3:
+            continue
+        leftovers.append(f"{text} (Source: {note_source})" if note_source and not SOURCE_URL_PATTERN.search(text) else text)
+    return leftovers
+
+def compact_notes(notes):
+    """
+    Merge near-identical facts across all notes, keeping every supporting source.
+
+    Parameters:
+    notes (list): The notes from analyze_articles, one per source.
+
+    Returns:
+    tuple: (DataFrame with Category, Fact and Sources columns, compacted corpus text grouped by category)
+    """
+    records, leftovers = [], []
+    for note in notes:
+        note_records = parse_note_facts(note)
+        if not note_records:
+            match = NOTE_SOURCE_PATTERN.search(note)
+            print(f"No facts parsed from the notes for {match.group(1) if match else 'a source'}, keeping them as written")
+        records.extend(note_records)
+        # Whatever didn't parse as a fact is kept as written, so free-form notes and their citations aren't lost
+        note_leftovers = parse_note_leftovers(note)
+        if note_leftovers:
+            leftovers.append('\n'.join(note_leftovers))
+    tables = [table for note in notes for table in parse_note_tables(note)]
+    if not (records or leftovers or tables):
+        return pd.DataFrame(columns=['Category', 'Fact', 'Sources']), ''
+
+    exact_keys = [re.sub(r'\W+', ' ', record.fact.lower()).strip() for record in records]
+    clusters = find_duplicate_clusters([record.fact for record in records], FACT_DUPLICATE_THRESHOLD,
+                                       keys=exact_keys, shingle_size=FACT_SHINGLE_SIZE) if records else []
+    grouped = {}
+    for record, cluster in zip(records, clusters):
+        grouped.setdefault(cluster, []).append(record)
+
+    rows = []
+    for cluster in sorted(grouped):
+        members = grouped[cluster]
+        # The most detailed wording represents the cluster; every source that supports it is kept
+        best = max(members, key=lambda record: len(record.fact))
+        sources = list(dict.fromkeys(record.source for record in members if record.source))
+        rows.append((members[0].category, best.fact, sources))
+    facts_df = pd.DataFrame(rows, columns=['Category', 'Fact', 'Sources'])
+
+    blocks = []
+    for category, group in facts_df.groupby('Category', sort=False):
+        lines = [f"Category: {category}"]
+        for fact, sources in zip(group['Fact'], group['Sources']):
+            lines.append(f"- {fact} (Sources: {', '.join(sources)})" if sources else f"- {fact}")
+        blocks.append('\n'.join(lines))
+    print(f"Compacted {len(records)} facts into {len(facts_df)}")
+    return facts_df, '\n\n'.join(blocks + leftovers + tables)
+
+def build_facts_index(compact_corpus):
+    """ Notes index over the compacted corpus; each fact line carries its own sources """
+    notes_index = NotesIndex()
+    for block in compact_corpus.split('\n\n'):
+        notes_index.add_note(block, source='')
+    return notes_index
+
 def convert_df_to_csv_bytes(df):
     # Convert DataFrame to CSV and encode to bytes
     return df.to_csv(index=False).encode('utf-8')
@@ -352,703 +1935,2555 @@ def save_bytes_to_file(bytes_data, file_name):
     with open(file_name, 'wb') as file:
         file.write(bytes_data)    
 
-def fix_markdown(text):
-    # Replace \\n with proper line breaks (\n)
-    text = re.sub(r'\\n', '\n', text)
+# Export bundles are built in memory and spill to a temporary file once they pass this size
+EXPORT_SPOOL_BYTES = 50_000_000
+EXPORT_CSV_ROWS_PER_CHUNK = 200
+EXPORT_CHUNK_BYTES = 1 << 16
+IMAGE_TAG_PATTERN = re.compile(r'<img src="([^"]+)"')
 
-    # Remove extra newlines at the beginning and end of paragraphs
-    text = re.sub(r'\n\n+', '\n\n', text)
+def iter_csv_chunks(df, rows_per_chunk=EXPORT_CSV_ROWS_PER_CHUNK):
+    """ Yield a DataFrame as CSV a few rows at a time """
+    if df.empty:
+        yield df.to_csv(index=False)
+        return
+    for start in range(0, len(df), rows_per_chunk):
+        yield df.iloc[start:start + rows_per_chunk].to_csv(index=False, header=start == 0)
 
-    # Split sections using ", " and format them
-    sections = re.split(r'", "', text)
-    formatted_sections = []
+def iter_file_chunks(path, chunk_bytes=EXPORT_CHUNK_BYTES):
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_bytes):
+            yield chunk
+
+def iter_url_chunks(url, chunk_bytes=EXPORT_CHUNK_BYTES, timeout=FETCH_TIMEOUT):
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        yield from response.iter_content(chunk_bytes)
+
+class ExportBuilder:
+    """
+    Streams artifacts straight into a ZIP archive, with no intermediate files in the working directory.
+    The archive lives in memory until it passes `max_memory` bytes, then spills to a temporary file.
+    """
+
+    def __init__(self, max_memory=EXPORT_SPOOL_BYTES):
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self.zip = zipfile.ZipFile(self.buffer, 'w', zipfile.ZIP_DEFLATED)
+
+    def add_text(self, name, text):
+        self.zip.writestr(name, text)
+
+    def add_chunks(self, name, chunks, compress=True):
+        """ Write an entry from an iterable of str or bytes chunks """
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with self.zip.open(info, 'w') as entry:
+            for chunk in chunks:
+                entry.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+
+    def finish(self):
+        """ Close the archive and return the spooled file positioned at the start; the caller closes it """
+        self.zip.close()
+        self.buffer.seek(0)
+        return self.buffer
+
+def build_export_bundle(outline, article_path, full_notes, df_outline, articles=None, compact_corpus=''):
+    """
+    Build the results ZIP: the outlines, the article, the notes, the scraped articles and the generated images.
+
+    Returns:
+    tempfile.SpooledTemporaryFile: The finished archive, in memory or on disk depending on its size.
+    """
+    export = ExportBuilder()
+    export.add_text('Final_Outline.txt', str(outline))
+    export.add_chunks('Final_Article.txt', iter_file_chunks(article_path))
+    export.add_chunks('Full_Notes.csv', iter_csv_chunks(full_notes))
+    export.add_chunks('All_Outlines.csv', iter_csv_chunks(df_outline))
+    if compact_corpus:
+        export.add_text('Compacted_Notes.txt', compact_corpus)
+
+    for index, note in enumerate(full_notes['Note'] if 'Note' in full_notes else []):
+        export.add_text(f'Notes/{index + 1:02d}.md', note)
+
+    if articles is not None:
+        for index, row in articles.iterrows():
+            article_content = '\n'.join(f'{key}: {value}' for key, value in row.items())
+            export.add_text(f'Articles/{index + 1:02d}_{safe_filename(row["Title"])[:80]}.txt', article_content)
+
+    # Generated image URLs expire, so the images themselves go into the bundle
+    with open(article_path, encoding='utf-8') as file:
+        image_urls = list(dict.fromkeys(url for line in file for url in IMAGE_TAG_PATTERN.findall(line)))
+    for index, url in enumerate(image_urls):
+        try:
+            # Pull the first chunk before opening the entry so a failed download leaves no empty file
+            chunks = iter_url_chunks(url)
+            first_chunk = next(chunks, b'')
+            export.add_chunks(f'Images/image_{index + 1:02d}.png', itertools.chain([first_chunk], chunks), compress=False)
+        except Exception as e:
+            print(f"Couldn't add image {url} to the export: {e}")
+
+    return export.finish()
+
+# Article clean-up patterns, compiled once
+ESCAPED_NEWLINE_PATTERN = re.compile(r'\\n')
+EXTRA_NEWLINES_PATTERN = re.compile(r'\n\n+')
+LIST_SEPARATOR_PATTERN = re.compile(r'", "')
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n\n')
+NEXT_SECTION_PATTERN = re.compile(r'\[Next Section to Write:[^\]]+\]')
+
+def fix_markdown(text):
+    # Replace \\n with proper line breaks (\n)
+    text = ESCAPED_NEWLINE_PATTERN.sub('\n', text)
+
+    # Remove extra newlines at the beginning and end of paragraphs
+    text = EXTRA_NEWLINES_PATTERN.sub('\n\n', text)
+
+    # Split sections using ", " and format them
+    sections = LIST_SEPARATOR_PATTERN.split(text)
+    formatted_sections = []
     for section in sections:
-        formatted_section = re.sub(r'\n\n', '\n', section.strip())
+        formatted_section = PARAGRAPH_BREAK_PATTERN.sub('\n', section.strip())
         formatted_sections.append(formatted_section)
 
     return '\n\n'.join(formatted_sections)
 
 
 def remove_sections_within_brackets(text):
-    # Define a regular expression pattern to match text within square brackets
-    pattern = r'\[Next Section to Write:[^\]]+\]'
+    # Remove the [Next Section to Write: ...] markers
+    return NEXT_SECTION_PATTERN.sub('', text)
 
-    # Use re.sub to replace all matches with an empty string
-    cleaned_text = re.sub(pattern, '', text)
+def clean_section(text):
+    """ Apply the final article clean-up to a single section """
+    return remove_sections_within_brackets(fix_markdown(text))
 
-    return cleaned_text
+ARTICLE_TEMP_PREFIX = 'article_'
 
-def query_assistant(prompt,type_of_writer,style):
-    response = client.chat.completions.create(
-        model="gpt-4-1106-preview",
-        messages=[
+class ArticleAssembler:
+    """
+    Builds the final article on disk as sections arrive. Each section is cleaned on its own and
+    appended as soon as every section before it is in, so the article is complete when the last one lands.
+    """
+
+    def __init__(self, path=None):
+        self.temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix=ARTICLE_TEMP_PREFIX, suffix='.md')
+            os.close(fd)
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.ready = {}
+        self.next_position = 0
+        self.lock = threading.Lock()
+
+    def add(self, position, text):
+        """ Mark the section at `position` final; it is written once all earlier sections are """
+        with self.lock:
+            self.ready[position] = clean_section(text)
+            while self.next_position in self.ready:
+                section = self.ready.pop(self.next_position)
+                if section:
+                    if self.file.tell() > 0:
+                        self.file.write('\n\n')
+                    self.file.write(section)
+                self.next_position += 1
+            self.file.flush()
+
+    def finish(self):
+        """ Close the file and return its path; the article is read from there, never held in memory whole """
+        with self.lock:
+            if self.ready:
+                print(f"Article assembled with sections missing before {sorted(self.ready)}")
+            self.file.close()
+        return self.path
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def discard(self):
+        """ Close the file and, if it is temporary, delete it """
+        self.close()
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # A run that fails while writing leaves no temporary article behind
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+
+def remove_temporary_article(path):
+    """ Delete an article ArticleAssembler wrote to a temporary file; checkpointed articles are kept """
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(tempfile.gettempdir()) \
+            and os.path.basename(path).startswith(ARTICLE_TEMP_PREFIX) and os.path.exists(path):
+        os.remove(path)
+
+# Seconds between re-renders of a streaming section
+STREAM_RENDER_INTERVAL = 0.25
+
+def writer_messages(prompt,type_of_writer,style):
+    # The prompt is either a single user message or a list of role-structured messages
+    conversation = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+    return [
         {"role": "system", "content": f"You are an award winning {type_of_writer} that iteratively writes articles based on your outline and notes by writing in beautiful and well organized markdown. Your voice/style is: {style} .  You work step by step and never write the same section twice. If you are given a specific section to work on, please only do that section. When all sections are complete return - Article Complete -."},
-        {"role": "user", "content": prompt}
-        ],
+        *conversation
+        ]
+
+def stream_assistant(prompt,type_of_writer,style):
+    """ Streaming version of query_assistant that yields text deltas as they arrive """
+    messages = writer_messages(prompt, type_of_writer, style)
+    stream = openai_scheduler.call("writing", "gpt-4-1106-preview", estimate_chat_tokens(messages, 4000),
+        client.chat.completions.create,
+        model="gpt-4-1106-preview",
+        messages=messages,
         max_tokens=4000,
-        temperature = 0.2
+        temperature = 0.2,
+        stream=True
     )
-    return response.choices[0].message.content
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
 
-def generate_images_from_placeholders(document):
-    # Find all placeholders
-    placeholders = re.findall(r'\[Insert Image Here: ([^\]]+)\]', document, re.DOTALL)
-    print(len(placeholders))
-    replacements = {}
+def query_assistant(prompt,type_of_writer,style,on_delta=None):
+    """
+    Ask the writer model for the next part of the article.
+
+    Parameters:
+    prompt (str or list): A user prompt or a list of role-structured messages.
+    on_delta (callable): Optional. Streams the response and is called with the text so far as it grows.
+
+    Returns:
+    str: The full response text.
+    """
+    messages = writer_messages(prompt, type_of_writer, style)
+    request = dict(model="gpt-4-1106-preview", messages=messages, max_tokens=4000, temperature=0.2)
+    if on_delta is None:
+        return cached_chat_completion("writing", estimate_chat_tokens(messages, 4000), **request)
+
+    # Streamed responses are cached too; a cached one arrives as a single delta
+    text = llm_cache.lookup('chat', request)
+    if text is not None:
+        on_delta(text)
+        return text
+    text = ''
+    for delta in stream_assistant(prompt, type_of_writer, style):
+        text += delta
+        on_delta(text)
+    llm_cache.record('chat', request, text)
+    return text
+
+def render_stream(slot, interval=STREAM_RENDER_INTERVAL):
+    """ on_delta callback that re-renders a Streamlit placeholder at most every `interval` seconds """
+    last_render = [0.0]
+
+    def render(text):
+        now = time.monotonic()
+        if now - last_render[0] >= interval:
+            slot.markdown(text + " ▌", unsafe_allow_html=True)
+            last_render[0] = now
+    return render
+
+# Token budget for the section-writing context (the model's window minus the completion allowance)
+WRITING_CONTEXT_TOKENS = 60_000
+WRITING_CONTEXT_WINDOW = 2  # Most recent sections that are sent back in full
+WRITING_SUMMARY_TOKENS = 2_000
+
+def truncate_to_tokens(text, tokens):
+    """ Cut text down to roughly `tokens` tokens """
+    max_chars = max(0, tokens) * 4
+    return text if len(text) <= max_chars else text[:max_chars] + "\n[...truncated]"
+
+def summarize_section(section):
+    """ Compact, extractive summary of a written section: its headings and their opening sentences """
+    lines = []
+    section_lines = [line.strip() for line in section.splitlines() if line.strip()]
+    for position, line in enumerate(section_lines):
+        if line.startswith('#'):
+            summary = line.lstrip('#').strip()
+            following = next((text for text in section_lines[position + 1:] if not text.startswith(('#', '[', '|', '<'))), '')
+            if following:
+                summary += ': ' + re.split(r'(?<=[.!?])\s', following, maxsplit=1)[0][:200]
+            lines.append('- ' + summary)
+    if not lines:
+        lines.append('- ' + section.strip()[:200])
+    return '\n'.join(lines)
+
+class ArticleContext:
+    """
+    Role-structured context for the section-writing loop. Sends the instructions and outline, the notes,
+    a compact summary of older sections and the most recent sections in full, within a token budget.
+    """
+
+    def __init__(self, instructions, notes='', token_budget=WRITING_CONTEXT_TOKENS, window=WRITING_CONTEXT_WINDOW):
+        self.instructions = instructions
+        self.notes = notes
+        self.token_budget = token_budget
+        self.window = window
+        self.exchanges = []  # (instruction, section) pairs still sent in full
+        self.summary = []  # Summaries of sections that fell out of the window
+        self.pending = None
+
+    def ask(self, instruction):
+        """ Set the instruction for the next request """
+        self.pending = instruction
+
+    def add_section(self, section):
+        """ Record the section the model wrote for the pending instruction """
+        self.exchanges.append((self.pending, section))
+        self.pending = None
+        while len(self.exchanges) > self.window:
+            _, oldest = self.exchanges.pop(0)
+            self.summary.append(summarize_section(oldest))
+
+    def messages(self):
+        """ Build the message list for the next request, dropping older material first to stay in budget """
+        messages = [{"role": "user", "content": self.instructions}]
+        remaining = self.token_budget - estimate_tokens(self.instructions) - estimate_tokens(self.pending or '')
+
+        summary = ''
+        if self.summary:
+            summary = "Sections already written (summarized):\n" + '\n'.join(self.summary)
+            if estimate_tokens(summary) > WRITING_SUMMARY_TOKENS:
+                summary = "Sections already written (summarized, most recent):\n" + '\n'.join(self.summary)[-WRITING_SUMMARY_TOKENS * 4:]
+            remaining -= estimate_tokens(summary)
+
+        # Keep room for the latest section, then give the notes whatever is left
+        newest = sum(estimate_tokens(text or '') for text in self.exchanges[-1]) if self.exchanges else 0
+        if self.notes:
+            # 50 tokens of slack for the wrapper text around the notes
+            notes = truncate_to_tokens(self.notes, min(estimate_tokens(self.notes), remaining - newest - 50))
+            notes_message = f"Here is the notes corpus to leverage to write as complete and comprehensive an article as possible.\nNotes: #### {notes} ####"
+            messages.append({"role": "user", "content": notes_message})
+            remaining -= estimate_tokens(notes_message)
+        if summary:
+            messages.append({"role": "user", "content": summary})
+
+        recent = []
+        for instruction, section in reversed(self.exchanges):
+            cost = estimate_tokens(instruction or '') + estimate_tokens(section)
+            if recent and cost > remaining:
+                break
+            recent.insert(0, (instruction, section))
+            remaining -= cost
+        for instruction, section in recent:
+            if instruction:
+                messages.append({"role": "user", "content": instruction})
+            messages.append({"role": "assistant", "content": section})
 
-    for description in placeholders:
-        print(description)
+        if self.pending:
+            messages.append({"role": "user", "content": self.pending})
+        return messages
+
+# Outline-driven writing: top level outline sections are written concurrently and stitched in order
+SECTION_WORKERS = 6
+SECTION_ATTEMPTS = 2  # Requests per section in each round
+SECTION_ROUNDS = 2  # Sections that failed are requested again once the others are written
+MIN_PARALLEL_SECTIONS = 2  # Outlines with fewer top level sections use the sequential writing loop
+OUTLINE_HEADING_PATTERN = re.compile(r'^\s{0,3}(#{1,6})\s+(.*?)\s*#*\s*$')
+OUTLINE_NUMBERED_PATTERN = re.compile(r'^((?:\d+|[IVXLC]+)\.)\s+(.*\S)\s*$')
+SOURCE_URL_PATTERN = re.compile(r'https?://[^\s\]\)\(\[,"\'<>]+')
+ARTICLE_COMPLETE_PATTERN = re.compile(r'-?\s*Article Complete\s*-?')
+PARAGRAPH_SPLIT_PATTERN = re.compile(r'\n\s*\n')
+NON_WORD_PATTERN = re.compile(r'\W+')
+
+class OutlineSection:
+    """ A node of the parsed outline: a heading, the outline text directly under it and its subsections """
+
+    def __init__(self, title, level, text=''):
+        self.title = title
+        self.level = level
+        self.text = text
+        self.children = []
+
+    def subtree_text(self):
+        return '\n'.join([self.text] + [child.subtree_text() for child in self.children])
+
+    def sources(self):
+        """ Source URLs the outline lists for this section """
+        return list(dict.fromkeys(url.rstrip('.') for url in SOURCE_URL_PATTERN.findall(self.subtree_text())))
+
+def parse_outline(outline):
+    """ Parse a markdown outline into a tree of OutlineSection nodes and return the root """
+    lines = outline.splitlines()
+    headings = []
+    for line_number, line in enumerate(lines):
+        match = OUTLINE_HEADING_PATTERN.match(line)
+        if match:
+            headings.append((line_number, len(match.group(1)), match.group(2).strip('*_ ')))
+    if not headings:
+        # Outlines without markdown headings usually number their top level sections
+        for line_number, line in enumerate(lines):
+            match = OUTLINE_NUMBERED_PATTERN.match(line)
+            if match:
+                headings.append((line_number, 1, line.strip().strip('*_ ')))
+
+    root = OutlineSection('', 0, '\n'.join(lines[:headings[0][0]]) if headings else outline)
+    stack = [root]
+    for position, (line_number, level, title) in enumerate(headings):
+        end = headings[position + 1][0] if position + 1 < len(headings) else len(lines)
+        node = OutlineSection(title, level, '\n'.join(lines[line_number:end]))
+        while stack[-1].level >= level:
+            stack.pop()
+        stack[-1].children.append(node)
+        stack.append(node)
+    return root
+
+def outline_top_sections(outline):
+    """ The sections of the outline that are written independently """
+    sections = parse_outline(outline).children
+    # A lone top level heading is the article title; its children are the real sections
+    while len(sections) == 1 and sections[0].children:
+        sections = sections[0].children
+    return sections
+
+def build_table_of_contents(sections, max_depth=3):
+    """ Markdown table of contents mirroring the outline tree """
+    lines = ["## Table of Contents"]
+
+    def add(section, depth):
+        lines.append(f"{'  ' * depth}- {section.title}")
+        if depth + 1 < max_depth:
+            for child in section.children:
+                add(child, depth + 1)
+
+    for section in sections:
+        add(section, 0)
+    return '\n'.join(lines)
+
+def select_section_notes(section, notes_index, k=NOTES_TOP_K):
+    """ The note chunks most relevant to a section, favouring the sources the outline assigns to it """
+    return format_note_chunks(notes_index.search(section.subtree_text(), k, set(section.sources())))
+
+def write_section(section, outline, notes, type_of_writer, style, on_delta=None):
+    """ Write one top level section of the article from its part of the outline and its notes """
+    instructions = f"""You will be writing ONE section of a long-form article based on an outline and a notes corpus. Other writers are writing the other sections at the same time, so only write the section you are given, including all of its subsections and sub-subsections.
+    Start the section with its heading exactly as it appears in the outline: {section.title}
+    While following the outline, draw extensively on your notes corpus. The notes contains many sections, each related to a specific source.
+    When citing a source, always reference a specific url from the notes corpus.
+    The citation should be inline and use the format: [URL Title from the notes,URL from the notes always starting with http or https].
+    You never write generically or with generalizations, you always attempt to use specific facts, data, etc. You also like to include markdown tables from data found in the notes where you think the table will add value and ease of reading for the reader.
+    The section is at least 2000 words. Use Headings, Subheadings, Sub-SubHeadings etc in beautiful markdown styling. Also make use of markdown lists, blockquotes, and other ways to make the content more readable, interesting, and useful.
+    At the beginning of the section, make a detailed recommendation for an image to include. This image should be a simplistic representation of the section.
+    It should NEVER include instructions for including text or be super complex. Provide these instructions like this: [Insert Image Here: The Image Description] .
+    Never cite references like this [[1†source]]. Always use the actual http or https url. Use as many relevant sources as possible.
+    Do not write a table of contents, an introduction to the whole article, a bibliography, or - Article Complete -.
+    Here is the full outline of the article, for context: #### {outline} ####.
+    The notes corpus to leverage follows in the next message."""
+    context = ArticleContext(instructions, notes)
+    context.ask(f"Please write the section: {section.title}\nHere is the outline of this section to follow: #### {section.subtree_text()} ####\nPlease take your time, think step by step, and return the full section.\nSection:")
+    return query_assistant(context.messages(), type_of_writer, style, on_delta)
+
+def write_section_with_retries(section, outline, notes, type_of_writer, style, on_delta=None, attempts=SECTION_ATTEMPTS):
+    """ write_section with retries, returning None if every attempt failed """
+    for attempt in range(1, attempts + 1):
         try:
-            # Generate an image
-            response = client.images.generate(
-                model="dall-e-3",
-                prompt=f"You will be given an image {description} but done in a very simple way, using metaphor if needed. Avoid including text.",
-                size="1792x1024",
-                quality="hd",
-                n=1,
-            )
-            image_url = response.data[0].url
-            replacements[f'[Insert Image Here: {description}]'] = f'<img src="{image_url}" width="800"/>'
+            return write_section(section, outline, notes, type_of_writer, style, on_delta)
         except Exception as e:
-            print(f"Error generating image for {description}: {e}")
+            print(f"Writing section {section.title!r} failed (attempt {attempt} of {attempts}): {e}")
+    return None
+
+def write_sections_concurrently(sections, outline, notes, type_of_writer, style, max_workers=SECTION_WORKERS, on_delta=None, on_tick=None, done=None, rounds=SECTION_ROUNDS):
+    """
+    Write every section at once.
+
+    Parameters:
+    sections (list): OutlineSection nodes to write.
+    outline (str): The full outline, given to every writer for context.
+    notes (NotesIndex): The notes index each section retrieves its notes from.
+    on_delta (callable): Optional. Streams the sections; called from the writer threads with (position, text so far).
+    on_tick (callable): Optional. Called on the calling thread every STREAM_RENDER_INTERVAL while sections are in flight.
+    done (dict): Optional. Sections already written, by position; these are yielded first and not rewritten.
+    rounds (int): Sections that failed are requested again, on their own, up to this many rounds in all.
+
+    Yields:
+    tuple: (position in sections, section text) in completion order.
+
+    Raises:
+    RuntimeError: If some sections failed in every round. The others have been yielded by then,
+    so a caller that saved them only has to write the missing ones.
+    """
+    done = done or {}
+    yield from done.items()
+    remaining = [position for position in range(len(sections)) if position not in done]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for round_number in range(1, rounds + 1):
+            if not remaining:
+                break
+            if round_number > 1:
+                print(f"Requesting {len(remaining)} failed sections again (round {round_number} of {rounds})")
+            futures = {}
+            for position in remaining:
+                section = sections[position]
+                section_delta = None if on_delta is None else (lambda text, position=position: on_delta(position, text))
+                future = executor.submit(write_section_with_retries, section, outline, select_section_notes(section, notes), type_of_writer, style, section_delta)
+                futures[future] = position
+            remaining = []
+            pending = set(futures)
+            while pending:
+                finished, pending = concurrent.futures.wait(pending, timeout=STREAM_RENDER_INTERVAL, return_when=concurrent.futures.FIRST_COMPLETED)
+                if on_tick is not None:
+                    on_tick()
+                for future in finished:
+                    text = future.result()
+                    if text is None:
+                        remaining.append(futures[future])
+                    else:
+                        yield futures[future], text
+    if remaining:
+        titles = [sections[position].title for position in sorted(remaining)]
+        raise RuntimeError(f"Could not write the sections {titles}")
+
+def stitch_sections(sections, written):
+    """
+    Consistency pass over independently written sections before they are joined in outline order.
+    Makes every section open with its outline heading at the outline's level, drops the markers the
+    sequential loop relies on, and removes paragraphs already used verbatim in an earlier section.
+    """
+    seen_paragraphs = set()
+    stitched = []
+    for section, text in zip(sections, written):
+        text = ARTICLE_COMPLETE_PATTERN.sub('', text)
+        text = NEXT_SECTION_PATTERN.sub('', text)
+        paragraphs = []
+        for paragraph in PARAGRAPH_SPLIT_PATTERN.split(text.strip()):
+            key = NON_WORD_PATTERN.sub(' ', paragraph).strip().lower()
+            # Headings, tables and image placeholders may legitimately repeat
+            if len(key) > 80 and not paragraph.lstrip().startswith(('#', '|', '[Insert Image Here')):
+                if key in seen_paragraphs:
+                    continue
+                seen_paragraphs.add(key)
+            paragraphs.append(paragraph)
+        text = '\n\n'.join(paragraphs)
+        heading = '#' * max(2, min(section.level, 6)) + ' '
+        first_line = text.split('\n', 1)[0]
+        if OUTLINE_HEADING_PATTERN.match(first_line):
+            text = heading + OUTLINE_HEADING_PATTERN.match(first_line).group(2) + text[len(first_line):]
+        else:
+            text = heading + section.title + '\n\n' + text
+        stitched.append(text)
+    return stitched
+
+# Images are generated in the background so they never block writing the next section
+IMAGE_WORKERS = 4
+IMAGE_PLACEHOLDER_PATTERN = re.compile(r'\[Insert Image Here: ([^\]]+)\]', re.DOTALL)
+
+def generate_image(description):
+    """ Generate one DALL-E image and return its <img> tag, or None if generation failed """
+    print(description)
+    try:
+        # Generate an image. URLs expire an hour after generation, so the cache only serves them for 50 minutes
+        request = dict(
+            model="dall-e-3",
+            prompt=f"You will be given an image {description} but done in a very simple way, using metaphor if needed. Avoid including text.",
+            size="1792x1024",
+            quality="hd",
+            n=1,
+        )
+        image_url = llm_cache.cached('image', request, lambda: openai_scheduler.call("images", "dall-e-3", 0,
+            client.images.generate, **request).data[0].url)
+        return f'<img src="{image_url}" width="800"/>'
+    except Exception as e:
+        print(f"Error generating image for {description}: {e}")
+        return None
+
+def start_image_generation(document, executor):
+    """ Submit every image placeholder in a document and return a {placeholder: future} dict """
+    placeholders = IMAGE_PLACEHOLDER_PATTERN.findall(document)
+    print(len(placeholders))
+    return {f'[Insert Image Here: {description}]': executor.submit(generate_image, description)
+            for description in dict.fromkeys(placeholders)}
+
+def replace_image_placeholders(document, futures, wait=False):
+    """
+    Swap finished images into a document. Placeholders that are done are removed from `futures`.
+
+    Returns:
+    tuple: (updated document, True once every placeholder has been handled)
+    """
+    if wait:
+        concurrent.futures.wait(list(futures.values()))
+    for placeholder, future in list(futures.items()):
+        if not future.done():
+            continue
+        del futures[placeholder]
+        image_tag = future.result()
+        if image_tag is not None:
+            document = document.replace(placeholder, image_tag)
+    return document, not futures
+
+def refresh_pending_images(sections, pending_images, wait=False, on_done=None):
+    """
+    Swap completed images into already written sections and re-render them.
 
-    # Replace placeholders with images
-    for old, new in replacements.items():
-        document = document.replace(old, new)
+    Parameters:
+    sections (list): The article sections, updated in place.
+    pending_images (list): (section index, streamlit placeholder, {placeholder: future}) entries.
+    wait (bool): Block until every image has finished.
+    on_done (callable): Optional. Called with (section index, section text) once a section has all its images.
 
+    Returns:
+    list: The entries that still have images in flight.
+    """
+    still_pending = []
+    for index, slot, futures in pending_images:
+        remaining = len(futures)
+        sections[index], done = replace_image_placeholders(sections[index], futures, wait)
+        if len(futures) != remaining:
+            slot.markdown(sections[index], unsafe_allow_html=True)
+        if not done:
+            still_pending.append((index, slot, futures))
+        elif on_done is not None:
+            on_done(index, sections[index])
+    return still_pending
+
+def generate_images_from_placeholders(document):
+    # Generate every image in the document concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+        futures = start_image_generation(document, executor)
+        document, _ = replace_image_placeholders(document, futures, wait=True)
     return document
 
-def main():
 
-    st.title("Automated Content Creation Pipeline - Information Gain")
-    query = st.text_input("Enter your query", "2023 Israel Hamas War Timeline")
-    num_articles = st.text_input("How Many Pages of Search Results Should We Use for Research?", 1)
-    type_of_writer = st.text_input("What Type of Writer Should We Simulate?", "NYTimes Journalist")
-    style = st.text_input("What Style or Voice Shoule We Adhere To?", "Professional and actionable.")
-    outline = []
-    final_article = []
-    conversation = []
-    i = 0
-    
-    # Initialize session state for processing
-    if 'process_started' not in st.session_state:
-        st.session_state.process_started = False
+# Stage pipeline: each stage declares what it reads and what it produces, and every stage whose
+# inputs are available runs at once, so independent work (like the survey) overlaps the writing
+PIPELINE_WORKERS = 4
+PIPELINE_TICK = 0.25
 
-      
-    if st.button("Start Research"):
-        st.session_state.process_started = True
+class Channel:
+    """ Thread-safe stream of items from the stage producing it to the stage consuming it """
+    _CLOSED = object()
 
-        if st.session_state.process_started:
-        # Your processing code here (scraping, analyzing, etc.)
-        # ...
-        # Set this to False if you want to prevent re-execution on refresh
-        # Provide the buffer's content to the download button
-            file_ids_attempt = []
-            progress = st.progress(0)
-            status = st.empty()
-    
-            # Scraping articles
-            status.text('Scraping articles...')
-            articles = scrape_articles(query,num_articles)
-            status.text('Articles scraped successfully!')
-            progress.progress(10)
-    
-    
-    
-            for index, row in articles.iterrows():
-                article = {
-                        'Root Domain': row['Root Domain'],
-                        'Link': row['Link'],
-                        'Title': row['Title'],
-                        'Authors': row['Authors'],
-                        'Publish Date': row['Publish Date'],
-                        'Snippet': row['Snippet'],
-                        'Text': row['Text']
-                    }
-                status.text(f'Uploading article {index + 1} of {len(articles)}...')
-                article_content = '\n'.join(f'{key}: {value}' for key, value in row.items())
-                file_id = upload_article(article_content, index, row['Title'])
-                file_ids_attempt.append((file_id, row['Title']))
-            status.text('All articles uploaded successfully!')
-            progress.progress(30)
-    
-            # Analyzing articles
-            file_ids = [(str(file_id), link) for file_id, link in file_ids_attempt if file_id is not None and isinstance(file_id, str)]
-            status.text('Analyzing articles...')
-            back_from_analyze = analyze_articles(file_ids,query,status,client)
-            aggregated_notes_file_path = back_from_analyze[0]
-            #status.text(back_from_analyze[0])
-            uploaded_file_ids = back_from_analyze[1]
-            full_notes = back_from_analyze[2]
-            full_notes_string = full_notes.to_string()
-            status.text('Analysis completed!')
-            progress.progress(60)
-            
-    
-            outline_assistant_id = client.beta.assistants.create(
-                instructions=f"Please simulate an expert on writing comprehensive long-form article outlines on the topic of {query}."
-                "As a superhuman AI, you do this job better than any human in terms of information gain."
-                "Based on the files provided in the reference corpuses, please improve, expand and extend the article outline with each new round."
-                f"The reference files have the following file ids: {uploaded_file_ids}. You DO have access to these files, even if you assume you dont."
-                "Make sure to double check, the file is available. Use the notes corpus to make sure you are not missing anything.Write at least 6000 words."
-                "Write your extremely detailed outline in markdown with deep hierarchies."
-                "The outline should include all unique information found in the corpus, highly organized, retaining all salient facts. The primary goal of this outline is maximum information density.6,000 word MINIMUM."
-                "Say research complete when done.",
-                model="gpt-3.5-turbo-1106",
-                tools=[{"type": "retrieval"}],
-                file_ids=uploaded_file_ids
-            ).id
-    
-            outline_thread_id = client.beta.threads.create().id
-    
-            prompt = "Please create an initial outline based on the aggregated notes."
-            client.beta.threads.messages.create(
-                thread_id=outline_thread_id,
-                role="user",
-                content=prompt
-            )
-    
-            run_response = client.beta.threads.runs.create(
-                thread_id=outline_thread_id,
-                assistant_id=outline_assistant_id
-            )
-    
-    
-            
-            run_status = client.beta.threads.runs.retrieve(thread_id=outline_thread_id, run_id=run_response.id).status
+    def __init__(self):
+        self._queue = queue.Queue()
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+        self._queue.put(item)
+
+    def close(self):
+        self._queue.put(self._CLOSED)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._CLOSED:
+                # Leave the marker in place for any other reader
+                self._queue.put(item)
+                return
+            yield item
+
+class Stage(NamedTuple):
+    name: str
+    fn: object
+    inputs: tuple
+    outputs: tuple = ()
+    streams: tuple = ()         # Outputs handed to fn as Channels; their consumers start as soon as fn does
+    main_thread: bool = False   # Stages that draw on the page have to run on the script thread
+    checkpoint: bool = True     # Whether a resumed run can reuse this stage's outputs
+    optional: bool = False      # A failure is logged and skipped, along with the stages that need its outputs
+
+# Checkpoints let a failed or interrupted run pick up where it stopped
+CHECKPOINT_DIR = os.path.join(CACHE_DIR, "runs")
+
+class RunCheckpoint:
+    """
+    A run's finished stages and finished items, kept in one directory.
+
+    manifest.json records the run inputs and, for each finished stage, the pickle holding its outputs.
+    Items finished inside a stage (one article's notes, one section) are appended to <stage>.items as
+    they land, so a stage that fails halfway only redoes the items it hadn't finished.
+    """
+
+    def __init__(self, run_dir, inputs=None):
+        self.run_dir = run_dir
+        self.manifest_path = os.path.join(run_dir, 'manifest.json')
+        self.lock = threading.Lock()
+        os.makedirs(run_dir, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as file:
+                self.manifest = json.load(file)
+        else:
+            self.manifest = {'created': datetime.now().isoformat(), 'inputs': inputs, 'stages': {}, 'complete': False}
+            self._write_manifest()
+
+    def _write_manifest(self):
+        # Written to a temporary file first so a crash never leaves a half-written manifest
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file, indent=2, default=str)
+        os.replace(temp_path, self.manifest_path)
+
+    def completed(self, stage):
+        return stage in self.manifest['stages']
+
+    def load_outputs(self, stage):
+        with open(os.path.join(self.run_dir, self.manifest['stages'][stage]['file']), 'rb') as file:
+            return pickle.load(file)
+
+    def save_outputs(self, stage, outputs):
+        file_name = f"{stage}.pkl"
+        with open(os.path.join(self.run_dir, file_name), 'wb') as file:
+            pickle.dump(outputs, file)
+        with self.lock:
+            self.manifest['stages'][stage] = {'file': file_name, 'outputs': sorted(outputs), 'finished': datetime.now().isoformat()}
+            self._write_manifest()
+
+    def items(self, stage):
+        """ The items of a stage finished so far, by key """
+        items = {}
+        path = os.path.join(self.run_dir, f"{stage}.items")
+        if os.path.exists(path):
+            with self.lock, open(path, 'r+b') as file:
+                good = 0  # Offset just past the last complete record
+                while True:
+                    try:
+                        key, value = pickle.load(file)
+                    except Exception:
+                        # The end of the log, or a record cut short by a crash
+                        break
+                    items[key] = value
+                    good = file.tell()
+                if good < os.fstat(file.fileno()).st_size:
+                    # Cut the damaged tail off, or items saved after it would never be read back
+                    print(f"Dropping a damaged record at the end of {path}")
+                    file.truncate(good)
+        return items
+
+    def save_item(self, stage, key, value):
+        with self.lock:
+            with open(os.path.join(self.run_dir, f"{stage}.items"), 'ab') as file:
+                pickle.dump((key, value), file)
+
+    def finish(self):
+        with self.lock:
+            self.manifest['complete'] = True
+            self._write_manifest()
+
+def open_checkpoint(inputs, fresh=False, root=None):
+    """
+    Return the checkpoint for a run with these inputs, resuming an unfinished one if there is one.
+
+    Parameters:
+    inputs (dict): The run inputs that identify it, like the query and writer settings.
+    fresh (bool): Discard any unfinished run with the same inputs and start over.
+    root (str): The directory holding the run directories, CHECKPOINT_DIR by default.
+    """
+    run_dir = os.path.join(root or CHECKPOINT_DIR, make_cache_key('run', inputs)[:16])
+    manifest_path = os.path.join(run_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as file:
+            complete = json.load(file).get('complete', False)
+        # A finished run with the same inputs is redone, not replayed
+        if fresh or complete:
+            shutil.rmtree(run_dir, ignore_errors=True)
+        else:
+            print(f"Resuming run in {run_dir}")
+    return RunCheckpoint(run_dir, inputs)
+
+class Pipeline:
+    """
+    Run a DAG of Stages, starting each one as soon as all of its inputs exist.
+
+    Parameters:
+    stages (list): The Stages. Each fn is called with its inputs and streams as keyword arguments and returns a dict of its outputs.
+    max_workers (int): Stages running in the background at once.
+    """
+    def __init__(self, stages, max_workers=PIPELINE_WORKERS):
+        produced = [name for stage in stages for name in stage.outputs + stage.streams]
+        duplicates = {name for name in produced if produced.count(name) > 1}
+        if duplicates:
+            raise ValueError(f"Pipeline values produced by more than one stage: {sorted(duplicates)}")
+        self.stages = list(stages)
+        self.max_workers = max_workers
+        self.timings = {}  # Stage name -> (started, finished) on the time.monotonic() clock
+        self.skipped = {}  # Stage name -> why it was skipped, for optional stages that failed or lost their inputs
+
+    def _call(self, stage, kwargs):
+        started = time.monotonic()
+        try:
+            outputs = stage.fn(**kwargs) or {}
+        finally:
+            # Consumers must never wait on a producer that has stopped, even if it failed
+            for name in stage.streams:
+                kwargs[name].close()
+            self.timings[stage.name] = (started, time.monotonic())
+        missing = set(stage.outputs) - set(outputs)
+        if missing:
+            raise RuntimeError(f"Stage {stage.name} did not produce {sorted(missing)}")
+        return outputs
+
+    def run(self, values, on_stage_done=None, checkpoint=None):
+        """
+        Run every stage and return the dict of all values.
+
+        Parameters:
+        values (dict): The initial inputs.
+        on_stage_done (callable): Called on the calling thread with (stage name, values) after each stage.
+        checkpoint (RunCheckpoint): Optional. Stages it has finished are restored instead of run, and
+            every stage's outputs are saved to it. Stages can also read it as the 'checkpoint' input.
+        """
+        values = dict(values, checkpoint=checkpoint)
+        pending = list(self.stages)
+        running = {}
+        if checkpoint is not None:
+            for stage in self.stages:
+                if stage.checkpoint and checkpoint.completed(stage.name):
+                    print(f"Pipeline stage {stage.name} restored from checkpoint")
+                    values.update(checkpoint.load_outputs(stage.name))
+                    pending.remove(stage)
+            for stage in self.stages:
+                if stage not in pending and on_stage_done is not None:
+                    on_stage_done(stage.name, values)
+
+        def start(stage):
+            pending.remove(stage)
+            for name in stage.streams:
+                values[name] = Channel()
+            return {name: values[name] for name in stage.inputs + stage.streams}
+
+        def skip(stage, error):
+            """ Drop a failed optional stage and everything downstream of it, which must be optional too """
+            print(f"Optional pipeline stage {stage.name} failed and was skipped: {error}")
+            self.skipped[stage.name] = str(error)
+            lost = set(stage.outputs + stage.streams)
             while True:
-                if run_status in ['queued', 'in_progress']:
-                    run_status = client.beta.threads.runs.retrieve(thread_id=outline_thread_id, run_id=run_response.id).status
-            
-                    time.sleep(1)  # Wait for 5 seconds before polling again
-                    print(run_status)
+                dependents = [other for other in pending if lost & set(other.inputs)]
+                if not dependents:
+                    return
+                for other in dependents:
+                    if not other.optional:
+                        raise RuntimeError(f"Stage {other.name} needs the outputs of stage {stage.name}, which failed") from error
+                    print(f"Optional pipeline stage {other.name} skipped because {stage.name} failed")
+                    self.skipped[other.name] = f"{stage.name} failed"
+                    pending.remove(other)
+                    lost |= set(other.outputs + other.streams)
+
+        def complete(stage, call):
+            try:
+                outputs = call()
+            except Exception as e:
+                if not stage.optional:
+                    raise
+                skip(stage, e)
+                return
+            finish(stage, outputs)
+
+        def finish(stage, outputs):
+            values.update(outputs)
+            started, finished = self.timings[stage.name]
+            print(f"Pipeline stage {stage.name} finished in {finished - started:.1f}s")
+            if checkpoint is not None and stage.checkpoint:
+                # Streams are saved as the items that went through them
+                checkpoint.save_outputs(stage.name, dict(outputs, **{name: values[name].items for name in stage.streams}))
+            if on_stage_done is not None:
+                on_stage_done(stage.name, values)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [stage for stage in pending if all(name in values for name in stage.inputs)]
+                for stage in ready:
+                    if not stage.main_thread:
+                        running[executor.submit(self._call, stage, start(stage))] = stage
+                main_stages = [stage for stage in ready if stage.main_thread]
+                if main_stages:
+                    # Background stages keep going while this one holds the script thread
+                    stage = main_stages[0]
+                    kwargs = start(stage)
+                    complete(stage, lambda: self._call(stage, kwargs))
                     continue
-                if run_status in ['completed', 'failed']:
-                    run_status = client.beta.threads.runs.retrieve(thread_id=outline_thread_id, run_id=run_response.id).status
-            
-                    print(run_status)
-                    print("run status outline loop")
-                    break
-                elif run_status == 'requires_action':
-                    print(run_status)
-                    break
-    
-            response = client.beta.threads.messages.list(thread_id=outline_thread_id)
-            the_outline = response.data[0].content[0].text
-            outline.append(the_outline)
-    
-            #st.write(response.data)
-            #st.write(the_outline.value)
-            prompt = f"""Please significantly extend and improve the outline using the notes found in file ids: {uploaded_file_ids} for the goal of the query: {query}.
-            For each top level section, list the urls of the sources that apply to that section from the notes corpus like this: [Relevant Source from Notes: https://the url found in the notes]
-            You DO have access to these files, even if you assume you dont. Make sure you look at all the files when creating and improving your outline. Make sure the outline is in beautiful and valid markdown.
-            Make sure to double check, the file is available. Use the notes corpus to make sure you are not missing anything.The goal is to add all missing facts, data, stats, main points, missing sections, missing subsections, etc.
-            Here is the outline to extend and improve using the corpus: {the_outline.value} \n Improved and Expanded Markdown Outline/Table of Contents:"""
-    
-            client.beta.threads.messages.create(
-                thread_id=outline_thread_id,
-                role="user",
-                content=prompt
-            )
-    
-            run_response = client.beta.threads.runs.create(
-                thread_id=outline_thread_id,
-                assistant_id=outline_assistant_id
-            )
-            print(f"Outline Run created with ID: {run_response.id}")
-            print(f"Created message for file ID {uploaded_file_ids} in thread {outline_thread_id}")
-            
-            while True:
-                run_status = client.beta.threads.runs.retrieve(thread_id=outline_thread_id, run_id=run_response.id).status
-                if run_status in ['queued', 'in_progress']:
-                    run_status = client.beta.threads.runs.retrieve(thread_id=outline_thread_id, run_id=run_response.id).status
-            
-                    time.sleep(1)  # Wait for 5 seconds before polling again
-                    print(run_status)
+                if any(stage.streams for stage in ready):
+                    # Consumers of a new stream can start right away
                     continue
-                if run_status in ['completed', 'failed']:
-                    run_status = client.beta.threads.runs.retrieve(thread_id=outline_thread_id, run_id=run_response.id).status
-    
-                    print(run_status)
-                    print("run status outline loop")
-                    break
-                elif run_status == 'requires_action':
-                    print(run_status)
-                    break
-            
-            # Retrieve the assistant's response
-            response = client.beta.threads.messages.list(thread_id=outline_thread_id)
-            outline_message_id = response.data[0].id
-            outline_message_content = response.data[0].content[0].text.value
-            outline_message_role= response.data[0].role
-            outline_message_file_id = response.data[0].file_ids
-        
-            outline.append(outline_message_content)
+                if not running:
+                    raise RuntimeError(f"Pipeline stages waiting on inputs nothing produces: {[stage.name for stage in pending]}")
+                done, _ = concurrent.futures.wait(running, timeout=PIPELINE_TICK, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    complete(running.pop(future), future.result)
+        return values
+
+
+class StreamlitUI:
+    """ The page elements the writing stage reports into """
+    def __init__(self):
+        self.progress_bar = st.progress(0)
+        self.status_text = st.empty()
+
+    def status(self, text):
+        self.status_text.text(text)
+
+    def progress(self, value):
+        self.progress_bar.progress(value)
+
+    def slot(self):
+        return st.empty()
+
+    def write(self, *args):
+        st.write(*args)
+
+class ConsoleSlot:
+    """ Stand-in for st.empty() when nothing is rendered """
+    def markdown(self, text, unsafe_allow_html=False):
+        pass
+
+class ConsoleUI:
+    """ Headless stand-in for StreamlitUI that prints status updates """
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+
+    def status(self, text):
+        print(f"{self.prefix}{text}")
+
+    def progress(self, value):
+        pass
+
+    def slot(self):
+        return ConsoleSlot()
+
+    def write(self, *args):
+        print(self.prefix + ' '.join(str(arg) for arg in args))
+
+
+def scrape_stage(query, num_articles, max_sources):
+    articles = scrape_articles(query,num_articles)
+    articles, merged_links = dedupe_articles(articles)
+    articles, source_scores = select_sources(articles, query, int(max_sources) or None)
+    return {'articles': articles, 'merged_links': merged_links, 'source_scores': source_scores}
+
+def upload_stage(articles, uploads):
+    upload_articles(articles, on_uploaded=uploads.put)
+    return {}
+
+def analyze_stage(uploads, query, checkpoint):
+    # Note taking starts on each article as soon as its upload finishes
+    file_ids = ((str(file_id), link) for file_id, link in uploads if file_id is not None and isinstance(file_id, str))
+    notes_index = NotesIndex()
+    done = checkpoint.items('analyze') if checkpoint else None
+    on_result = (lambda file_id, result: checkpoint.save_item('analyze', file_id, result)) if checkpoint else None
+    full_notes, uploaded_file_ids, _ = analyze_articles(file_ids,query,None,client,notes_index,done,on_result)
+    return {'full_notes': full_notes, 'uploaded_file_ids': uploaded_file_ids, 'notes_index': notes_index}
+
+def compact_stage(full_notes, uploaded_file_ids, notes_index):
+    facts_df, compact_corpus = compact_notes(full_notes['Note'].tolist())
+    if compact_corpus:
+        # Outline and writing work from the deduplicated facts instead of the raw notes
+        writing_index = build_facts_index(compact_corpus)
+        compact_file_id = upload_bytes(client, compact_corpus.encode('utf-8'), 'compacted_notes.txt')
+        outline_file_ids = [compact_file_id]
+    else:
+        writing_index = notes_index
+        outline_file_ids = uploaded_file_ids
+    return {'facts_df': facts_df, 'compact_corpus': compact_corpus, 'writing_index': writing_index, 'outline_file_ids': outline_file_ids}
+
+def outline_stage(query, outline_file_ids):
+    outline_assistant_id = get_or_create_assistant(client,
+        instructions="Please simulate an expert on writing comprehensive long-form article outlines on the topic given in the user's message."
+        "As a superhuman AI, you do this job better than any human in terms of information gain."
+        "Based on the files provided in the reference corpuses, please improve, expand and extend the article outline with each new round."
+        "The reference files are attached to the messages in this thread. You DO have access to these files, even if you assume you dont."
+        "Make sure to double check, the file is available. Use the notes corpus to make sure you are not missing anything.Write at least 6000 words."
+        "Write your extremely detailed outline in markdown with deep hierarchies."
+        "The outline should include all unique information found in the corpus, highly organized, retaining all salient facts. The primary goal of this outline is maximum information density.6,000 word MINIMUM."
+        "Say research complete when done.",
+        model="gpt-3.5-turbo-1106",
+        tools=[{"type": "retrieval"}]
+    )
+
+    def generate_outlines():
+        outline = []
+        outline_thread_id = openai_scheduler.call("outline", "assistants", 0, client.beta.threads.create).id
+        attach_files_to_thread(client, outline_thread_id, outline_file_ids)
+
+        prompt = f"""The topic of the article is: {query}
+        The reference files have the following file ids: {outline_file_ids}.
+        Please create an initial outline based on the aggregated notes."""
+        openai_scheduler.call("outline", "assistants", 0, client.beta.threads.messages.create,
+            thread_id=outline_thread_id,
+            role="user",
+            content=prompt
+        )
+
+        outcome = run_and_wait(client, outline_thread_id, outline_assistant_id, "outline", "gpt-3.5-turbo-1106")
+        print(f"Outline run {outcome.run_id} finished with status: {outcome.status.value}")
+        if outcome.status != RunStatus.COMPLETED:
+            raise RuntimeError(f"Initial outline run ended with status {outcome.status.value}: {outcome.last_error}")
+
+        response = openai_scheduler.call("outline", "assistants", 0, client.beta.threads.messages.list, thread_id=outline_thread_id)
+        the_outline = response.data[0].content[0].text
+        outline.append(the_outline.value)
+
+        #st.write(response.data)
+        #st.write(the_outline.value)
+        prompt = f"""Please significantly extend and improve the outline using the notes found in file ids: {outline_file_ids} for the goal of the query: {query}.
+        For each top level section, list the urls of the sources that apply to that section from the notes corpus like this: [Relevant Source from Notes: https://the url found in the notes]
+        You DO have access to these files, even if you assume you dont. Make sure you look at all the files when creating and improving your outline. Make sure the outline is in beautiful and valid markdown.
+        Make sure to double check, the file is available. Use the notes corpus to make sure you are not missing anything.The goal is to add all missing facts, data, stats, main points, missing sections, missing subsections, etc.
+        Here is the outline to extend and improve using the corpus: {the_outline.value} \n Improved and Expanded Markdown Outline/Table of Contents:"""
+
+        openai_scheduler.call("outline", "assistants", 0, client.beta.threads.messages.create,
+            thread_id=outline_thread_id,
+            role="user",
+            content=prompt
+        )
+
+        outcome = run_and_wait(client, outline_thread_id, outline_assistant_id, "outline", "gpt-3.5-turbo-1106")
+        print(f"Outline run {outcome.run_id} finished with status: {outcome.status.value}")
+        print(f"Created message for file ID {outline_file_ids} in thread {outline_thread_id}")
+        if outcome.status != RunStatus.COMPLETED:
+            raise RuntimeError(f"Outline extension run ended with status {outcome.status.value}: {outcome.last_error}")
     
-            status.text('Finalizing outline...')
-            df_outline = pd.DataFrame(outline)
+        # Retrieve the assistant's response
+        response = openai_scheduler.call("outline", "assistants", 0, client.beta.threads.messages.list, thread_id=outline_thread_id)
+        outline_message_id = response.data[0].id
+        outline_message_content = response.data[0].content[0].text.value
+        outline_message_role= response.data[0].role
+        outline_message_file_id = response.data[0].file_ids
+
+        outline.append(outline_message_content)
+        return outline
+
+    # Both rounds are cached as one response; the second prompt is built from the first outline
+    outline = llm_cache.cached('assistant', {'assistant_id': outline_assistant_id, 'model': "gpt-3.5-turbo-1106", 'query': query, 'file_ids': outline_file_ids}, generate_outlines)
+    df_outline = pd.DataFrame(outline)
+
+    return {'outline': outline, 'df_outline': df_outline, 'final_outline': outline[1]}
+
+def write_stage(query, final_outline, writing_index, type_of_writer, style, ui, checkpoint):
+    notes_index = writing_index
+    # Only sections still waiting for their images are kept; the rest of the article lives in the assembler's file
+    sections = {}
+    cited_urls = {}
+    bibliography_written = False
+
+    def track(section_text):
+        # Keep what the bibliography step needs from a section, so the section itself can be let go
+        nonlocal bibliography_written
+        cited_urls.update(dict.fromkeys(SOURCE_URL_PATTERN.findall(section_text)))
+        bibliography_written = bibliography_written or "Bibliography Complete" in section_text
+
+    # Sections a previous attempt wrote are replayed from the checkpoint instead of being rewritten
+    saved = checkpoint.items('write') if checkpoint else {}
+
+    def write_turn(key, slot):
+        if key in saved:
+            return saved[key]
+        text = query_assistant(conversation.messages(),type_of_writer,style,render_stream(slot))
+        if checkpoint is not None:
+            checkpoint.save_item('write', key, text)
+        return text
+
+    prompt = f"""You will be writing a long-form article based on an outline and a notes corpus. You include everything in the outline, including the top level sections, subsections, and sub-subsections. 
+    Never write the same section twice, always progress to the next section. 
+    Start by writing a table of contents (only included in first iteration) that mirrors exactly what you see in the outline with all sections/subsections/subsubsections included. 
+    It should have many sections, subsections, and subsubsections. Then go section by section, the table of contents should only be returned once. 
+    While following the outline, draw extensively on your notes corpus. The notes contains many sections, each related to a specific source. 
+    Each chunk of notes is labelled with the url of its source like this: [Source: https://the url]. 
+    When citing a source, always reference a specific url from the notes corpus. 
+    The citation should be inline and use the format: [URL Title from the notes,URL from the notes always starting with http or https]. 
+    You never write generically or with generalizations, 
+    you always attempt to use specific facts, data, etc. You also like to include markdown tables. 
+    Make sure to cite your sources inline. Each section is at least 2000 words. 
+    You write in beautiful markdown and always cite your sources from http or https urls found in your notes corpus. 
+    Leverage your notes to the fullest extent possible. 
+    At the beginning of each top level section only section, make a detailed recommendation for an image to include. 
+    This image should be a simplistic representation of the given section. 
+    It should NEVER instructions for including text or be super complex. 
+    The image description should be very specific to help a generative AI render it accurately. 
+    Provide these instructions like this: [Insert Image Here: The Image Description] . 
+    Also Please include markdown tables from data found in the notes where you think the table will add value and ease of reading for the reader. 
+    Each section will likely have a table or other structured markdown viz.
+    Use Headings, Subheadings, Sub-SubHeadings etc in beautiful markdown styling. Also make use of markdown lists, blockquotes, and other ways to make the content more readable, interesting, and useful.
+    Use as many relevant sources as possible in each section.
+    Be extremely thorough and comprehensive with a focus on making the article as useful and actionable as possible. 
+    When referencing a url, do it inline and use [URL Title from the notes,URL from the notes always starting with http or https]. 
+    Never cite references like this [[1†source]]. Always use the actual http or https url. Try to use as many different sources as possible in your article. 
+    Because the notes are so extensive, you should be referencing sources, all sources should be referenced by the end of the article. 
+    When you have finished all the sections return the text - Article Complete - Start with the table of contents, and then write each section of the table of contents one at a time.
+    After writing a section, always provide the next section title that needs to be written like this [Next Section to Write: Next Section Title].
+    Here is the outline you will follow: #### {final_outline} ####. 
+    The notes corpus to leverage follows in the next message.
+    Please take your time, think step by step, and return the full section."""
     
-            
-            status.text('Outline generation concluded. Now Writing Full Article.')
-            progress.progress(70)
-            
-            # Convert DataFrames to CSV bytes
-            aggregate_notes_csv_bytes = convert_df_to_csv_bytes(full_notes)
-            all_outlines_csv_bytes = convert_df_to_csv_bytes(df_outline)
+    conversation = ArticleContext(prompt, format_note_chunks(notes_index.search(f"{query}\n{final_outline}")))
+    # Sections are cleaned and spilled to disk as soon as they (and their images) are final
+    with ArticleAssembler(os.path.join(checkpoint.run_dir, 'article.md') if checkpoint else None) as assembler:
+        def section_done(position, section_text):
+            assembler.add(position, section_text)
+            sections.pop(position, None)
+
+        image_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+        pending_images = []
+        outline_sections = outline_top_sections(final_outline)
     
-            final_outline = outline[1]
-            
+        if len(outline_sections) >= MIN_PARALLEL_SECTIONS:
+          # Write every top level section of the outline at once and stitch them in outline order
+          ui.status(f'Writing {len(outline_sections)} Article Sections')
+          table_of_contents = build_table_of_contents(outline_sections)
+          ui.slot().markdown(table_of_contents)
+          section_slots = [ui.slot() for _ in outline_sections]
+          written = [''] * len(outline_sections)
+          section_images = [{} for _ in outline_sections]
+          # Writer threads can't touch the page, so they leave partial text here for the main thread to render
+          partial_sections = {}
+          saved_sections = {position: text for (kind, position), text in saved.items() if kind == 'section'}
+
+          def render_partial_sections():
+            for position, partial_text in list(partial_sections.items()):
+              if not written[position]:
+                section_slots[position].markdown(partial_text + " ▌", unsafe_allow_html=True)
+            partial_sections.clear()
+
+          for completed, (position, section_text) in enumerate(write_sections_concurrently(outline_sections, final_outline, notes_index, type_of_writer, style,
+                                                                                           on_delta=partial_sections.__setitem__, on_tick=render_partial_sections,
+                                                                                           done=saved_sections), start=1):
+            ui.progress(70 + int(20 * completed / len(outline_sections)))
+            ui.status(f'Wrote Article Section {completed} of {len(outline_sections)}')
+            written[position] = section_text
+            # Saved as they land, so if some sections can't be written a resumed run only writes those
+            if checkpoint is not None and position not in saved_sections:
+              checkpoint.save_item('write', ('section', position), section_text)
+            section_slots[position].markdown(section_text, unsafe_allow_html=True)
+            # Start this section's images while the other sections are still being written
+            section_images[position] = start_image_generation(section_text, image_executor)
+          sections.update(enumerate(stitch_sections(outline_sections, written), start=1))
+          written.clear()  # The stitched sections replace the raw ones
+          assembler.add(0, table_of_contents)
+          conversation.add_section(table_of_contents)
+          for position, section_slot in enumerate(section_slots, start=1):
+            section_slot.markdown(sections[position], unsafe_allow_html=True)
+            conversation.add_section(sections[position])
+            track(sections[position])
+            pending_images.append((position, section_slot, section_images[position - 1]))
+          pending_images = refresh_pending_images(sections, pending_images, on_done=section_done)
+          count = len(section_slots) + 1
+        else:
+          conversation.ask("Table of Contents:\n---------------------------------------")
+          toc_slot = ui.slot()
+          query_gpt = write_turn(('turn', 0), toc_slot)
+          toc_slot.markdown(query_gpt)
+          conversation.add_section(query_gpt)
+          track(query_gpt)
+          assembler.add(0, query_gpt)
+          last_section = query_gpt
+          count = 1
+          i=1
     
-            prompt = f"""You will be writing a long-form article based on an outline and a notes corpus. You include everything in the outline, including the top level sections, subsections, and sub-subsections. 
-            Never write the same section twice, always progress to the next section. 
-            Start by writing a table of contents (only included in first iteration) that mirrors exactly what you see in the outline with all sections/subsections/subsubsections included. 
-            It should have many sections, subsections, and subsubsections. Then go section by section, the table of contents should only be returned once. 
-            While following the outline, draw extensively on your notes corpus. The notes contains many sections, each related to a specific source. 
-            The sections of notes on individual sources are seperated by file-Gcjd8AsDYc1zhct03uHXyoqo filenames like that.  
-            When citing a source, always reference a specific url from the notes corpus. 
-            The citation should be inline and use the format: [URL Title from the notes,URL from the notes always starting with http or https]. 
-            You never write generically or with generalizations, 
-            you always attempt to use specific facts, data, etc. You also like to include markdown tables. 
-            Make sure to cite your sources inline. Each section is at least 2000 words. 
-            You write in beautiful markdown and always cite your sources from http or https urls found in your notes corpus. 
-            Leverage your notes to the fullest extent possible. 
-            At the beginning of each top level section only section, make a detailed recommendation for an image to include. 
-            This image should be a simplistic representation of the given section. 
-            It should NEVER instructions for including text or be super complex. 
-            The image description should be very specific to help a generative AI render it accurately. 
-            Provide these instructions like this: [Insert Image Here: The Image Description] . 
-            Also Please include markdown tables from data found in the notes where you think the table will add value and ease of reading for the reader. 
-            Each section will likely have a table or other structured markdown viz.
-            Use Headings, Subheadings, Sub-SubHeadings etc in beautiful markdown styling. Also make use of markdown lists, blockquotes, and other ways to make the content more readable, interesting, and useful.
-            Use as many relevant sources as possible in each section.
-            Be extremely thorough and comprehensive with a focus on making the article as useful and actionable as possible. 
-            When referencing a url, do it inline and use [URL Title from the notes,URL from the notes always starting with http or https]. 
-            Never cite references like this [[1†source]]. Always use the actual http or https url. Try to use as many different sources as possible in your article. 
-            Because the notes are so extensive, you should be referencing sources, all sources should be referenced by the end of the article. 
-            When you have finished all the sections return the text - Article Complete - Start with the table of contents, and then write each section of the table of contents one at a time.
-            After writing a section, always provide the next section title that needs to be written like this [Next Section to Write: Next Section Title].
-            Here is the outline you will follow: #### {final_outline} ####. 
-            Here is the notes corpus to leverage to write as complete and comprehensive an article as possible. 
-            Notes Dataframe: #### {full_notes_string} #### 
-            Please take your time, think step by step, and return the full section.
-            Section:"""
-            
-            conversation.append(str(prompt))
-            
-            conversation.append("Table of Contents:")
-            conversation.append("---------------------------------------")
-            query_gpt = query_assistant(str(conversation),type_of_writer,style)
-            st.markdown(query_gpt)
-            conversation.append(query_gpt)
-            final_article.append(query_gpt)
-            i=1
-            
-            while not any("Article Complete" in article_section for article_section in final_article):
-              progress.progress(70 + 1)
-              status.text(f'Writing Article Section {i}')
-              
-              st.write("-----------------------------")
-              keep_going = "Please write the next specified section. Do not rewrite existing sections, always move on to the next section that has not been completed yet. If all sections have been completed, return the text  - Article Complete - when finished with all sections. Next Section:"
-              conversation.append(keep_going)
-              #st.write(conversation)
-              second_query_gpt = query_assistant(str(conversation),type_of_writer,style)
-              document_with_images = generate_images_from_placeholders(second_query_gpt)
-              conversation.append(document_with_images)
-              st.markdown(document_with_images, unsafe_allow_html=True)
-              final_article.append(document_with_images)
-              #print(f"GPT Response:{query_gpt}")
-              i+=1
+          while "Article Complete" not in last_section:
+            ui.progress(70 + 1)
+            ui.status(f'Writing Article Section {i}')
+      
+            ui.write("-----------------------------")
+            keep_going = "Please write the next specified section. Do not rewrite existing sections, always move on to the next section that has not been completed yet. If all sections have been completed, return the text  - Article Complete - when finished with all sections. Next Section:"
+            conversation.ask(keep_going)
+            # Pull the notes for the section the model said it will write next
+            next_section = re.search(r'\[Next Section to Write:([^\]]+)\]', last_section)
+            if next_section:
+              conversation.notes = format_note_chunks(notes_index.search(next_section.group(1)))
+            #st.write(conversation)
+            section_slot = ui.slot()
+            second_query_gpt = write_turn(('turn', count), section_slot)
+            conversation.add_section(second_query_gpt)
+            section_slot.markdown(second_query_gpt, unsafe_allow_html=True)
+            track(second_query_gpt)
+            sections[count] = last_section = second_query_gpt
+            # Images for this section render while the next section is being written
+            pending_images.append((count, section_slot, start_image_generation(second_query_gpt, image_executor)))
+            count += 1
+            pending_images = refresh_pending_images(sections, pending_images, on_done=section_done)
+            #print(f"GPT Response:{query_gpt}")
+            i+=1
+
+        if not bibliography_written:
+
+          ui.status('Writing Bibliography')
+          add_bibliography = "Now please add a nicely formatted markdown bibliography at the end. The Bibliography should refrence the http or https links as they appear in the notes corpus that are referenced in the article. Once the bibliography is done, return the string - Bibliography Complete -"
+          if cited_urls:
+            add_bibliography += "\nThese are the urls cited in the article: " + "\n".join(cited_urls)
+          conversation.ask(add_bibliography)
+          bibliography_slot = ui.slot()
+          final_query_gpt = write_turn(('bibliography', 0), bibliography_slot)
+          bibliography_slot.markdown(final_query_gpt, unsafe_allow_html=True)
+
+          assembler.add(count, final_query_gpt)
+
+        # The bibliography doesn't need the images, so they are only awaited now
+        ui.status('Waiting for the remaining images')
+        refresh_pending_images(sections, pending_images, wait=True, on_done=section_done)
+        image_executor.shutdown()
+        return {'article_path': assembler.finish()}
+
+def export_stage(outline, article_path, full_notes, df_outline, articles, compact_corpus):
+    try:
+        return {'bundle': build_export_bundle(outline, article_path, full_notes, df_outline, articles, compact_corpus)}
+    finally:
+        # The bundle holds the article now, so a temporary copy is no longer needed
+        remove_temporary_article(article_path)
+
+def survey_stage(compact_corpus, full_notes):
+    corpus= compact_corpus or '\n\n'.join(full_notes['Note'])
             
-            if not any("Bibliography Complete" in article_section for article_section in final_article):
+    # The corpus plus roughly 4000 tokens of fixed survey prompt and the 4000 token completion
+    survey_tokens = estimate_tokens(corpus) + 8000
+    survey_text = cached_chat_completion("survey", survey_tokens,
+      model="gpt-3.5-turbo-1106",
+      messages=[
+            {"role": "system", "content": f"You are an expert survey writer writing a survey based on an article. Create AT LEAST 20 survey questions and their possible resonses to choose, including a few open ended response options. You create this as json only. Here is the corpus: {corpus}"},
+            {"role": "user", "content": """Return only valid Typeforms api request json. Use conditional logic where appropriate to improve or enhance the survey quality, consistency, or flow.
+            You will always have conditional logic, so your json needs to have a logic section. Never create questions or logic with images.
+            Here is the info you need to know to create an accurate json for Typeforms api.
     
-              status.text('Writing Bibliography')
-              add_bibliography = "Now please add a nicely formatted markdown bibliography at the end. The Bibliography should refrence the http or https links as they appear in the notes corpus that are referenced in the article. Once the bibliography is done, return the string - Bibliography Complete -"
-              conversation.append(add_bibliography)
-              final_query_gpt = query_assistant(str(conversation),type_of_writer,style)
-              st.markdown(final_query_gpt, unsafe_allow_html=True)
     
-              final_article.append(final_query_gpt)
-                
-            final_article = " ".join(final_article)
-            final_article =  fix_markdown(final_article)
-            final_article = remove_sections_within_brackets(final_article)
-            
-            
-    
-            
-            
-            status.text('Final Article Complete. Now Creating the Survey.')
+    Here is an example of a valid json request that uses conditional logic to help you make sure you are adhering to the proper syntax and schema. Pay special attention to syntax, exact schema and capitalization. All createItems must have a location and details:
     
+    ####{
+        "title": "Fly Fishing in Colorado Survey",
+        "settings": {
+            "language": "en",
+            "progress_bar": "proportion",
+            "meta": { "allow_indexing": False },
+            "hide_navigation": False,
+            "is_public": False,
+            "is_trial": False,
+            "show_progress_bar": True,
+            "show_typeform_branding": True,
+            "are_uploads_public": False,
+            "show_time_to_complete": True,
+            "show_number_of_submissions": False,
+            "show_cookie_consent": False,
+            "show_question_number": True,
+            "show_key_hint_on_choices": True,
+            "autosave_progress": True,
+            "free_form_navigation": False,
+            "use_lead_qualification": False,
+            "pro_subdomain_enabled": False
+        },
+        "welcome_screens": [
+            {
+                "title": "Welcome to the Fly Fishing in Colorado Survey!",
+                "properties": {
+                    "show_button": True,
+                    "button_text": "Start"
+                }
+            }
+        ],
+        "fields": [
+            {
+                "title": "What is your email address?",
+                "ref": "email_address",
+                "type": "email",
+                "validations": { "required": False }
+            },
+            {
+                "title": "How often do you go fly fishing in Colorado?",
+                "ref": "fishing_frequency",
+                "type": "multiple_choice",
+                "properties": {
+                    "choices": [
+                        { "label": "Less than once a year" },
+                        { "label": "Once a year" },
+                        { "label": "2-3 times a year" },
+                        { "label": "4-6 times a year" },
+                        { "label": "More than 6 times a year" }
+                    ]
+                },
+                "validations": { "required": False }
+            },
+            {
+                "title": "Do you own your fishing equipment?",
+                "ref": "own_equipment",
+                "type": "yes_no",
+                "validations": { "required": True }
+            },
+            {
+                "title": "What type of fish do you primarily target?",
+                "ref": "fish_target",
+                "type": "multiple_choice",
+                "properties": {
+                    "choices": [
+                        { "label": "Trout" },
+                        { "label": "Salmon" },
+                        { "label": "Bass" },
+                        { "label": "Other" }
+                    ]
+                },
+                "validations": { "required": True }
+            },
+            {
+                "title": "Describe your most memorable fishing experience.",
+                "ref": "fishing_experience",
+                "type": "long_text",
+                "validations": { "required": False }
+            },
+            {
+                "title": "Select your preferred fishing locations in Colorado.",
+                "ref": "fishing_locations",
+                "type": "multiple_choice",
+                "properties": {
+                    "choices": [
+                        {
+                            "label": "Location A",
     
+                        },
+                        {
+                            "label": "Location B",
     
-            corpus= full_notes
-                    
-            response = client.chat.completions.create(
-              model="gpt-3.5-turbo-1106",
-              messages=[
-                    {"role": "system", "content": f"You are an expert survey writer writing a survey based on an article. Create AT LEAST 20 survey questions and their possible resonses to choose, including a few open ended response options. You create this as json only. Here is the corpus: {corpus}"},
-                    {"role": "user", "content": """Return only valid Typeforms api request json. Use conditional logic where appropriate to improve or enhance the survey quality, consistency, or flow.
-                    You will always have conditional logic, so your json needs to have a logic section. Never create questions or logic with images.
-                    Here is the info you need to know to create an accurate json for Typeforms api.
-            
-            
-            Here is an example of a valid json request that uses conditional logic to help you make sure you are adhering to the proper syntax and schema. Pay special attention to syntax, exact schema and capitalization. All createItems must have a location and details:
-            
-            ####{
-                "title": "Fly Fishing in Colorado Survey",
-                "settings": {
-                    "language": "en",
-                    "progress_bar": "proportion",
-                    "meta": { "allow_indexing": False },
-                    "hide_navigation": False,
-                    "is_public": False,
-                    "is_trial": False,
-                    "show_progress_bar": True,
-                    "show_typeform_branding": True,
-                    "are_uploads_public": False,
-                    "show_time_to_complete": True,
-                    "show_number_of_submissions": False,
-                    "show_cookie_consent": False,
-                    "show_question_number": True,
-                    "show_key_hint_on_choices": True,
-                    "autosave_progress": True,
-                    "free_form_navigation": False,
-                    "use_lead_qualification": False,
-                    "pro_subdomain_enabled": False
+                        }
+                    ],
+                    "allow_multiple_selection": True
+                },
+                "validations": { "required": True }
+            },
+            {
+                "title": "On a scale of 1 to 10, how would you rate your fishing skills?",
+                "ref": "fishing_skills",
+                "type": "opinion_scale",
+                "properties": {
+                    "steps": 10,
+                    "start_at_one": True
                 },
-                "welcome_screens": [
+                "validations": { "required": True }
+            },
+            {
+                "title": "Would you be interested in participating in a fishing tournament?",
+                "ref": "interest_tournament",
+                "type": "yes_no",
+                "validations": { "required": True }
+            },
+        ],
+        "thankyou_screens": [
+        {
+            "title": "Thank you for your responses!",
+            "ref": "end_of_survey",
+            "properties": {
+                "show_button": False,
+                "share_icons": False
+            }
+        }
+        ],
+        "logic": [
+            {
+                "type": "field",
+                "ref": "email_address",
+                "actions": [
                     {
-                        "title": "Welcome to the Fly Fishing in Colorado Survey!",
-                        "properties": {
-                            "show_button": True,
-                            "button_text": "Start"
+                        "action": "jump",
+                        "details": {
+                            "to": {
+                                "type": "field",
+                                "value": "fishing_frequency"
+                            }
+                        },
+                        "condition": {
+                            "op": "always",
+                            "vars": []
                         }
                     }
-                ],
-                "fields": [
-                    {
-                        "title": "What is your email address?",
-                        "ref": "email_address",
-                        "type": "email",
-                        "validations": { "required": False }
-                    },
+                ]
+            },
+            {
+                "type": "field",
+                "ref": "fishing_frequency",
+                "actions": [
                     {
-                        "title": "How often do you go fly fishing in Colorado?",
-                        "ref": "fishing_frequency",
-                        "type": "multiple_choice",
-                        "properties": {
-                            "choices": [
-                                { "label": "Less than once a year" },
-                                { "label": "Once a year" },
-                                { "label": "2-3 times a year" },
-                                { "label": "4-6 times a year" },
-                                { "label": "More than 6 times a year" }
-                            ]
+                        "action": "jump",
+                        "details": {
+                            "to": {
+                                "type": "field",
+                                "value": "own_equipment"
+                            }
                         },
-                        "validations": { "required": False }
-                    },
-                    {
-                        "title": "Do you own your fishing equipment?",
-                        "ref": "own_equipment",
-                        "type": "yes_no",
-                        "validations": { "required": True }
-                    },
+                        "condition": {
+                            "op": "always",
+                            "vars": []
+                        }
+                    }
+                ]
+            },
+            {
+                "type": "field",
+                "ref": "own_equipment",
+                "actions": [
                     {
-                        "title": "What type of fish do you primarily target?",
-                        "ref": "fish_target",
-                        "type": "multiple_choice",
-                        "properties": {
-                            "choices": [
-                                { "label": "Trout" },
-                                { "label": "Salmon" },
-                                { "label": "Bass" },
-                                { "label": "Other" }
-                            ]
+                        "action": "jump",
+                        "details": {
+                            "to": {
+                                "type": "field",
+                                "value": "fish_target"
+                            }
                         },
-                        "validations": { "required": True }
-                    },
-                    {
-                        "title": "Describe your most memorable fishing experience.",
-                        "ref": "fishing_experience",
-                        "type": "long_text",
-                        "validations": { "required": False }
-                    },
-                    {
-                        "title": "Select your preferred fishing locations in Colorado.",
-                        "ref": "fishing_locations",
-                        "type": "multiple_choice",
-                        "properties": {
-                            "choices": [
+                        "condition": {
+                            "op": "is",
+                            "vars": [
                                 {
-                                    "label": "Location A",
-            
+                                    "type": "field",
+                                    "value": "own_equipment"
                                 },
                                 {
-                                    "label": "Location B",
-            
+                                    "type": "constant",
+                                    "value": True
                                 }
-                            ],
-                            "allow_multiple_selection": True
-                        },
-                        "validations": { "required": True }
-                    },
-                    {
-                        "title": "On a scale of 1 to 10, how would you rate your fishing skills?",
-                        "ref": "fishing_skills",
-                        "type": "opinion_scale",
-                        "properties": {
-                            "steps": 10,
-                            "start_at_one": True
-                        },
-                        "validations": { "required": True }
-                    },
-                    {
-                        "title": "Would you be interested in participating in a fishing tournament?",
-                        "ref": "interest_tournament",
-                        "type": "yes_no",
-                        "validations": { "required": True }
-                    },
-                ],
-                "thankyou_screens": [
-                {
-                    "title": "Thank you for your responses!",
-                    "ref": "end_of_survey",
-                    "properties": {
-                        "show_button": False,
-                        "share_icons": False
-                    }
-                }
-                ],
-                "logic": [
-                    {
-                        "type": "field",
-                        "ref": "email_address",
-                        "actions": [
-                            {
-                                "action": "jump",
-                                "details": {
-                                    "to": {
-                                        "type": "field",
-                                        "value": "fishing_frequency"
-                                    }
-                                },
-                                "condition": {
-                                    "op": "always",
-                                    "vars": []
-                                }
-                            }
-                        ]
+                            ]
+                        }
                     },
                     {
-                        "type": "field",
-                        "ref": "fishing_frequency",
-                        "actions": [
-                            {
-                                "action": "jump",
-                                "details": {
-                                    "to": {
-                                        "type": "field",
-                                        "value": "own_equipment"
-                                    }
-                                },
-                                "condition": {
-                                    "op": "always",
-                                    "vars": []
-                                }
+                        "action": "jump",
+                        "details": {
+                            "to": {
+                                "type": "field",
+                                "value": "fishing_experience"
                             }
-                        ]
-                    },
-                    {
-                        "type": "field",
-                        "ref": "own_equipment",
-                        "actions": [
-                            {
-                                "action": "jump",
-                                "details": {
-                                    "to": {
-                                        "type": "field",
-                                        "value": "fish_target"
-                                    }
-                                },
-                                "condition": {
-                                    "op": "is",
-                                    "vars": [
-                                        {
-                                            "type": "field",
-                                            "value": "own_equipment"
-                                        },
-                                        {
-                                            "type": "constant",
-                                            "value": True
-                                        }
-                                    ]
-                                }
-                            },
-                            {
-                                "action": "jump",
-                                "details": {
-                                    "to": {
-                                        "type": "field",
-                                        "value": "fishing_experience"
-                                    }
+                        },
+                        "condition": {
+                            "op": "is_not",
+                            "vars": [
+                                {
+                                    "type": "field",
+                                    "value": "own_equipment"
                                 },
-                                "condition": {
-                                    "op": "is_not",
-                                    "vars": [
-                                        {
-                                            "type": "field",
-                                            "value": "own_equipment"
-                                        },
-                                        {
-                                            "type": "constant",
-                                            "value": True
-                                        }
-                                    ]
+                                {
+                                    "type": "constant",
+                                    "value": True
                                 }
-                            }
-                        ]
+                            ]
+                        }
                     }
-            
                 ]
-            
-            
             }
-            
-            ####
-            
-            Before providing your json answer, check the following:
-            
-            Check the Supported Operations and Variable Types: Ensure the operations (op) used in your logic are supported by the system.
-            For example, if you are comparing a field that returns a boolean (Yes/No), use operations like is or is_not, and ensure that the constant value you compare with is also a boolean (true or false).
-            
-            Ensure Correct Data Types: Make sure the types of the constants (constant) in your conditions match the type of data that the field returns.
-            
-            Correct Structure of Logic Conditions: The vars array should have the correct structure and number of items as per the operation's requirements.
-            
-            Similarly, check and update other conditions in your logic section following the same principles. Make sure that the operations and the types of values in your conditions are compatible with each other and with the field types they reference.
-            
-            shape is never a valid field detail or option, never include it. Take your time, go slow, and produce only valid json.
-            ALWAYS Ensure that the ref values used in your logic section match exactly with the ref values defined in your fields.
-            ####
-            
-            You will be considered to have failed if your survey is less than 20 questions or if you return incomplete or invalid json.
-            Your survey should be at least 4000 words. Your Complete Json for the 20 question Survey Based on the Corpus:"""}],
-            
-            
-                  max_tokens=4000,
-                  temperature=0.2,
-                  response_format={ "type": "json_object" }
-            )
-            
-            
-            def replace_bool(match):
-                if match.group(0) == 'true':
-                    return 'True'
-                else:
-                    return 'False'
-            
-            gpt_json = response.choices[0].message.content
-            result = re.sub(r'\btrue\b|\bfalse\b', replace_bool, gpt_json)
     
-            json_object = json.loads(response.choices[0].message.content)
+        ]
     
     
+    }
     
+    ####
     
-            endpoint = 'https://api.typeform.com/forms'
-        
-            
-            def create_form(api_token, form_data):
-                """
-                Create a new form on Typeform using the provided API token and form data.
-            
-                Parameters:
-                api_token (str): Typeform API token for authentication.
-                form_data (dict): The data for the form to be created.
-            
-                Returns:
-                dict: JSON response containing the created form data.
-                """
-                endpoint = 'https://api.typeform.com/forms'
-                headers = {
-                    'Authorization': f'Bearer {api_token}',
-                    'Content-Type': 'application/json'
-                }
-            
+    Before providing your json answer, check the following:
+    
+    Check the Supported Operations and Variable Types: Ensure the operations (op) used in your logic are supported by the system.
+    For example, if you are comparing a field that returns a boolean (Yes/No), use operations like is or is_not, and ensure that the constant value you compare with is also a boolean (true or false).
+    
+    Ensure Correct Data Types: Make sure the types of the constants (constant) in your conditions match the type of data that the field returns.
+    
+    Correct Structure of Logic Conditions: The vars array should have the correct structure and number of items as per the operation's requirements.
+    
+    Similarly, check and update other conditions in your logic section following the same principles. Make sure that the operations and the types of values in your conditions are compatible with each other and with the field types they reference.
+    
+    shape is never a valid field detail or option, never include it. Take your time, go slow, and produce only valid json.
+    ALWAYS Ensure that the ref values used in your logic section match exactly with the ref values defined in your fields.
+    ####
+    
+    You will be considered to have failed if your survey is less than 20 questions or if you return incomplete or invalid json.
+    Your survey should be at least 4000 words. Your Complete Json for the 20 question Survey Based on the Corpus:"""}],
+    
+    
+          max_tokens=4000,
+          temperature=0.2,
+          response_format={ "type": "json_object" }
+    )
+
+    try:
+        json_object = json.loads(survey_text)
+    except json.JSONDecodeError as e:
+        # A long survey can run into max_tokens; keep what was complete and let prepare_form repair the rest
+        print(f"Survey JSON is invalid ({e}), salvaging the complete part")
+        json_object = salvage_json(survey_text)
+    return {'survey': json_object}
+
+
+# Local checks for the survey payload, so a bad ref or op is fixed before the POST instead of failing it
+TYPEFORM_FORMS_URL = 'https://api.typeform.com/forms'
+TYPEFORM_BANNED_KEYS = {'shape'}
+TYPEFORM_REF_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,255}$')
+TYPEFORM_BOOLEAN_OPS = {'is', 'is_not'}
+TYPEFORM_NUMBER_OPS = {'equal', 'not_equal', 'lower_than', 'lower_equal_than', 'greater_than', 'greater_equal_than'}
+TYPEFORM_TEXT_OPS = {'is', 'is_not', 'equal', 'not_equal', 'contains', 'not_contains', 'begins_with', 'ends_with'}
+TYPEFORM_DATE_OPS = {'on', 'not_on', 'earlier_than', 'earlier_than_or_on', 'later_than', 'later_than_or_on'}
+# Field type -> (ops its conditions may use, kind of value they compare against)
+TYPEFORM_FIELD_TYPES = {
+    'yes_no': (TYPEFORM_BOOLEAN_OPS, 'boolean'),
+    'legal': (TYPEFORM_BOOLEAN_OPS, 'boolean'),
+    'multiple_choice': (TYPEFORM_BOOLEAN_OPS, 'choice'),
+    'dropdown': (TYPEFORM_BOOLEAN_OPS, 'choice'),
+    'opinion_scale': (TYPEFORM_NUMBER_OPS, 'number'),
+    'rating': (TYPEFORM_NUMBER_OPS, 'number'),
+    'nps': (TYPEFORM_NUMBER_OPS, 'number'),
+    'number': (TYPEFORM_NUMBER_OPS, 'number'),
+    'short_text': (TYPEFORM_TEXT_OPS, 'text'),
+    'long_text': (TYPEFORM_TEXT_OPS, 'text'),
+    'email': (TYPEFORM_TEXT_OPS, 'text'),
+    'website': (TYPEFORM_TEXT_OPS, 'text'),
+    'phone_number': (TYPEFORM_TEXT_OPS, 'text'),
+    'date': (TYPEFORM_DATE_OPS, 'text'),
+    'statement': (set(), None),
+}
+TYPEFORM_TYPE_ALIASES = {'picture_choice': 'multiple_choice', 'boolean': 'yes_no', 'text': 'short_text', 'scale': 'opinion_scale', 'paragraph': 'long_text'}
+TYPEFORM_OP_ALIASES = {'is': 'equal', 'is_not': 'not_equal', 'equal': 'is', 'not_equal': 'is_not', 'equals': 'is', 'not_equals': 'is_not', 'less_than': 'lower_than', 'less_equal_than': 'lower_equal_than'}
+TYPEFORM_ACTIONS = {'jump', 'add', 'subtract', 'multiply', 'divide', 'set'}
+TYPEFORM_STEPS = {'opinion_scale': (5, 11), 'rating': (3, 10)}
+TYPEFORM_REPAIR_WORKERS = 4
+
+class FormIssue(NamedTuple):
+    kind: str        # 'form', 'fields' or 'logic'
+    index: int       # Position in form[kind]; None for form level issues
+    message: str
+
+def slugify_ref(text):
+    """ Make a title or label usable as a Typeform ref """
+    return re.sub(r'[^a-z0-9]+', '_', str(text).lower()).strip('_')[:255] or 'ref'
+
+def unique_ref(ref, taken):
+    candidate, suffix = ref, 2
+    while candidate in taken:
+        candidate = f"{ref[:250]}_{suffix}"
+        suffix += 1
+    taken.add(candidate)
+    return candidate
+
+def salvage_json(text):
+    """
+    Parse a JSON object that was cut off, keeping every complete value and closing the open objects and arrays.
+    Raises ValueError if nothing can be recovered.
+    """
+    start = text.find('{')
+    if start == -1:
+        raise ValueError("The survey response has no JSON object")
+    closers = []
+    cut = None  # (end of the text to keep, closers to append)
+    in_string = escaped = False
+    for position in range(start, len(text)):
+        char = text[position]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if not closers:
+                break
+            closers.pop()
+            if not closers:
+                return json.loads(text[start:position + 1])
+            cut = (position + 1, ''.join(reversed(closers)))
+        elif char == ',':
+            cut = (position, ''.join(reversed(closers)))
+    if cut is None:
+        raise ValueError("The survey response has no complete JSON values")
+    return json.loads(text[start:cut[0]] + cut[1])
+
+def strip_banned_keys(value):
+    """ Recursively drop the keys Typeform rejects, like shape """
+    if isinstance(value, dict):
+        return {key: strip_banned_keys(item) for key, item in value.items() if key not in TYPEFORM_BANNED_KEYS}
+    if isinstance(value, list):
+        return [strip_banned_keys(item) for item in value]
+    return value
+
+def coerce_condition_value(value, kind):
+    """ Convert a condition constant to the kind of value its field returns, or None if it can't be """
+    if kind == 'boolean':
+        if isinstance(value, bool):
+            return value
+        return {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}.get(str(value).strip().lower())
+    if kind == 'number':
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        try:
+            number = float(str(value).strip())
+        except ValueError:
+            return None
+        return int(number) if number.is_integer() else number
+    if kind == 'text':
+        return value if isinstance(value, str) else str(value)
+    return value
+
+def form_refs(form):
+    """ Field refs mapped to their fields, and the thank you screen refs """
+    fields = {field['ref']: field for field in form.get('fields', []) if isinstance(field, dict) and field.get('ref')}
+    screens = {screen['ref'] for screen in form.get('thankyou_screens', []) if isinstance(screen, dict) and screen.get('ref')}
+    return fields, screens
+
+def resolve_ref(value, refs, titles=None):
+    """ Match a ref the model wrote to an existing ref, allowing for case, spacing and field titles """
+    if value in refs:
+        return value
+    slug = slugify_ref(value)
+    for ref in refs:
+        if slugify_ref(ref) == slug:
+            return ref
+    for ref, title in (titles or {}).items():
+        if slugify_ref(title) == slug:
+            return ref
+    return None
+
+def repair_field(field, taken_refs):
+    """ Fix what can be fixed in one field in place """
+    field_type = str(field.get('type', '')).strip().lower().replace(' ', '_').replace('-', '_')
+    field['type'] = TYPEFORM_TYPE_ALIASES.get(field_type, field_type)
+    ref = field.get('ref')
+    if not isinstance(ref, str) or not TYPEFORM_REF_PATTERN.match(ref) or ref in taken_refs:
+        ref = slugify_ref(ref or field.get('title', 'field'))
+    field['ref'] = unique_ref(ref, taken_refs)
+    properties = field.get('properties')
+    if field['type'] in ('multiple_choice', 'dropdown') and isinstance(properties, dict):
+        choices = []
+        choice_refs = set()
+        for choice in properties.get('choices') or []:
+            label = choice.get('label') if isinstance(choice, dict) else choice
+            if isinstance(label, (str, int, float)) and str(label).strip():
+                choice_ref = choice.get('ref') if isinstance(choice, dict) and isinstance(choice.get('ref'), str) else slugify_ref(label)
+                # Picture choice attachments are dropped along with the type
+                choices.append({'label': str(label), 'ref': unique_ref(choice_ref, choice_refs)})
+        properties['choices'] = choices
+    if field['type'] in TYPEFORM_STEPS and isinstance(properties, dict) and 'steps' in properties:
+        low, high = TYPEFORM_STEPS[field['type']]
+        steps = coerce_condition_value(properties['steps'], 'number')
+        properties['steps'] = min(max(int(steps), low), high) if steps is not None else high
+    validations = field.get('validations')
+    if isinstance(validations, dict) and 'required' in validations:
+        required = coerce_condition_value(validations['required'], 'boolean')
+        validations['required'] = bool(required)
+    return field
+
+def repair_condition(condition, fields, titles):
+    """ Fix refs, ops and constant types in one logic condition, returning the repaired condition """
+    if not isinstance(condition, dict) or not condition.get('op'):
+        return {'op': 'always', 'vars': []}
+    op = str(condition['op']).strip().lower()
+    condition['op'] = op
+    variables = condition.get('vars') if isinstance(condition.get('vars'), list) else []
+    if op == 'always':
+        condition['vars'] = []
+        return condition
+    if op in ('and', 'or'):
+        condition['vars'] = [repair_condition(variable, fields, titles) for variable in variables]
+        return condition
+    field = None
+    for variable in variables:
+        if isinstance(variable, dict) and variable.get('type') == 'field':
+            variable['value'] = resolve_ref(variable.get('value'), fields, titles) or variable.get('value')
+            field = fields.get(variable['value'])
+    if field is None or field.get('type') not in TYPEFORM_FIELD_TYPES:
+        condition['vars'] = variables
+        return condition
+    ops, kind = TYPEFORM_FIELD_TYPES[field['type']]
+    if op not in ops and TYPEFORM_OP_ALIASES.get(op) in ops:
+        condition['op'] = TYPEFORM_OP_ALIASES[op]
+    choices = (field.get('properties') or {}).get('choices') or []
+    for variable in variables:
+        if not isinstance(variable, dict) or variable.get('type') == 'field':
+            continue
+        if kind == 'choice':
+            # Conditions on choice fields compare against choice refs, but models usually write the label
+            wanted = slugify_ref(variable.get('value'))
+            for choice in choices:
+                if wanted in (slugify_ref(choice['label']), slugify_ref(choice['ref'])):
+                    variable['type'], variable['value'] = 'choice', choice['ref']
+        elif variable.get('type') == 'constant':
+            coerced = coerce_condition_value(variable.get('value'), kind)
+            if coerced is not None:
+                variable['value'] = coerced
+    condition['vars'] = variables
+    return condition
+
+def repair_logic(logic, fields, screens, titles):
+    """ Fix what can be fixed in one logic block in place """
+    logic.setdefault('type', 'field')
+    if logic.get('type') == 'field':
+        logic['ref'] = resolve_ref(logic.get('ref'), fields, titles) or logic.get('ref')
+    for action in logic.get('actions') or []:
+        if not isinstance(action, dict):
+            continue
+        action['action'] = str(action.get('action', 'jump')).strip().lower()
+        target = (action.get('details') or {}).get('to')
+        if action['action'] == 'jump' and isinstance(target, dict):
+            field_ref = resolve_ref(target.get('value'), fields, titles)
+            screen_ref = resolve_ref(target.get('value'), screens)
+            if field_ref is not None:
+                target['type'], target['value'] = 'field', field_ref
+            elif screen_ref is not None:
+                target['type'], target['value'] = 'thankyou', screen_ref
+        action['condition'] = repair_condition(action.get('condition'), fields, titles)
+    return logic
+
+def repair_form(form):
+    """ Apply every automatic fix to a survey payload, returning the repaired copy """
+    form = strip_banned_keys(form if isinstance(form, dict) else {})
+    if not str(form.get('title', '')).strip():
+        form['title'] = 'Survey'
+    taken_refs = set()
+    form['fields'] = [repair_field(field, taken_refs) for field in form.get('fields') or [] if isinstance(field, dict)]
+    screen_refs = set()
+    for screen in form.get('thankyou_screens') or []:
+        if isinstance(screen, dict):
+            screen['ref'] = unique_ref(slugify_ref(screen.get('ref') or screen.get('title', 'thank_you')), screen_refs)
+    fields, screens = form_refs(form)
+    titles = {ref: field.get('title', '') for ref, field in fields.items()}
+    form['logic'] = [repair_logic(logic, fields, screens, titles) for logic in form.get('logic') or [] if isinstance(logic, dict)]
+    return form
+
+def check_condition(condition, fields, path):
+    """ Problems with one logic condition, as strings """
+    op = condition.get('op') if isinstance(condition, dict) else None
+    variables = condition.get('vars') if isinstance(condition, dict) else None
+    if not op or not isinstance(variables, list):
+        return [f"{path} needs an op and a vars list"]
+    if op == 'always':
+        return [] if not variables else [f"{path} op always takes no vars"]
+    if op in ('and', 'or'):
+        if len(variables) < 2:
+            return [f"{path} op {op} needs at least two conditions"]
+        return [problem for position, variable in enumerate(variables) for problem in check_condition(variable, fields, f"{path}.vars[{position}]")]
+    field_vars = [variable for variable in variables if isinstance(variable, dict) and variable.get('type') == 'field']
+    value_vars = [variable for variable in variables if isinstance(variable, dict) and variable.get('type') != 'field']
+    if len(field_vars) != 1 or len(value_vars) != 1:
+        return [f"{path} op {op} needs one field var and one value var"]
+    field = fields.get(field_vars[0].get('value'))
+    if field is None:
+        return [f"{path} refers to unknown field {field_vars[0].get('value')!r}"]
+    ops, kind = TYPEFORM_FIELD_TYPES.get(field['type'], (set(), None))
+    if op not in ops:
+        return [f"{path} op {op} is not supported for {field['type']} field {field['ref']!r}"]
+    value = value_vars[0]
+    if kind == 'choice':
+        choice_refs = {choice['ref'] for choice in (field.get('properties') or {}).get('choices') or []}
+        if value.get('type') != 'choice' or value.get('value') not in choice_refs:
+            return [f"{path} must compare {field['ref']!r} against one of its choice refs"]
+    elif value.get('type') != 'constant' or coerce_condition_value(value.get('value'), kind) != value.get('value'):
+        return [f"{path} must compare {field['ref']!r} against a {kind} constant"]
+    return []
+
+def validate_form(form):
+    """
+    Check a survey payload against the parts of the Typeform create form schema the model gets wrong.
+
+    Parameters:
+    form (dict): The form payload.
+
+    Returns:
+    list: FormIssues; empty if the payload is valid.
+    """
+    issues = []
+    if not isinstance(form, dict):
+        return [FormIssue('form', None, 'The payload is not a JSON object')]
+    if not str(form.get('title', '')).strip():
+        issues.append(FormIssue('form', None, 'The form needs a title'))
+    if not form.get('fields'):
+        issues.append(FormIssue('form', None, 'The form needs at least one field'))
+    if json.dumps(form).find('"shape"') != -1:
+        issues.append(FormIssue('form', None, 'shape is not a valid key'))
+    seen_refs = set()
+    for index, field in enumerate(form.get('fields') or []):
+        if not isinstance(field, dict):
+            issues.append(FormIssue('fields', index, 'The field is not a JSON object'))
+            continue
+        problems = [f"missing {key}" for key in ('title', 'ref', 'type') if not field.get(key)]
+        if field.get('type') and field['type'] not in TYPEFORM_FIELD_TYPES:
+            problems.append(f"type {field['type']!r} is not supported")
+        ref = field.get('ref')
+        if ref and (not isinstance(ref, str) or not TYPEFORM_REF_PATTERN.match(ref)):
+            problems.append(f"ref {ref!r} is not a valid ref")
+        elif ref in seen_refs:
+            problems.append(f"ref {ref!r} is used by more than one field")
+        seen_refs.add(ref)
+        if field.get('type') in ('multiple_choice', 'dropdown') and not (field.get('properties') or {}).get('choices'):
+            problems.append("a choice field needs properties.choices")
+        issues.extend(FormIssue('fields', index, f"fields[{index}] {problem}") for problem in problems)
+    fields, screens = form_refs(form)
+    for index, logic in enumerate(form.get('logic') or []):
+        path = f"logic[{index}]"
+        problems = []
+        if not isinstance(logic, dict):
+            problems.append(f"{path} is not a JSON object")
+        elif logic.get('type') == 'field' and logic.get('ref') not in fields:
+            problems.append(f"{path} refers to unknown field {logic.get('ref')!r}")
+        elif not logic.get('actions'):
+            problems.append(f"{path} needs actions")
+        else:
+            for position, action in enumerate(logic['actions']):
+                action_path = f"{path}.actions[{position}]"
+                if not isinstance(action, dict) or action.get('action') not in TYPEFORM_ACTIONS:
+                    problems.append(f"{action_path} needs an action from {sorted(TYPEFORM_ACTIONS)}")
+                    continue
+                target = (action.get('details') or {}).get('to')
+                if action['action'] == 'jump':
+                    if not isinstance(target, dict):
+                        problems.append(f"{action_path} jump needs details.to")
+                    elif not ((target.get('type') == 'field' and target.get('value') in fields)
+                              or (target.get('type') == 'thankyou' and target.get('value') in screens)):
+                        problems.append(f"{action_path} jumps to unknown {target.get('type')} {target.get('value')!r}")
+                elif not {'target', 'value'} <= set(action.get('details') or {}):
+                    problems.append(f"{action_path} {action['action']} needs details.target and details.value")
+                problems.extend(check_condition(action.get('condition'), fields, f"{action_path}.condition"))
+        issues.extend(FormIssue('logic', index, problem) for problem in problems)
+    return issues
+
+def typeform_error_issues(response):
+    """ Turn the details of a rejected create form request into FormIssues """
+    try:
+        details = response.json().get('details') or []
+    except ValueError:
+        return []
+    issues = []
+    for detail in details:
+        # Typeform points at the bad value with a JSON pointer like /logic/3/actions/0/condition
+        parts = str(detail.get('field', '')).strip('/').split('/')
+        message = detail.get('description') or detail.get('code') or 'rejected by Typeform'
+        if len(parts) >= 2 and parts[0] in ('fields', 'logic') and parts[1].isdigit():
+            issues.append(FormIssue(parts[0], int(parts[1]), f"{parts[0]}[{parts[1]}] {message}"))
+        else:
+            issues.append(FormIssue('form', None, message))
+    return issues
+
+def regenerate_form_fragment(form, kind, index, problems):
+    """ Ask the model to fix one broken field or logic block, returning the new fragment or None """
+    fields = [{'ref': field.get('ref'), 'type': field.get('type'), 'title': field.get('title'),
+               'choices': [choice.get('ref') for choice in (field.get('properties') or {}).get('choices') or []]}
+              for field in form.get('fields', [])]
+    _, screens = form_refs(form)
+    fragment = json.dumps(form[kind][index])
+    prompt = (f"This {'field' if kind == 'fields' else 'logic block'} from a Typeform create form request is invalid:\n{fragment}\n"
+              f"Problems:\n" + "\n".join(problems) + "\n"
+              f"Fields in the form (ref, type, title, choice refs): {json.dumps(fields)}\n"
+              f"Thank you screen refs: {sorted(screens)}\n"
+              f"Supported field types and the ops their conditions may use: {json.dumps({name: sorted(ops) for name, (ops, _) in TYPEFORM_FIELD_TYPES.items()})}\n"
+              "Conditions on choice fields compare against {\"type\": \"choice\", \"value\": <choice ref>}. shape is never a valid key.\n"
+              "Return only the corrected fragment as a single JSON object.")
+    try:
+        repaired = json.loads(cached_chat_completion("survey", estimate_tokens(prompt) + 1000,
+            model="gpt-3.5-turbo-1106",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=1000,
+            temperature=0,
+            response_format={"type": "json_object"}
+        ))
+    except (openai.OpenAIError, json.JSONDecodeError) as e:
+        print(f"Could not regenerate {kind}[{index}]: {e}")
+        return None
+    # The model sometimes wraps the fragment in a single key
+    if isinstance(repaired, dict) and len(repaired) == 1 and isinstance(next(iter(repaired.values())), dict):
+        repaired = next(iter(repaired.values()))
+    return repaired if isinstance(repaired, dict) else None
+
+def prepare_form(form, issues=()):
+    """
+    Repair a survey payload locally, regenerating only the fragments that can't be fixed and
+    dropping any that still fail.
+
+    Parameters:
+    form (dict): The survey payload from the model.
+    issues (list): Extra FormIssues to fix, like the ones Typeform returned for an earlier attempt.
+
+    Returns:
+    dict: A payload that passes validate_form.
+    """
+    form = repair_form(form)
+    flagged = {(issue.kind, issue.index) for issue in issues if issue.kind != 'form'}
+    issues = list(issues) + validate_form(form)
+    broken = {}
+    for issue in issues:
+        if issue.kind != 'form' and issue.index < len(form.get(issue.kind, [])):
+            broken.setdefault((issue.kind, issue.index), []).append(issue.message)
+    if broken:
+        print(f"Regenerating {len(broken)} broken survey fragments: {sorted(broken)}")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=TYPEFORM_REPAIR_WORKERS) as executor:
+            futures = {key: executor.submit(regenerate_form_fragment, form, *key, problems) for key, problems in broken.items()}
+        for (kind, index), future in futures.items():
+            if future.result() is not None:
+                form[kind][index] = future.result()
+        # Local checks can't see what Typeform objected to, so those fragments go if they weren't regenerated
+        unresolved = {key for key, future in futures.items() if key in flagged and future.result() is None}
+        for kind in ('fields', 'logic'):
+            form[kind] = [item for index, item in enumerate(form.get(kind, [])) if (kind, index) not in unresolved]
+        form = repair_form(form)
+    # Whatever is still broken is dropped; dropping a field can orphan logic, so check again
+    for _ in range(3):
+        issues = validate_form(form)
+        dropped = {(issue.kind, issue.index) for issue in issues if issue.kind != 'form'}
+        if not dropped:
+            break
+        print(f"Dropping survey fragments that are still invalid: {sorted(dropped)}")
+        for kind in ('fields', 'logic'):
+            form[kind] = [item for index, item in enumerate(form.get(kind, [])) if (kind, index) not in dropped]
+    if issues:
+        raise ValueError(f"The survey could not be repaired: {[issue.message for issue in issues]}")
+    return form
+
+
+def create_form(api_token, form_data):
+    """
+    Create a new form on Typeform using the provided API token and form data.
+
+    Parameters:
+    api_token (str): Typeform API token for authentication.
+    form_data (dict): The data for the form to be created.
+
+    Returns:
+    requests.Response: The Typeform response. On success the form URL is in its Location header.
+    """
+    headers = {
+        'Authorization': f'Bearer {api_token}',
+        'Content-Type': 'application/json'
+    }
+    return requests.post(TYPEFORM_FORMS_URL, json=form_data, headers=headers)
+
+def typeform_stage(survey):
+    try:
+        form = prepare_form(survey)
+    except ValueError as e:
+        # A broken survey shouldn't cost the article, so the run carries on without a form
+        print(e)
+        return {'form_response': None}
+    response = create_form(api_token, form)
+    if response.status_code == 400:
+        # One more targeted repair with the fragments Typeform pointed at
+        issues = typeform_error_issues(response)
+        print(f"Typeform rejected the survey: {[issue.message for issue in issues]}")
+        try:
+            response = create_form(api_token, prepare_form(form, issues))
+        except ValueError as e:
+            print(e)
+    return {'form_response': response}
+
+
+PIPELINE_STAGES = [
+    Stage('scrape', scrape_stage, ('query', 'num_articles', 'max_sources'), ('articles', 'merged_links', 'source_scores')),
+    Stage('upload', upload_stage, ('articles',), streams=('uploads',)),
+    Stage('analyze', analyze_stage, ('uploads', 'query', 'checkpoint'), ('full_notes', 'uploaded_file_ids', 'notes_index')),
+    Stage('compact', compact_stage, ('full_notes', 'uploaded_file_ids', 'notes_index'), ('facts_df', 'compact_corpus', 'writing_index', 'outline_file_ids')),
+    Stage('outline', outline_stage, ('query', 'outline_file_ids'), ('outline', 'df_outline', 'final_outline')),
+    Stage('write', write_stage, ('query', 'final_outline', 'writing_index', 'type_of_writer', 'style', 'ui', 'checkpoint'), ('article_path',), main_thread=True),
+    # The ZIP is a temporary file, so it is rebuilt rather than checkpointed
+    Stage('export', export_stage, ('outline', 'article_path', 'full_notes', 'df_outline', 'articles', 'compact_corpus'), ('bundle',), checkpoint=False),
+    # The survey only needs the notes, so it is written while the outline and article are.
+    # It is a side product, so its failures never cost the article
+    Stage('survey', survey_stage, ('compact_corpus', 'full_notes'), ('survey',), optional=True),
+    Stage('typeform', typeform_stage, ('survey',), ('form_response',), optional=True),
+]
+
+# Progress bar position once each stage on the path to the article finishes
+STAGE_PROGRESS = {'scrape': 10, 'upload': 30, 'compact': 60, 'outline': 70, 'export': 95}
+
+
+def main():
+
+    st.title("Automated Content Creation Pipeline - Information Gain")
+    query = st.text_input("Enter your query", "2023 Israel Hamas War Timeline")
+    num_articles = st.text_input("How Many Pages of Search Results Should We Use for Research?", 1)
+    type_of_writer = st.text_input("What Type of Writer Should We Simulate?", "NYTimes Journalist")
+    style = st.text_input("What Style or Voice Shoule We Adhere To?", "Professional and actionable.")
+    max_sources = st.text_input("Maximum Number of Sources to Analyze (0 for no limit)", 10)
+    fresh_run = st.checkbox("Start over instead of resuming an unfinished run with these settings")
     
-                response = requests.post(endpoint, json=form_data, headers=headers)
-                st.write(response)
-                st.write(response.content)
-                if response.status_code == 201:
-                    # Extract the URL from the 'Location' header of the response
-                    form_url = response.headers.get('Location', None)
-                
-                    if form_url:
-                        st.write("Form URL:", form_url)
+    # Initialize session state for processing
+    if 'process_started' not in st.session_state:
+        st.session_state.process_started = False
+
+      
+    if st.button("Start Research"):
+        st.session_state.process_started = True
+
+        if st.session_state.process_started:
+            ui = StreamlitUI()
+            ui.status('Scraping articles...')
+
+            def on_stage_done(name, values):
+                if name == 'scrape':
+                    if values['merged_links']:
+                        st.write(f"Merged {sum(len(links) for links in values['merged_links'].values())} duplicate articles:", values['merged_links'])
+                    st.write(f"Selected {len(values['articles'])} sources by information gain:", values['source_scores'])
+                    ui.status(f"Uploading and analyzing {len(values['articles'])} articles...")
+                elif name == 'compact':
+                    ui.status('Analysis completed! Now generating the outline.')
+                elif name == 'outline':
+                    ui.status('Outline generation concluded. Now Writing Full Article.')
+                elif name == 'export':
+                    # st.download_button only takes bytes-like data, not the spooled file
+                    with values['bundle'] as bundle:
+                        st.download_button(
+                            label="Download ZIP",
+                            data=bundle.read(),
+                            file_name="All_Results.zip",
+                            mime="application/zip"
+                        )
+                    print('Successfully created All_Results.zip')
+                elif name == 'typeform':
+                    response = values['form_response']
+                    if response is None:
+                        st.write("The survey could not be repaired, so no form was created.")
+                    elif response.status_code == 201:
+                        # Extract the URL from the 'Location' header of the response
+                        form_url = response.headers.get('Location', None)
+                        if form_url:
+                            st.write("Form URL:", form_url)
+                        else:
+                            st.write("Form URL not found in the response.")
                     else:
-                        st.write("Form URL not found in the response.")
-                else:
-                    st.write("Failed to create form. Status code:", response.status_code)
-                        
-            
-            created_form = create_form(api_token, json_object)
-            progress.progress(95)
-                # Create a buffer in memory for the ZIP file
-            buffer = io.BytesIO()
-        
-            # Create a zip archive in the buffer
-            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                # Save the outline string as a text file and add to the zip archive
-                outline_file_name = 'Final_Outline.txt'
-                save_string_to_file(str(outline), outline_file_name)
-                zipf.write(outline_file_name, outline_file_name)
-        
-                # Save the final article
-                final_article_file_name = 'Final_Article.txt'
-                save_string_to_file(str(final_article), final_article_file_name)
-                zipf.write(final_article_file_name, final_article_file_name)
-        
-                # Save the full notes as a CSV file and add to the zip archive
-                full_notes_file_name = 'Full_Notes.csv'
-                save_bytes_to_file(aggregate_notes_csv_bytes, full_notes_file_name)
-                zipf.write(full_notes_file_name, full_notes_file_name)
-        
-                # Save the all outlines as a CSV file and add to the zip archive
-                all_outlines_file_name = 'All_Outlines.csv'
-                save_bytes_to_file(all_outlines_csv_bytes, all_outlines_file_name)
-                zipf.write(all_outlines_file_name, all_outlines_file_name)
-        
-            # Move the buffer's pointer to the beginning after writing
-            buffer.seek(0)
-        
-        progress.progress(99)
+                        st.write("Failed to create form. Status code:", response.status_code)
+                        st.write(response.content)
+                if name in STAGE_PROGRESS:
+                    ui.progress(STAGE_PROGRESS[name])
+
+            run_inputs = {
+                'query': query,
+                'num_articles': num_articles,
+                'max_sources': max_sources,
+                'type_of_writer': type_of_writer,
+                'style': style,
+            }
+            # A run that failed or was interrupted picks up from its last finished stage
+            checkpoint = open_checkpoint(run_inputs, fresh_run)
+            pipeline = Pipeline(PIPELINE_STAGES)
+            pipeline.run(dict(run_inputs, ui=ui), on_stage_done=on_stage_done, checkpoint=checkpoint)
+            for name, reason in pipeline.skipped.items():
+                st.write(f"Skipped {name}: {reason}")
+            checkpoint.finish()
+            ui.progress(99)
       
         st.session_state.process_started = False
-        if not session_state.process_started:
-
-            btn = st.download_button(
-                label="Download ZIP",
-                data=buffer,
-                file_name="All_Results.zip",
-                mime="application/zip"
-            )
     
+        ui.status("Research, outline, and final article generation completed successfully.")
 
-        
+# Headless batch mode: python -m app run --queries queries.txt
+BATCH_CONCURRENCY = 2  # Queries in flight; they share the caches and the OpenAI rate limits
+BATCH_OUTPUT_DIR = "output"
+SURVEY_STAGES = {'survey', 'typeform'}
 
-        print('Successfully created All_Results.zip')
-    
-        status.text("Research, outline, and final article generation completed successfully.")
+def read_queries(path):
+    """ One query per line; blank lines and lines starting with # are skipped """
+    with open(path, encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip() and not line.lstrip().startswith('#')]
 
-if __name__ == "__main__":
-    main()
+def run_query(position, query, output_dir, stages, settings, fresh=False):
+    """ Run the whole pipeline for one query and save its results bundle, returning a summary row """
+    started = time.time()
+    row = {'query': query, 'status': 'ok', 'sources': 0, 'bundle': '', 'form_url': '', 'skipped': ''}
+    try:
+        run_inputs = dict(settings, query=query)
+        checkpoint = open_checkpoint(run_inputs, fresh)
+        pipeline = Pipeline(stages)
+        values = pipeline.run(dict(run_inputs, ui=ConsoleUI(f"[{query}] ")), checkpoint=checkpoint)
+        row['sources'] = len(values['articles'])
+        row['skipped'] = ', '.join(pipeline.skipped)
+        row['bundle'] = os.path.join(output_dir, f"{position:03d}_{safe_filename(query).replace(' ', '_')[:80]}.zip")
+        with values['bundle'] as bundle, open(row['bundle'], 'wb') as file:
+            shutil.copyfileobj(bundle, file)
+        form_response = values.get('form_response')
+        if form_response is not None and form_response.status_code == 201:
+            row['form_url'] = form_response.headers.get('Location', '')
+        checkpoint.finish()
+    except Exception as e:
+        # One bad query shouldn't stop the rest of the batch
+        print(f"Query {query!r} failed: {e}")
+        row['status'] = f"failed: {e}"
+    row['seconds'] = round(time.time() - started, 1)
+    return row
+
+def run_batch(queries, output_dir=BATCH_OUTPUT_DIR, concurrency=BATCH_CONCURRENCY, skip_survey=False, fresh=False, **settings):
+    """
+    Write an article for every query without Streamlit.
+
+    Parameters:
+    queries (list): The queries.
+    output_dir (str): Where each query's ZIP bundle and summary.csv are written.
+    concurrency (int): Queries in flight at once.
+    skip_survey (bool): Leave out the survey and Typeform stages.
+    fresh (bool): Start every query over instead of resuming its unfinished run.
+    settings: num_articles, max_sources, type_of_writer and style, as in the Streamlit form.
+
+    Returns:
+    pandas.DataFrame: One summary row per query.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Runs are keyed by their inputs, so a repeated query would share a run directory with the first one
+    unique_queries = list(dict.fromkeys(queries))
+    if len(unique_queries) < len(queries):
+        print(f"Skipping {len(queries) - len(unique_queries)} duplicate queries")
+    queries = unique_queries
+    stages = [stage for stage in PIPELINE_STAGES if not (skip_survey and stage.name in SURVEY_STAGES)]
+    started = time.time()
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_query, position, query, output_dir, stages, settings, fresh) for position, query in enumerate(queries, start=1)]
+        for future in concurrent.futures.as_completed(futures):
+            rows.append(future.result())
+            written = sum(row['status'] == 'ok' for row in rows)
+            hours = (time.time() - started) / 3600
+            print(f"{len(rows)}/{len(queries)} queries done, {written} articles written ({written / hours:.1f} articles/hour)")
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(output_dir, 'summary.csv'), index=False)
+    return summary
+
+# Offline benchmark: python -m app bench runs the real pipeline against local fakes of SerpAPI,
+# the article hosts, OpenAI and Typeform, so scheduling and parsing regressions show up before deploy
+BENCH_SIZES = (10, 100, 1000)
+BENCH_QUERY = "benchmark query"
+# Median seconds per request to each fake; actual latencies are log-normal around these
+BENCH_LATENCY = {'serp': 0.5, 'article': 0.2, 'api': 0.05, 'run': 2.0, 'chat': 1.0, 'image': 3.0, 'download': 0.1, 'typeform': 0.3}
+BENCH_LATENCY_SPREAD = 0.5
+BENCH_ARTICLE_WORDS = 800
+BENCH_TOPIC_WORDS = 100
+BENCH_NOTE_FACTS = 40
+BENCH_OUTLINE_SECTIONS = 6
+BENCH_SECTION_WORDS = 600
+BENCH_SURVEY_QUESTIONS = 20
+BENCH_STREAM_CHUNKS = 20
+BENCH_IMAGE_BYTES = 100_000
+# Plenty of stopwords, so newspaper's paragraph scoring keeps the synthetic text
+BENCH_WORDS = ("the of and to in is that for it as with was on be by this are from at or an which have not has but "
+               "they their were been will would there also more than about into after over its new said city council "
+               "river water energy market policy school health budget report study data growth climate transport "
+               "housing court election museum festival harbour railway factory farmers workers research hospital").split()
+# Stage -> (output, unit) counted for the throughput column
+BENCH_STAGE_ITEMS = {'scrape': ('articles', 'articles'), 'upload': ('uploads', 'uploads'), 'analyze': ('full_notes', 'notes'),
+                     'compact': ('facts_df', 'facts')}
+
+class FakeService:
+    """ Latency and failure injection shared by the benchmark fakes """
+    def __init__(self, latency_scale=1.0, failure_rate=0.0, seed=0):
+        self.latency_scale = latency_scale
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, service):
+        with self.lock:
+            return BENCH_LATENCY[service] * self.latency_scale * self.random.lognormvariate(0, BENCH_LATENCY_SPREAD)
+
+    def wait(self, service):
+        time.sleep(self.delay(service))
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+def synthetic_sentences(rng, words, vocabulary=BENCH_WORDS):
+    """ Roughly `words` words of capitalised, full-stopped filler """
+    sentences = []
+    while words > 0:
+        length = rng.randint(8, 16)
+        sentences.append(' '.join(rng.choices(vocabulary, k=length)).capitalize() + '.')
+        words -= length
+    return sentences
+
+def synthetic_article_html(number, seed=0):
+    rng = random.Random(f"{seed}-article-{number}")
+    # Every article gets its own topic words, or source selection would find nothing new after the first
+    topic = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(4, 9))) for _ in range(BENCH_TOPIC_WORDS)]
+    sentences = synthetic_sentences(rng, BENCH_ARTICLE_WORDS, BENCH_WORDS + topic)
+    paragraphs = ''.join(f"<p>{' '.join(sentences[i:i + 5])}</p>" for i in range(0, len(sentences), 5))
+    return (f"<html><head><title>Synthetic article {number}</title></head><body>"
+            f"<article><h1>Synthetic article {number}</h1>{paragraphs}</article></body></html>")
+
+class FakeHostHandler(http.server.BaseHTTPRequestHandler):
+    """ Article hosts, the image CDN and Typeform for the benchmark, all on one local server """
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path.startswith('/image/'):
+            service.wait('download')
+            self._send(200, self.server.image_bytes, 'image/png')
+        elif self.path.startswith('/article/'):
+            service.wait('article')
+            if service.fails():
+                self._send(503, b'Service Unavailable', 'text/plain')
+                return
+            html = synthetic_article_html(int(self.path.rsplit('/', 1)[1]), self.server.seed)
+            self._send(200, html.encode('utf-8'), 'text/html; charset=utf-8')
+        else:
+            self._send(404, b'Not Found', 'text/plain')
+
+    def do_POST(self):
+        service = self.server.service
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        service.wait('typeform')
+        if self.path != '/forms':
+            self._send(404, b'Not Found', 'text/plain')
+        elif service.fails():
+            self._send(500, b'{"code": "INTERNAL_ERROR"}', 'application/json')
+        else:
+            form_id = f"bench{next(self.server.form_ids)}"
+            self._send(201, json.dumps({'id': form_id}).encode('utf-8'), 'application/json',
+                       {'Location': f"http://{self.headers['Host']}/forms/{form_id}"})
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_hosts(service, seed=0):
+    """ Serve FakeHostHandler from a background thread on a free local port """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeHostHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.seed = seed
+    server.image_bytes = random.Random(seed).randbytes(BENCH_IMAGE_BYTES)
+    server.form_ids = itertools.count(1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_fake_google_search(base_url, size, service):
+    """ A GoogleSearch stand-in returning `size` results that link to the fake article hosts """
+    class FakeGoogleSearch:
+        def __init__(self, params):
+            self.params = params
 
+        def get_dict(self):
+            service.wait('serp')
+            if service.fails():
+                return {"error": "Fake SerpAPI failure"}
+            start = int(self.params.get('start', 0))
+            return {"organic_results": [
+                {"position": number + 1, "title": f"Synthetic article {number}", "link": f"{base_url}/article/{number}",
+                 "snippet": f"Snippet of synthetic article {number}"}
+                for number in range(start, min(start + 10, size))]}
+    return FakeGoogleSearch
 
+class FakeOpenAI:
+    """
+    In-process stand-in for the parts of openai.Client the pipeline uses. Failures are only injected
+    where the pipeline recovers from them: scheduled requests raise APIConnectionError and runs fail.
+    """
+    def __init__(self, service, base_url, seed=0):
+        self.service = service
+        self.base_url = base_url
+        self.seed = seed
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.file_links = {}  # File ID -> source link of uploaded articles
+        self.threads = {}     # Thread ID -> messages, newest last
+        self.runs = {}        # Run ID -> {'thread_id', 'due', 'status', 'done'}
+        ns = types.SimpleNamespace
+        self.files = ns(create=self.create_file, retrieve=self.retrieve_file)
+        self.beta = ns(
+            assistants=ns(create=self.create_assistant, retrieve=self.retrieve_assistant),
+            threads=ns(create=self.create_thread,
+                       messages=ns(create=self.create_message, list=self.list_messages),
+                       runs=ns(create=self.create_run, retrieve=self.retrieve_run, cancel=self.cancel_run)))
+        self.chat = ns(completions=ns(create=self.create_completion))
+        self.images = ns(generate=self.generate_image)
 
+    def _id(self, prefix):
+        return f"{prefix}{next(self.ids)}"
 
+    def _request(self):
+        """ Latency and, sometimes, a retryable failure for one scheduled request """
+        self.service.wait('api')
+        if self.service.fails():
+            raise openai.APIConnectionError(request=None)
 
+    def _rng(self, *key):
+        return random.Random('-'.join(str(part) for part in (self.seed,) + key))
 
+    def create_file(self, file, purpose):
+        self._request()
+        filename, data = file
+        content = data.read().decode('utf-8', errors='replace')
+        file_id = self._id('file-')
+        link = re.search(r'https?://\S+', content)
+        with self.lock:
+            self.file_links[file_id] = link.group(0) if link else None
+        return types.SimpleNamespace(id=file_id, filename=filename, bytes=len(content), purpose=purpose)
 
+    def retrieve_file(self, file_id):
+        self._request()
+        with self.lock:
+            link = self.file_links.get(file_id)
+        return types.SimpleNamespace(id=file_id, filename=f"{safe_filename(link or file_id)}.txt")
 
+    def create_assistant(self, **kwargs):
+        self.service.wait('api')
+        return types.SimpleNamespace(id=self._id('asst_'))
 
+    def retrieve_assistant(self, assistant_id):
+        self.service.wait('api')
+        return types.SimpleNamespace(id=assistant_id)
 
+    def create_thread(self):
+        self.service.wait('api')
+        thread_id = self._id('thread_')
+        with self.lock:
+            self.threads[thread_id] = []
+        return types.SimpleNamespace(id=thread_id)
+
+    def _add_message(self, thread_id, role, content, file_ids=()):
+        text = types.SimpleNamespace(value=content, annotations=[])
+        message = types.SimpleNamespace(id=self._id('msg_'), role=role, content=[types.SimpleNamespace(text=text)], file_ids=list(file_ids))
+        with self.lock:
+            self.threads[thread_id].append(message)
+        return message
+
+    def create_message(self, thread_id, role, content, file_ids=()):
+        self.service.wait('api')
+        return self._add_message(thread_id, role, content, file_ids)
+
+    def list_messages(self, thread_id):
+        self.service.wait('api')
+        with self.lock:
+            return types.SimpleNamespace(data=list(reversed(self.threads[thread_id])))
+
+    def create_run(self, thread_id, assistant_id, stream=False):
+        if stream:
+            # Like SDKs that predate run streaming, so runs go through the shared poller
+            raise TypeError("create() got an unexpected keyword argument 'stream'")
+        self.service.wait('api')
+        run_id = self._id('run_')
+        with self.lock:
+            self.runs[run_id] = {'thread_id': thread_id, 'due': time.monotonic() + self.service.delay('run'),
+                                 'status': 'failed' if self.service.fails() else 'completed', 'done': False}
+        return types.SimpleNamespace(id=run_id, status='queued')
+
+    def retrieve_run(self, thread_id, run_id):
+        self.service.wait('api')
+        with self.lock:
+            run = self.runs[run_id]
+            finishing = not run['done'] and time.monotonic() >= run['due']
+            run['done'] = run['done'] or finishing
+        if finishing and run['status'] == 'completed':
+            self._add_message(thread_id, 'assistant', self._assistant_reply(thread_id))
+        status = run['status'] if run['done'] else 'in_progress'
+        last_error = types.SimpleNamespace(code='server_error', message='Fake run failure') if status == 'failed' else None
+        return types.SimpleNamespace(id=run_id, status=status, last_error=last_error)
+
+    def cancel_run(self, thread_id, run_id):
+        self.service.wait('api')
+        with self.lock:
+            self.runs[run_id].update(status='cancelled', done=True)
+        return types.SimpleNamespace(id=run_id, status='cancelled')
+
+    def _assistant_reply(self, thread_id):
+        with self.lock:
+            messages = list(self.threads[thread_id])
+            links = [link for link in self.file_links.values() if link]
+        prompt = messages[-1].content[0].text.value
+        rng = self._rng(thread_id, len(messages))
+        if 'outline' in prompt.lower() and 'Full Notes:' not in prompt:
+            return synthetic_outline(rng, links)
+        file_ids = [file_id for message in messages for file_id in message.file_ids]
+        with self.lock:
+            link = self.file_links.get(file_ids[-1]) if file_ids else None
+        return synthetic_notes(rng, link or f"{self.base_url}/article/unknown")
+
+    def create_completion(self, model, messages, stream=False, response_format=None, **kwargs):
+        self._request()
+        rng = self._rng(len(messages), messages[-1]['content'][:200])
+        prompt = messages[-1]['content']
+        if response_format is not None:
+            text = json.dumps(synthetic_survey(rng))
+        elif 'bibliography' in prompt.lower():
+            text = "## Bibliography\n" + '\n'.join(f"- {url}" for url in dict.fromkeys(SOURCE_URL_PATTERN.findall(prompt))) + "\n- Bibliography Complete -"
+        else:
+            with self.lock:
+                links = [link for link in self.file_links.values() if link]
+            title = re.search(r'exactly as it appears in the outline: (.+)', '\n'.join(message['content'] for message in messages))
+            text = synthetic_section(rng, title.group(1).strip() if title else "Section", links)
+        if not stream:
+            self.service.wait('chat')
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))], usage=None)
+        return self._stream(text)
+
+    def _stream(self, text):
+        step = max(1, len(text) // BENCH_STREAM_CHUNKS)
+        delay = self.service.delay('chat') / BENCH_STREAM_CHUNKS
+        for start in range(0, len(text), step):
+            time.sleep(delay)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text[start:start + step]))])
+
+    def generate_image(self, **kwargs):
+        self._request()
+        self.service.wait('image')
+        return types.SimpleNamespace(data=[types.SimpleNamespace(url=f"{self.base_url}/image/{next(self.ids)}")])
+
+def synthetic_notes(rng, link):
+    lines = ["Full Notes:", f"Article Source URL for Later Citation: {link}"]
+    for category in range(1, 5):
+        lines.append(f"Category {category}: {' '.join(rng.sample(BENCH_WORDS, 3)).title()}")
+        for fact in range(1, BENCH_NOTE_FACTS // 4 + 1):
+            lines.append(f"Fact/Info {fact}: {' '.join(rng.choices(BENCH_WORDS, k=14))} - http or https URL of Source: {link}")
+    return '\n'.join(lines)
+
+def synthetic_outline(rng, links):
+    lines = ["# Benchmark Article"]
+    for section in range(1, BENCH_OUTLINE_SECTIONS + 1):
+        lines.append(f"## {section}. {' '.join(rng.sample(BENCH_WORDS, 3)).title()}")
+        if links:
+            lines.append(f"[Relevant Source from Notes: {rng.choice(links)}]")
+        for subsection in range(1, 4):
+            lines.append(f"### {section}.{subsection} {' '.join(rng.sample(BENCH_WORDS, 3)).title()}")
+            lines.append(f"- {' '.join(rng.choices(BENCH_WORDS, k=10))}")
+    return '\n'.join(lines)
+
+def synthetic_section(rng, title, links):
+    lines = [title, f"[Insert Image Here: a simple drawing of {' '.join(rng.sample(BENCH_WORDS, 3))}]"]
+    for sentence in synthetic_sentences(rng, BENCH_SECTION_WORDS):
+        link = rng.choice(links) if links else None
+        lines.append(f"{sentence} [Source, {link}]" if link and rng.random() < 0.3 else sentence)
+    lines += ["| Item | Value |", "| --- | --- |"] + [f"| {rng.choice(BENCH_WORDS)} | {rng.randint(1, 100)} |" for _ in range(3)]
+    return '\n'.join(lines)
+
+def synthetic_survey(rng):
+    types_cycle = ['yes_no', 'multiple_choice', 'opinion_scale', 'long_text']
+    fields, logic = [], []
+    for number in range(1, BENCH_SURVEY_QUESTIONS + 1):
+        field = {'ref': f"q{number}", 'title': f"Question {number} about {rng.choice(BENCH_WORDS)}?", 'type': types_cycle[number % len(types_cycle)]}
+        if field['type'] == 'multiple_choice':
+            field['properties'] = {'choices': [{'label': label} for label in rng.sample(BENCH_WORDS, 4)]}
+        fields.append(field)
+        if field['type'] == 'yes_no' and number + 2 <= BENCH_SURVEY_QUESTIONS:
+            logic.append({'type': 'field', 'ref': field['ref'], 'actions': [{
+                'action': 'jump', 'details': {'to': {'type': 'field', 'value': f"q{number + 2}"}},
+                'condition': {'op': 'is', 'vars': [{'type': 'field', 'value': field['ref']}, {'type': 'constant', 'value': False}]}}]})
+    return {'title': "Benchmark survey", 'fields': fields, 'logic': logic}
+
+def use_cache_dir(cache_dir):
+    """ Point the on-disk caches and run checkpoints at another directory, leaving the real ones untouched """
+    global serp_cache, article_store, file_id_cache, assistant_registry, llm_cache, CHECKPOINT_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    serp_cache = DiskCache(os.path.join(cache_dir, "serp.sqlite3"), ttl=SERP_CACHE_TTL, max_bytes=SERP_CACHE_MAX_BYTES)
+    article_store = ArticleStore(os.path.join(cache_dir, os.path.basename(ARTICLE_STORE_PATH)), max_bytes=ARTICLE_STORE_MAX_BYTES)
+    file_id_cache = DiskCache(os.path.join(cache_dir, "file_ids.sqlite3"), ttl=FILE_ID_CACHE_TTL)
+    assistant_registry = DiskCache(os.path.join(cache_dir, os.path.basename(ASSISTANT_REGISTRY_PATH)))
+    llm_cache = LLMCache(os.path.join(cache_dir, "llm.sqlite3"), mode='bypass')
+    CHECKPOINT_DIR = os.path.join(cache_dir, "runs")
+    _verified_assistant_ids.clear()
+    _verified_file_ids.clear()
+    file_content_hashes.clear()
+    _file_metadata_cache.clear()
+
+def run_benchmark(sizes=BENCH_SIZES, latency_scale=1.0, failure_rate=0.0, seed=0, real_rate_limits=False):
+    """
+    Time the whole pipeline against local fakes of every external service.
+
+    The fakes replace the OpenAI client, GoogleSearch and the Typeform URL for the rest of the process,
+    and every size runs on empty caches in a temporary directory.
+
+    Parameters:
+    sizes (iterable): Numbers of search results (articles) to benchmark.
+    latency_scale (float): Multiplier for the BENCH_LATENCY medians; 0 removes the simulated latency.
+    failure_rate (float): Share of requests, runs and page loads that fail.
+    seed (int): Seed for latencies, failures and synthetic content.
+    real_rate_limits (bool): Keep the production RPM/TPM budgets instead of only the stage priorities.
+
+    Returns:
+    pandas.DataFrame: One row per size and stage with wall time and throughput, plus a total row with peak memory.
+    """
+    global client, GoogleSearch, TYPEFORM_FORMS_URL, openai_scheduler
+    service = FakeService(latency_scale, failure_rate, seed)
+    server = start_fake_hosts(service, seed)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    client = FakeOpenAI(service, base_url, seed)
+    TYPEFORM_FORMS_URL = f"{base_url}/forms"
+    if not real_rate_limits:
+        # The production budgets would dominate the timings, so only the stage priorities are kept
+        openai_scheduler = OpenAIScheduler(limits={"default": {}})
+    bench_dir = tempfile.mkdtemp(prefix="bench_")
+    rows = []
+    try:
+        for size in sizes:
+            use_cache_dir(os.path.join(bench_dir, str(size)))
+            GoogleSearch = make_fake_google_search(base_url, size, service)
+            pipeline = Pipeline(PIPELINE_STAGES)
+            tracemalloc.start()
+            started = time.monotonic()
+            error = None
+            try:
+                values = pipeline.run({'query': BENCH_QUERY, 'num_articles': math.ceil(size / 10), 'max_sources': 0,
+                                       'type_of_writer': "NYTimes Journalist", 'style': "Professional and actionable.",
+                                       'ui': ConsoleUI(f"[bench {size}] ")})
+            except Exception as e:
+                # Failures the pipeline doesn't recover from, like a failed outline run, still report how far it got
+                print(f"Benchmark with {size} articles failed: {e}")
+                error, values = str(e), {}
+            finally:
+                total = time.monotonic() - started
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            if 'bundle' in values:
+                values['bundle'].close()
+            for name, (stage_started, stage_finished) in sorted(pipeline.timings.items(), key=lambda item: item[1]):
+                seconds = stage_finished - stage_started
+                output, unit = BENCH_STAGE_ITEMS.get(name, (None, None))
+                produced = values.get(output)
+                items = len(produced.items if isinstance(produced, Channel) else produced) if produced is not None else None
+                rows.append({'articles': size, 'stage': name, 'start_s': round(stage_started - started, 2), 'seconds': round(seconds, 2),
+                             'items': items, 'unit': unit, 'items_per_s': round(items / seconds, 1) if items and seconds else None,
+                             'peak_mb': None, 'error': None})
+            sources = len(values.get('articles', ()))
+            rows.append({'articles': size, 'stage': 'total', 'start_s': 0.0, 'seconds': round(total, 2), 'items': sources,
+                         'unit': 'articles', 'items_per_s': round(sources / total, 1), 'peak_mb': round(peak / 1e6, 1), 'error': error})
+    finally:
+        server.shutdown()
+        shutil.rmtree(bench_dir, ignore_errors=True)
+    return pd.DataFrame(rows)
+
+def build_cli_parser():
+    parser = argparse.ArgumentParser(prog="python -m app", description="Run the content pipeline without Streamlit.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="Write an article for every query in a file")
+    run.add_argument("--queries", required=True, help="Text file with one query per line")
+    run.add_argument("--output", default=BATCH_OUTPUT_DIR, help="Directory for the ZIP bundles and summary.csv")
+    run.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Queries in flight at once")
+    run.add_argument("--pages", type=int, default=1, help="Pages of search results to use for research")
+    run.add_argument("--max-sources", type=int, default=10, help="Maximum number of sources to analyze (0 for no limit)")
+    run.add_argument("--writer", default="NYTimes Journalist", help="Type of writer to simulate")
+    run.add_argument("--style", default="Professional and actionable.", help="Style or voice to adhere to")
+    run.add_argument("--skip-survey", action="store_true", help="Don't write a survey or create a Typeform")
+    run.add_argument("--fresh", action="store_true", help="Start every query over instead of resuming unfinished runs")
+    run.add_argument("--llm-cache", choices=LLM_CACHE_MODES, help="Model response cache mode (default: LLM_CACHE_MODE, or bypass)")
+    archive = run.add_mutually_exclusive_group()
+    archive.add_argument("--record", metavar="ARCHIVE", help="Record every outbound HTTP exchange, with timings, to this file")
+    archive.add_argument("--replay", metavar="ARCHIVE", help="Serve HTTP from a recording instead of the network")
+    run.add_argument("--replay-latency", type=float, default=HTTP_REPLAY_LATENCY,
+                     help="Multiplier for the recorded latencies when replaying (1 for the original timings, 0 for none)")
+    bench = commands.add_parser("bench", help="Time the pipeline offline against fakes of every external service")
+    bench.add_argument("--sizes", type=int, nargs="+", default=list(BENCH_SIZES), help="Numbers of articles to benchmark")
+    bench.add_argument("--latency-scale", type=float, default=1.0, help="Multiplier for the simulated service latencies (0 for none)")
+    bench.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests, runs and page loads that fail")
+    bench.add_argument("--seed", type=int, default=0, help="Seed for latencies, failures and synthetic content")
+    bench.add_argument("--real-rate-limits", action="store_true", help="Keep the production OpenAI rate limits")
+    bench.add_argument("--output", help="Also write the report to this CSV file")
+    return parser
+
+def cli(argv=None):
+    args = build_cli_parser().parse_args(argv)
+    if args.command == "run":
+        archive = None
+        if args.record or args.replay:
+            archive = use_http_archive('record' if args.record else 'replay', args.record or args.replay, args.replay_latency)
+        if args.llm_cache:
+            llm_cache.set_mode(args.llm_cache)
+        try:
+            # With an archive the checkpoints live in its empty temporary directory, so every stage runs
+            summary = run_batch(read_queries(args.queries), args.output, args.concurrency, args.skip_survey, args.fresh,
+                                num_articles=args.pages, max_sources=args.max_sources, type_of_writer=args.writer, style=args.style)
+            print(summary.to_string(index=False))
+        finally:
+            if archive is not None:
+                print(archive.summary())
+                archive.close()
+    elif args.command == "bench":
+        report = run_benchmark(args.sizes, args.latency_scale, args.failure_rate, args.seed, args.real_rate_limits)
+        print(report.to_string(index=False))
+        if args.output:
+            report.to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+    # streamlit run app.py serves the page; python -m app is the headless CLI
+    if st.runtime.exists():
+        main()
+    else:
+        cli()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+import streamlit as st
+
+# app.py reads its API keys from the Streamlit secrets at import time, which the tests never use to call the APIs
+st.secrets = {"OPENAI_API_KEY": "test", "SERP_API_KEY": "test", "TYPEFORM_API_KEY": "test"}
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import app
+
+
+def test_items_survive_a_record_cut_short_by_a_crash(tmp_path):
+    checkpoint = app.RunCheckpoint(str(tmp_path), {'query': 'q'})
+    checkpoint.save_item('write', ('section', 0), 'first')
+    checkpoint.save_item('write', ('section', 1), 'second')
+    log_path = tmp_path / 'write.items'
+    data = log_path.read_bytes()
+    log_path.write_bytes(data[:-5])
+
+    resumed = app.RunCheckpoint(str(tmp_path))
+    assert resumed.items('write') == {('section', 0): 'first'}
+    resumed.save_item('write', ('section', 1), 'second again')
+    resumed.save_item('write', ('section', 2), 'third')
+    assert app.RunCheckpoint(str(tmp_path)).items('write') == {
+        ('section', 0): 'first', ('section', 1): 'second again', ('section', 2): 'third'}
+
+
+def test_outputs_and_completion_are_restored(tmp_path):
+    checkpoint = app.RunCheckpoint(str(tmp_path), {'query': 'q'})
+    checkpoint.save_outputs('scrape', {'articles': [1, 2]})
+    resumed = app.RunCheckpoint(str(tmp_path))
+    assert resumed.completed('scrape') and not resumed.completed('upload')
+    assert resumed.load_outputs('scrape') == {'articles': [1, 2]}
+
+
+def test_run_batch_runs_each_query_once(tmp_path, monkeypatch):
+    ran = []
+
+    def run_query(position, query, output_dir, stages, settings, fresh=False):
+        ran.append(query)
+        return {'query': query, 'status': 'ok'}
+
+    monkeypatch.setattr(app, 'run_query', run_query)
+    summary = app.run_batch(['a', 'b', 'a'], str(tmp_path), concurrency=2)
+    assert sorted(ran) == ['a', 'b']
+    assert len(summary) == 2
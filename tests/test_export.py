@@ -0,0 +1,35 @@
+import os
+import zipfile
+
+import pandas as pd
+import streamlit as st
+
+import app
+
+
+def build_bundle(tmp_path):
+    article_path = tmp_path / "article.md"
+    article_path.write_text("# Title\n\nBody text", encoding="utf-8")
+    full_notes = pd.DataFrame({'File ID': ['file-1'], 'Note': ['Some notes']})
+    df_outline = pd.DataFrame(['outline one', 'outline two'])
+    return app.build_export_bundle(['outline one', 'outline two'], str(article_path), full_notes, df_outline)
+
+
+def test_bundle_is_a_zip_with_the_article_and_notes(tmp_path):
+    with build_bundle(tmp_path) as bundle, zipfile.ZipFile(bundle) as archive:
+        assert archive.read('Final_Article.txt').decode('utf-8') == "# Title\n\nBody text"
+        assert archive.read('Notes/01.md').decode('utf-8') == 'Some notes'
+        assert {'Final_Outline.txt', 'Full_Notes.csv', 'All_Outlines.csv'} <= set(archive.namelist())
+
+
+def test_large_bundles_spill_to_disk():
+    export = app.ExportBuilder(max_memory=1024)
+    export.add_chunks('Images/image_01.png', [os.urandom(4096)], compress=False)
+    with export.finish() as bundle:
+        assert bundle._rolled
+        assert zipfile.ZipFile(bundle).read('Images/image_01.png')
+
+
+def test_bundle_bytes_are_accepted_by_download_button(tmp_path):
+    with build_bundle(tmp_path) as bundle:
+        st.download_button(label="Download ZIP", data=bundle.read(), file_name="All_Results.zip", mime="application/zip")
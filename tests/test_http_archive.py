@@ -0,0 +1,94 @@
+import http.server
+import sqlite3
+import threading
+import zlib
+
+import pytest
+import requests
+
+import app
+
+httpx = app.httpx
+
+
+class PageStub(http.server.BaseHTTPRequestHandler):
+    """ Serves a page with a custom header, and a 404 for anything else """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        status, body = (200, b'{"results": [1, 2, 3]}') if self.path.startswith('/search') else (404, b'missing')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Stub', 'yes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PageStub)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def archive_session(archive):
+    session = requests.Session()
+    session.mount('http://', app.ArchiveAdapter(archive))
+    return session
+
+
+def test_requests_exchanges_replay_with_the_server_gone(tmp_path, stub):
+    path = str(tmp_path / 'archive.sqlite3')
+    base_url = f"http://127.0.0.1:{stub.server_port}"
+    session = archive_session(app.HTTPArchive(path, 'record'))
+    recorded = session.get(f"{base_url}/search?q=rates&api_key=secret")
+    missing = session.get(f"{base_url}/other")
+    stub.shutdown()
+    stub.server_close()
+    assert recorded.status_code == 200 and missing.status_code == 404
+    with sqlite3.connect(path) as conn:
+        archived = b''.join(zlib.decompress(row[0]) + row[1].encode('utf-8') for row in conn.execute("SELECT data, url FROM exchanges"))
+    assert b'secret' not in archived
+
+    archive = app.HTTPArchive(path, 'replay', latency_scale=0)
+    session = archive_session(archive)
+    # The API key isn't part of the recording, so a run with another key replays the same way
+    replayed = session.get(f"{base_url}/search?q=rates&api_key=other")
+    assert replayed.status_code == recorded.status_code
+    assert replayed.content == recorded.content
+    assert replayed.headers['X-Stub'] == 'yes' and replayed.headers['Content-Type'] == 'application/json'
+    assert session.get(f"{base_url}/other").status_code == 404
+    with pytest.raises(requests.ConnectionError, match="No recorded response for GET"):
+        session.get(f"{base_url}/never-recorded")
+    assert archive.replayed == 2 and archive.missed == 1
+    assert stub.requests == ['/search?q=rates&api_key=secret', '/other']
+
+
+def test_httpx_exchanges_replay_with_the_server_gone(tmp_path, stub):
+    path = str(tmp_path / 'archive.sqlite3')
+    url = f"http://127.0.0.1:{stub.server_port}/search?q=rates"
+    with httpx.Client(transport=app.ArchiveTransport(app.HTTPArchive(path, 'record'))) as client:
+        recorded = client.get(url)
+    stub.shutdown()
+    stub.server_close()
+    assert stub.requests == ['/search?q=rates']
+
+    with httpx.Client(transport=app.ArchiveTransport(app.HTTPArchive(path, 'replay', latency_scale=0))) as client:
+        replayed = client.get(url)
+        assert replayed.status_code == recorded.status_code == 200
+        assert replayed.content == recorded.content
+        assert replayed.headers['x-stub'] == 'yes'
+        with pytest.raises(httpx.ConnectError, match="No recorded response for GET"):
+            client.get(url.replace('/search', '/never-recorded'))
+
+
+def test_replay_needs_an_existing_archive(tmp_path):
+    with pytest.raises(FileNotFoundError, match="No HTTP archive"):
+        app.HTTPArchive(str(tmp_path / 'missing.sqlite3'), 'replay')
@@ -0,0 +1,34 @@
+import time
+from types import SimpleNamespace as ns
+
+import app
+
+
+def test_image_urls_are_not_served_once_they_have_expired(tmp_path, monkeypatch):
+    cache = app.LLMCache(str(tmp_path / 'llm.sqlite3'), mode='read-through')
+    request = {'model': 'dall-e-3', 'prompt': 'a lighthouse'}
+    cache.record('image', request, 'https://images.example/1.png')
+    cache.record('chat', request, 'text')
+    assert cache.lookup('image', request) == 'https://images.example/1.png'
+
+    later = time.time() + 2 * 60 * 60
+    monkeypatch.setattr(app.time, 'time', lambda: later)
+    assert cache.lookup('image', request) is None
+    assert cache.lookup('chat', request) == 'text'
+
+
+def test_file_ids_still_fingerprint_by_content_after_a_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'file_id_cache', app.DiskCache(str(tmp_path / 'file_ids.sqlite3')))
+    monkeypatch.setattr(app, 'file_content_hashes', {})
+    monkeypatch.setattr(app, '_verified_file_ids', set())
+    uploads = iter(['file-first', 'file-second'])
+    client = ns(files=ns(create=lambda **kwargs: ns(id=next(uploads))))
+    file_id = app.upload_bytes(client, b'notes', 'notes.txt')
+    request = {'messages': [{'role': 'user', 'content': f'Read {file_id}'}]}
+    fingerprint = app.normalize_llm_request(request)
+    assert file_id not in str(fingerprint)
+
+    # A new process has no in-memory hashes, but the file ID cache still knows the content
+    app.file_content_hashes.clear()
+    assert app.normalize_llm_request(request) == fingerprint
+    assert app.normalize_llm_request('Read file-unknown') == 'Read file-unknown'
@@ -0,0 +1,33 @@
+import app
+
+FACT_NOTE = """Article Title: Rates outlook
+Source: https://a.com/rates
+
+Category 1: Monetary policy
+Fact/Info 1: The central bank raised rates by half a point in March - http or https URL of Source: https://a.com/rates
+Fact/Info 2: Inflation expectations fell for the third month running
+Analysts quoted in the piece expect two more hikes this year.
+"""
+
+FREE_FORM_NOTE = """Article Title: Housing market
+Source: https://b.com/housing
+
+- Mortgage applications dropped 12% week over week
+- First-time buyers now make up a record low share of sales
+> "We have not seen a slowdown like this since 2008," one broker said.
+"""
+
+
+def test_free_form_notes_keep_their_content_and_source():
+    facts_df, corpus = app.compact_notes([FACT_NOTE, FREE_FORM_NOTE])
+    assert set(source for sources in facts_df['Sources'] for source in sources) == {'https://a.com/rates'}
+    assert "- Mortgage applications dropped 12% week over week (Source: https://b.com/housing)" in corpus
+    assert '> "We have not seen a slowdown like this since 2008," one broker said. (Source: https://b.com/housing)' in corpus
+    assert "Analysts quoted in the piece expect two more hikes this year. (Source: https://a.com/rates)" in corpus
+    assert "Article Title" not in corpus
+
+
+def test_every_line_of_the_writing_index_carries_its_source():
+    _, corpus = app.compact_notes([FREE_FORM_NOTE])
+    index = app.build_facts_index(corpus)
+    assert index.chunks and all('https://b.com/housing' in line for chunk in index.chunks for line in chunk.splitlines())
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+import app
+
+
+def fail(**kwargs):
+    raise RuntimeError("survey broke")
+
+
+def test_optional_stage_failure_skips_it_and_its_dependents():
+    stages = [
+        app.Stage('article', lambda query: {'article': query.upper()}, ('query',), ('article',)),
+        app.Stage('survey', fail, ('article',), ('survey',), optional=True),
+        app.Stage('form', lambda survey: {'form': survey}, ('survey',), ('form',), optional=True),
+        app.Stage('export', lambda article: {'bundle': article + '.zip'}, ('article',), ('bundle',)),
+    ]
+    pipeline = app.Pipeline(stages)
+    values = pipeline.run({'query': 'q'})
+    assert values['bundle'] == 'Q.zip'
+    assert 'survey' not in values and 'form' not in values
+    assert set(pipeline.skipped) == {'survey', 'form'}
+
+
+def test_required_stage_failure_stops_the_run():
+    stages = [app.Stage('article', fail, ('query',), ('article',))]
+    with pytest.raises(RuntimeError, match="survey broke"):
+        app.Pipeline(stages).run({'query': 'q'})
+
+
+def test_required_stage_cannot_depend_on_a_skipped_optional_stage():
+    stages = [
+        app.Stage('survey', fail, ('query',), ('survey',), optional=True),
+        app.Stage('export', lambda survey: {'bundle': survey}, ('survey',), ('bundle',)),
+    ]
+    with pytest.raises(RuntimeError, match="needs the outputs of stage survey"):
+        app.Pipeline(stages).run({'query': 'q'})
+
+
+def test_salvage_json_keeps_complete_values_of_a_truncated_survey():
+    survey = {'title': 'Survey', 'fields': [{'ref': 'q1', 'title': 'One?', 'type': 'yes_no'},
+                                            {'ref': 'q2', 'title': 'Two, "quoted" {braces}?', 'type': 'long_text'}]}
+    text = json.dumps(survey)
+    truncated = text[:text.index('"q2"') + 12]
+    assert app.salvage_json(truncated) == {'title': 'Survey', 'fields': [survey['fields'][0], {'ref': 'q2'}]}
+    assert app.salvage_json("Here you go: " + text + " trailing") == survey
+
+
+def test_salvage_json_rejects_text_without_complete_values():
+    with pytest.raises(ValueError):
+        app.salvage_json('{"title": "Surv')
@@ -0,0 +1,196 @@
+import copy
+import http.server
+import json
+import threading
+
+import pytest
+
+import app
+
+
+def survey():
+    return {
+        'title': 'Reader survey',
+        'fields': [
+            {'ref': 'liked', 'title': 'Did you like the article?', 'type': 'yes_no'},
+            {'ref': 'topic', 'title': 'Which topic?', 'type': 'multiple_choice',
+             'properties': {'choices': [{'label': 'Policy', 'ref': 'policy'}, {'label': 'Markets', 'ref': 'markets'}]}},
+            {'ref': 'score', 'title': 'How useful was it?', 'type': 'opinion_scale', 'properties': {'steps': 5}},
+            {'ref': 'why', 'title': 'Why?', 'type': 'long_text'},
+        ],
+        'logic': [
+            {'type': 'field', 'ref': 'liked', 'actions': [{
+                'action': 'jump', 'details': {'to': {'type': 'field', 'value': 'why'}},
+                'condition': {'op': 'is', 'vars': [{'type': 'field', 'value': 'liked'}, {'type': 'constant', 'value': False}]}}]},
+        ],
+    }
+
+
+def condition(form, index=0):
+    return form['logic'][index]['actions'][0]['condition']
+
+
+def messages(issues):
+    return ' | '.join(issue.message for issue in issues)
+
+
+def test_valid_survey_has_no_issues():
+    assert app.validate_form(survey()) == []
+
+
+def test_validate_form_flags_bad_and_duplicate_refs():
+    form = survey()
+    form['fields'][0]['ref'] = 'not a ref!'
+    form['fields'][2]['ref'] = 'topic'
+    issues = app.validate_form(form)
+    assert "fields[0] ref 'not a ref!' is not a valid ref" in messages(issues)
+    assert "fields[2] ref 'topic' is used by more than one field" in messages(issues)
+
+
+def test_validate_form_flags_invalid_ops():
+    form = survey()
+    condition(form)['op'] = 'greater_than'
+    issues = app.validate_form(form)
+    assert [(issue.kind, issue.index) for issue in issues] == [('logic', 0)]
+    assert "op greater_than is not supported for yes_no field 'liked'" in messages(issues)
+
+
+def test_validate_form_flags_type_mismatches():
+    form = survey()
+    condition(form)['vars'][1]['value'] = 'no'
+    form['logic'].append({'type': 'field', 'ref': 'topic', 'actions': [{
+        'action': 'jump', 'details': {'to': {'type': 'field', 'value': 'why'}},
+        'condition': {'op': 'is', 'vars': [{'type': 'field', 'value': 'topic'}, {'type': 'constant', 'value': 'Policy'}]}}]})
+    issues = app.validate_form(form)
+    assert "must compare 'liked' against a boolean constant" in messages(issues)
+    assert "must compare 'topic' against one of its choice refs" in messages(issues)
+
+
+def test_validate_form_flags_unknown_types_refs_and_shape():
+    form = survey()
+    form['fields'][3]['type'] = 'video'
+    form['fields'][1]['properties']['shape'] = 'circle'
+    form['logic'][0]['ref'] = 'missing'
+    issues = messages(app.validate_form(form))
+    assert "fields[3] type 'video' is not supported" in issues
+    assert "shape is not a valid key" in issues
+    assert "refers to unknown field 'missing'" in issues
+
+
+def test_repair_form_fixes_refs_ops_and_types():
+    form = survey()
+    form['fields'][0]['ref'] = 'Did you like it?'
+    form['fields'][1]['type'] = 'picture_choice'
+    form['fields'][1]['properties']['shape'] = 'circle'
+    form['fields'][2]['ref'] = 'topic'
+    form['fields'][2]['properties']['steps'] = '20'
+    form['logic'][0]['ref'] = 'Did you like it?'
+    condition(form)['op'] = 'equal'
+    condition(form)['vars'] = [{'type': 'field', 'value': 'Did you like the article?'}, {'type': 'constant', 'value': 'no'}]
+    form['logic'].append({'ref': 'topic', 'actions': [{
+        'action': 'JUMP', 'details': {'to': {'type': 'field', 'value': 'Why?'}},
+        'condition': {'op': 'equals', 'vars': [{'type': 'field', 'value': 'topic'}, {'type': 'constant', 'value': 'Markets'}]}}]})
+    assert app.validate_form(form)
+
+    repaired = app.repair_form(form)
+    assert app.validate_form(repaired) == []
+    assert [field['ref'] for field in repaired['fields']] == ['did_you_like_it', 'topic', 'topic_2', 'why']
+    assert repaired['fields'][1]['type'] == 'multiple_choice'
+    assert repaired['fields'][2]['properties']['steps'] == 11
+    assert condition(repaired) == {'op': 'is', 'vars': [{'type': 'field', 'value': 'did_you_like_it'}, {'type': 'constant', 'value': False}]}
+    assert condition(repaired, 1)['vars'][1] == {'type': 'choice', 'value': 'markets'}
+    assert repaired['logic'][1]['actions'][0]['details']['to'] == {'type': 'field', 'value': 'why'}
+
+
+def test_prepare_form_regenerates_what_repair_cannot_fix(monkeypatch):
+    form = survey()
+    condition(form)['op'] = 'contains'
+    fixed_logic = copy.deepcopy(survey()['logic'][0])
+    calls = []
+
+    def regenerate(form, kind, index, problems):
+        calls.append((kind, index, problems))
+        return copy.deepcopy(fixed_logic)
+
+    monkeypatch.setattr(app, 'regenerate_form_fragment', regenerate)
+    prepared = app.prepare_form(form)
+    assert [(kind, index) for kind, index, _ in calls] == [('logic', 0)]
+    assert 'op contains is not supported' in calls[0][2][0]
+    assert prepared['logic'] == [fixed_logic]
+    assert app.validate_form(prepared) == []
+
+
+def test_prepare_form_drops_fragments_that_stay_broken(monkeypatch):
+    form = survey()
+    condition(form)['op'] = 'contains'
+    monkeypatch.setattr(app, 'regenerate_form_fragment', lambda form, kind, index, problems: None)
+    prepared = app.prepare_form(form)
+    assert prepared['logic'] == []
+    assert len(prepared['fields']) == 4
+
+
+def test_prepare_form_raises_when_nothing_is_left(monkeypatch):
+    monkeypatch.setattr(app, 'regenerate_form_fragment', lambda form, kind, index, problems: None)
+    with pytest.raises(ValueError, match="could not be repaired"):
+        app.prepare_form({'title': 'Empty', 'fields': [{'title': 'Video?', 'type': 'video'}]})
+
+
+class FormsStub(http.server.BaseHTTPRequestHandler):
+    """ Typeform's create form endpoint: rejects the first payload's logic, accepts the next one """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.posted.append(body)
+        if len(self.server.posted) == 1:
+            status, reply, headers = 400, {'code': 'VALIDATION_ERROR', 'details': [
+                {'code': 'invalid_value', 'field': '/logic/0/actions/0/condition', 'description': 'jump target is not reachable'}]}, {}
+        else:
+            status, reply, headers = 201, {'id': 'abc123'}, {'Location': 'https://api.typeform.com/forms/abc123'}
+        data = json.dumps(reply).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def forms_stub(monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FormsStub)
+    server.posted = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(app, 'TYPEFORM_FORMS_URL', f"http://127.0.0.1:{server.server_port}/forms")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_create_form_posts_to_the_forms_endpoint(forms_stub):
+    forms_stub.posted.append('earlier request')
+    response = app.create_form('token', survey())
+    assert response.status_code == 201
+    assert forms_stub.posted[-1] == survey()
+
+
+def test_typeform_stage_repairs_after_a_400(forms_stub, monkeypatch):
+    regenerated = []
+
+    def regenerate(form, kind, index, problems):
+        regenerated.append((kind, index, problems))
+        logic = copy.deepcopy(form[kind][index])
+        logic['actions'][0]['details']['to']['value'] = 'score'
+        return logic
+
+    monkeypatch.setattr(app, 'regenerate_form_fragment', regenerate)
+    response = app.typeform_stage(survey())['form_response']
+    assert response.status_code == 201
+    assert response.headers['Location'] == 'https://api.typeform.com/forms/abc123'
+    assert len(forms_stub.posted) == 2
+    assert forms_stub.posted[0] == survey()
+    assert regenerated == [('logic', 0, ['logic[0] jump target is not reachable'])]
+    assert forms_stub.posted[1]['logic'][0]['actions'][0]['details']['to'] == {'type': 'field', 'value': 'score'}
@@ -0,0 +1,85 @@
+import os
+import re
+
+import pytest
+
+import app
+
+PARALLEL_OUTLINE = "# Article\n## First\n- A point\n## Second\n- Another point\n"
+
+
+@pytest.fixture
+def images(monkeypatch):
+    monkeypatch.setattr(app, 'generate_image', lambda description: f'<img src="https://img.example/{description}.png" width="800"/>')
+
+
+def run_write_stage(outline):
+    result = app.write_stage('query', outline, app.NotesIndex(), 'Writer', 'Plain', app.ConsoleUI(), None)
+    assert list(result) == ['article_path']
+    with open(result['article_path'], encoding='utf-8') as file:
+        article = file.read()
+    os.remove(result['article_path'])
+    return article
+
+
+def section_writer(calls, failures=None):
+    """ Stand-in for query_assistant that writes a section per request and fails a title while failures[title] > 0 """
+    failures = failures if failures is not None else {}
+
+    def writer(messages, type_of_writer, style, on_delta=None):
+        request = messages[-1]['content']
+        if 'bibliography' in request:
+            return "## Bibliography\n- https://first.example\n- Bibliography Complete -"
+        title = re.search(r'Please write the section: (.*)', request).group(1)
+        calls.append(title)
+        if failures.get(title, 0) > 0:
+            failures[title] -= 1
+            raise RuntimeError("rate limited")
+        return f"## {title}\n\n[Insert Image Here: {title.lower()}]\n\nAbout {title}, see https://{title.lower()}.example"
+    return writer
+
+
+def test_parallel_sections_are_assembled_in_order_with_their_images(monkeypatch, images):
+    calls = []
+    monkeypatch.setattr(app, 'query_assistant', section_writer(calls))
+    article = run_write_stage(PARALLEL_OUTLINE)
+    assert sorted(calls) == ['First', 'Second']
+    assert article.index('## Table of Contents') < article.index('## First') < article.index('## Second') < article.index('## Bibliography')
+    assert '<img src="https://img.example/first.png"' in article and '<img src="https://img.example/second.png"' in article
+    assert '[Insert Image Here' not in article
+
+
+def test_failed_sections_are_requested_again_before_stitching(monkeypatch, images):
+    calls = []
+    monkeypatch.setattr(app, 'query_assistant', section_writer(calls, {'Second': app.SECTION_ATTEMPTS}))
+    article = run_write_stage(PARALLEL_OUTLINE)
+    assert calls.count('Second') == app.SECTION_ATTEMPTS + 1
+    assert article.index('## First') < article.index('## Second') < article.index('## Bibliography')
+
+
+def test_a_resumed_run_writes_only_the_sections_that_failed(tmp_path, monkeypatch, images):
+    calls = []
+    monkeypatch.setattr(app, 'query_assistant', section_writer(calls, {'Second': app.SECTION_ATTEMPTS * app.SECTION_ROUNDS}))
+    checkpoint = app.RunCheckpoint(str(tmp_path), {'query': 'query'})
+    with pytest.raises(RuntimeError, match="Could not write the sections \\['Second'\\]"):
+        app.write_stage('query', PARALLEL_OUTLINE, app.NotesIndex(), 'Writer', 'Plain', app.ConsoleUI(), checkpoint)
+
+    calls.clear()
+    result = app.write_stage('query', PARALLEL_OUTLINE, app.NotesIndex(), 'Writer', 'Plain', app.ConsoleUI(), app.RunCheckpoint(str(tmp_path)))
+    assert calls == ['Second']
+    with open(result['article_path'], encoding='utf-8') as file:
+        article = file.read()
+    assert article.index('## First') < article.index('## Second') < article.index('## Bibliography')
+
+
+def test_sequential_sections_are_assembled_in_order(monkeypatch, images):
+    replies = iter([
+        "## Table of Contents\n- Only",
+        "## Only\n\n[Insert Image Here: only]\n\nText citing https://only.example [Next Section to Write: Bibliography]",
+        "## Bibliography\n- https://only.example\n- Bibliography Complete -\n- Article Complete -",
+    ])
+    monkeypatch.setattr(app, 'query_assistant', lambda messages, type_of_writer, style, on_delta=None: next(replies))
+    article = run_write_stage("# Article\n## Only\n- A point\n")
+    assert article.index('## Table of Contents') < article.index('## Only') < article.index('## Bibliography')
+    assert '<img src="https://img.example/only.png"' in article
+    assert next(replies, None) is None